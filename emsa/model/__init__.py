@@ -1,4 +1,11 @@
 from .model_base import EpidemicModelBase, get_substates
 from .matrix_generator import MatrixGenerator
+from .sparse_matrix import SparseMatrix
+from .layered_matrix import LayeredMatrix
+from .matrix_cache import MatrixCache
+from .schedule import Schedule, SegmentedODE
+from .factored_ode import FactoredODE
+from .state_layout import StateLayout
+from .ode_compiler import compile_model_struct, ODECompiler
 from .epidemic_model import EpidemicModel
 from .r0_calculator import R0Generator
@@ -5,15 +5,19 @@ from .model_base import EpidemicModelBase
 
 
 class EpidemicModel(EpidemicModelBase):
-    def __init__(self, data, model_struct: dict):
+    def __init__(
+        self, data, model_struct: dict, ode_engine: str = "dense", solver_config: dict = None
+    ):
         """
         Initialize the EpidemicModel, a class for running single simulations of a given model.
 
         Parameters:
             data: Model data.
             model_struct (dict): The structure of the model.
+            ode_engine (str): Method of evaluating the right-hand side of the ODE.
+            solver_config (dict): Integration method and its settings.
         """
-        super().__init__(data, model_struct)
+        super().__init__(data, model_struct, ode_engine=ode_engine, solver_config=solver_config)
 
     def get_solution(self, y0: torch.Tensor, t_eval: torch.Tensor, **kwargs) -> to.Solution:
         """
@@ -29,13 +33,19 @@ class EpidemicModel(EpidemicModelBase):
             torch.Tensor: Solution of the ODE.
         """
         self.initialize_matrices()
-        odefun = kwargs.get("odefun", self.basic_ode)
+        odefun = kwargs.get("odefun") or self.get_basic_ode()
         return self.get_sol_from_ode(
             y0=torch.atleast_2d(y0),
             t_eval=torch.atleast_2d(t_eval),
             odefun=odefun,
         )
 
+    def get_basic_ode(self):
+        """
+        Get the ODE function without vaccination, evaluated by the engine of the model.
+        """
+        return self.basic_ode if self.ode_engine == "dense" else self.get_engine_ode()
+
     def basic_ode(self, t: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
         """
         Basic ODE function without vaccination.
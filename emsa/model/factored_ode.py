@@ -0,0 +1,137 @@
+import torch
+
+from .layered_matrix import LayeredMatrix
+from .sparse_matrix import SparseMatrix
+
+
+class FactoredODE:
+    """
+    Right-hand side of the system
+
+            y' = (y @ A) * (y @ T) + y @ B,
+
+    evaluated without the n_eq x n_eq matrix products, see MatrixGenerator for the meaning of
+    the matrices.
+
+    The state is viewed as a tensor of shape (n_samples, n_age, n_comp). A and B only connect
+    compartments of the same age group, hence they are applied as one n_comp x n_comp block per
+    age group. The rows of T are only nonzero for the substates of the actors, and these rows are
+    the same for every substate of an actor, while its columns are only nonzero for the compartments
+    involved in transmission. The force of infection is thus computed from the actor sums with a
+    contact product of cost O(n_age^2) per compartment involved, and the cost of evaluating the
+    right-hand side is O(n_age^2 + n_age * n_comp^2) instead of O(n_eq^2).
+
+    The matrices may either be shared by all samples, or stacks with a leading sample dimension.
+
+    Attributes:
+        n_age (int): The number of age groups.
+        n_comp (int): The number of compartments per age group.
+        B_blocks (torch.Tensor): Blocks of B, of shape (..., n_age, n_comp, n_comp).
+        A_blocks (torch.Tensor): Columns of the blocks of A involved in transmission.
+        tms_comps (torch.Tensor): Indices of the compartments involved in transmission.
+        actor_agg (torch.Tensor): Matrix of shape (n_comp, n_actors) summing the actor substates.
+        contact_kernel (torch.Tensor): Rows of T corresponding to the actors, and columns to the
+            compartments involved in transmission, of shape (..., n_age, n_actors, n_age, n_tms_comps).
+    """
+
+    def __init__(self, model, A=None, T=None, B=None):
+        """
+        Initialize the factored right-hand side from the matrices of the model.
+
+        Args:
+            model (EpidemicModelBase): The model, the matrices of which are used by default.
+            A: Matrix or matrix stack used instead of model.A.
+            T: Matrix or matrix stack used instead of model.T.
+            B: Matrix or matrix stack used instead of model.B.
+        """
+        self.n_age = model.n_age
+        self.n_comp = model.n_comp
+        A, T, B = (
+            to_dense(model_matrix if matrix is None else matrix)
+            for model_matrix, matrix in zip((model.A, model.T, model.B), (A, T, B))
+        )
+
+        A_blocks = self._get_age_blocks(A)
+        self.B_blocks = self._get_age_blocks(B)
+
+        T = T.reshape(*T.shape[:-2], self.n_age, self.n_comp, self.n_age, self.n_comp)
+        # Products of y @ A and y @ T are only nonzero where both have nonzero columns
+        tms_cols = self._get_nonzero_comps(A_blocks, dim=-1) & self._get_nonzero_comps(T, dim=-1)
+        self.tms_comps = tms_cols.nonzero().flatten()
+        self.A_blocks = A_blocks.index_select(-1, self.tms_comps).contiguous()
+
+        actor_groups = self._get_actor_groups(T=T, compartments=model.compartments)
+        self.actor_agg = torch.zeros((self.n_comp, len(actor_groups)), device=T.device)
+        for group_idx, group in enumerate(actor_groups):
+            self.actor_agg[group, group_idx] = 1
+        actor_rows = torch.tensor([group[0] for group in actor_groups], device=T.device)
+        self.contact_kernel = (
+            T.index_select(-3, actor_rows).index_select(-1, self.tms_comps).contiguous()
+        )
+
+    def __call__(self, t: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+        y = y.reshape(y.shape[0], self.n_age, self.n_comp)
+        # Weighted sums of the actors are mixed by the contact kernel
+        actors = y @ self.actor_agg
+        force_of_infection = torch.einsum("...jg,...jgis->...is", actors, self.contact_kernel)
+        transmission = torch.einsum("...ac,...acs->...as", y, self.A_blocks) * force_of_infection
+        linear = torch.einsum("...ac,...acd->...ad", y, self.B_blocks)
+        return linear.index_add_(-1, self.tms_comps, transmission).reshape(y.shape[0], -1)
+
+    def _get_age_blocks(self, matrix: torch.Tensor) -> torch.Tensor:
+        """
+        Get the diagonal blocks of a matrix connecting compartments of the same age group.
+
+        Args:
+            matrix (torch.Tensor): Matrix of shape (..., n_eq, n_eq).
+
+        Returns:
+            torch.Tensor: Blocks of shape (..., n_age, n_comp, n_comp).
+
+        Raises:
+            ValueError: If the matrix connects compartments of different age groups.
+        """
+        matrix = matrix.reshape(
+            *matrix.shape[:-2], self.n_age, self.n_comp, self.n_age, self.n_comp
+        )
+        blocks = torch.diagonal(matrix, dim1=-4, dim2=-2).movedim(-1, -3)
+        if torch.count_nonzero(blocks) != torch.count_nonzero(matrix):
+            raise ValueError("Linear terms between different age groups can't be factored!")
+        return blocks.contiguous()
+
+    def _get_nonzero_comps(self, matrix: torch.Tensor, dim: int) -> torch.Tensor:
+        """
+        Get a mask of the compartments with a nonzero entry along the given dimension.
+        """
+        return (matrix != 0).movedim(dim, -1).reshape(-1, self.n_comp).any(dim=0)
+
+    def _get_actor_groups(self, T: torch.Tensor, compartments: list) -> list:
+        """
+        Group the compartments with nonzero rows in T by state. Substates of the same state are summed
+        before applying the contact kernel, given that their rows in T are the same, otherwise every
+        substate forms a group on its own.
+
+        Args:
+            T (torch.Tensor): T of shape (..., n_age, n_comp, n_age, n_comp).
+            compartments (list): Names of the compartments.
+
+        Returns:
+            list: Lists of compartment indices.
+        """
+        actor_comps = self._get_nonzero_comps(T, dim=-3).nonzero().flatten().tolist()
+        groups = {}
+        for comp in actor_comps:
+            groups.setdefault(compartments[comp].rsplit("_", 1)[0], []).append(comp)
+
+        actor_groups = []
+        for group in groups.values():
+            rows = T.index_select(-3, torch.tensor(group, device=T.device))
+            if all(torch.equal(rows[..., 0, :, :], rows[..., i, :, :]) for i in range(len(group))):
+                actor_groups.append(group)
+            else:
+                actor_groups += [[comp] for comp in group]
+        return actor_groups
+
+
+def to_dense(matrix) -> torch.Tensor:
+    return matrix.to_dense() if isinstance(matrix, (SparseMatrix, LayeredMatrix)) else matrix
@@ -0,0 +1,95 @@
+from typing import List
+
+import torch
+
+
+class LayeredMatrix:
+    """
+    Stack of matrices given as weighted sums of a few fixed layers, e.g. the transmission matrices
+    T corresponding to the home, work, school and other contact layers.
+
+    T is linear in the contact matrix, so scaling the contact layers, e.g. closing schools or
+    reducing work contacts, only changes the weights of the precomputed layers of T. Instead of
+    a dense matrix per sample, only the weights of shape (n_samples, n_layers) are stored, and
+    y @ M is computed with a single product of y with the layers shared by all samples.
+
+    Attributes:
+        layers (torch.Tensor): Layers of shape (n_layers, n_eq, n_eq) shared by all samples, or of
+            shape (n_samples, n_layers, n_eq, n_eq).
+        weights (torch.Tensor): Weights of the layers of shape (n_samples, n_layers).
+        n_eq (int): Number of rows (and columns) of the matrices.
+    """
+
+    def __init__(self, layers: torch.Tensor, weights: torch.Tensor):
+        self.layers = layers
+        self.weights = torch.atleast_2d(weights).to(dtype=layers.dtype, device=layers.device)
+        self.n_eq = layers.shape[-1]
+        self._flat_layers = None
+        if layers.dim() == 3:
+            # Layers side by side, so that y @ M_l for every layer l is a single product
+            self._flat_layers = layers.permute(1, 0, 2).reshape(self.n_eq, -1)
+
+    @classmethod
+    def cat(cls, matrices: List["LayeredMatrix"]) -> "LayeredMatrix":
+        """
+        Concatenate stacks of layered matrices along the sample dimension.
+        """
+        weights = torch.cat([matrix.weights for matrix in matrices])
+        if all(matrix.layers is matrices[0].layers for matrix in matrices):
+            return cls(layers=matrices[0].layers, weights=weights)
+        layers = [matrix.get_sample_layers() for matrix in matrices]
+        return cls(layers=torch.cat(layers), weights=weights)
+
+    @property
+    def is_batched(self) -> bool:
+        return True
+
+    @property
+    def is_shared(self) -> bool:
+        """
+        Whether the layers are shared by all samples.
+        """
+        return self.layers.dim() == 3
+
+    @property
+    def shape(self) -> torch.Size:
+        return torch.Size((self.weights.shape[0], self.n_eq, self.n_eq))
+
+    def dim(self) -> int:
+        return len(self.shape)
+
+    def size(self) -> torch.Size:
+        return self.shape
+
+    def to(self, device) -> "LayeredMatrix":
+        return LayeredMatrix(layers=self.layers.to(device), weights=self.weights.to(device))
+
+    def get_sample_layers(self) -> torch.Tensor:
+        """
+        Get the layers of every sample, of shape (n_samples, n_layers, n_eq, n_eq).
+        """
+        if self.is_shared:
+            return self.layers.expand(self.weights.shape[0], *self.layers.shape)
+        return self.layers
+
+    def select(self, idx: torch.Tensor) -> "LayeredMatrix":
+        """
+        Select the matrices at the given positions of the stack.
+        """
+        layers = self.layers if self.is_shared else self.layers[idx]
+        return LayeredMatrix(layers=layers, weights=self.weights[idx])
+
+    def to_dense(self) -> torch.Tensor:
+        if self.is_shared:
+            return torch.einsum("sl,lij->sij", self.weights, self.layers)
+        return torch.einsum("sl,slij->sij", self.weights, self.layers)
+
+    def __rmatmul__(self, y: torch.Tensor) -> torch.Tensor:
+        """
+        Compute y @ M, where y is of shape (n_samples, n_eq).
+        """
+        if self.is_shared:
+            layer_products = (y @ self._flat_layers).reshape(y.shape[0], -1, self.n_eq)
+        else:
+            layer_products = torch.einsum("si,slij->slj", y, self.layers)
+        return torch.einsum("slj,sl->sj", layer_products, self.weights)
@@ -0,0 +1,99 @@
+from typing import Any, Dict, List
+
+import torch
+
+from .layered_matrix import LayeredMatrix
+from .sparse_matrix import SparseMatrix
+
+
+def select_samples(value, idx: torch.Tensor):
+    """
+    Select the samples at the given positions of a per-sample value, which is either a tensor with
+    a leading sample dimension, a batched SparseMatrix or LayeredMatrix, or a dictionary of such
+    values.
+    """
+    if isinstance(value, dict):
+        return {key: select_samples(item, idx) for key, item in value.items()}
+    if isinstance(value, (SparseMatrix, LayeredMatrix)):
+        return value.select(idx)
+    return value[idx]
+
+
+def cat_samples(values: List[Any]):
+    """
+    Concatenate per-sample values of the same kind along the sample dimension, see select_samples.
+    """
+    if isinstance(values[0], dict):
+        return {key: cat_samples([value[key] for value in values]) for key in values[0]}
+    if isinstance(values[0], SparseMatrix):
+        return SparseMatrix.cat(values)
+    if isinstance(values[0], LayeredMatrix):
+        return LayeredMatrix.cat(values)
+    return torch.cat(values)
+
+
+class MatrixCache:
+    """
+    Cache of the per-sample matrices and parameters of a model, keyed by the indices of the
+    samples in the LHS table.
+
+    TargetCalc solves the unfinished samples again in every time window, with the same sampled
+    parameters. Instead of generating their matrices again, the matrices are stored after the
+    first window, and the matrices of the later batches are gathered from the cache. Finished
+    samples are evicted, and their storage is released once they make up half of the cache.
+
+    Attributes:
+        values (Dict[str, Any]): Cached per-sample values, as returned by
+            EpidemicModelBase.get_batch_matrices.
+        positions (torch.Tensor): Position of every sample in the cached values, -1 if not cached.
+    """
+
+    def __init__(self, n_samples: int, device):
+        self.values: Dict[str, Any] = {}
+        self.positions = torch.full((n_samples,), -1, dtype=torch.long, device=device)
+        self.n_stored = 0
+
+    def __contains__(self, indices: torch.Tensor) -> bool:
+        return bool((self.positions[indices.long()] >= 0).all())
+
+    @property
+    def n_cached(self) -> int:
+        return int((self.positions >= 0).sum())
+
+    def store(self, indices: torch.Tensor, values: Dict[str, Any]) -> None:
+        """
+        Store the per-sample values of the samples with the given indices.
+
+        Args:
+            indices (torch.Tensor): Indices of the samples in the LHS table.
+            values (Dict[str, Any]): Per-sample values, with the samples in the order of indices.
+        """
+        if not indices.numel() or not values:
+            return
+        if self.values:
+            values = {key: cat_samples([self.values[key], values[key]]) for key in self.values}
+        self.values = values
+        self.positions[indices.long()] = torch.arange(
+            self.n_stored, self.n_stored + indices.numel(), device=self.positions.device
+        )
+        self.n_stored += indices.numel()
+
+    def get(self, indices: torch.Tensor) -> Dict[str, Any]:
+        """
+        Get the per-sample values of the samples with the given indices, which have to be cached.
+        """
+        return select_samples(self.values, self.positions[indices.long()])
+
+    def evict(self, indices: torch.Tensor) -> None:
+        """
+        Remove the samples with the given indices from the cache.
+        """
+        self.positions[indices.long()] = -1
+        cached = (self.positions >= 0).nonzero().flatten()
+        if 2 * cached.numel() > self.n_stored:
+            return
+        # Release the storage of the evicted samples
+        keep = self.positions[cached]
+        self.values = select_samples(self.values, keep) if cached.numel() else {}
+        self.positions[cached] = torch.arange(cached.numel(), device=self.positions.device)
+        self.n_stored = cached.numel()
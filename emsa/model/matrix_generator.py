@@ -1,100 +1,78 @@
-from typing import List, Any, Dict, Callable
+from typing import List, Any, Dict, Callable, Optional
 
 import torch
 
 from . import get_substates, EpidemicModelBase
 
 
-def generate_transition_block(transition_param: float, n_states: int) -> torch.Tensor:
-    """
-    Generate a transition block for the transition matrix.
-
-    Args:
-        transition_param: The transition parameter value.
-        n_states: The number of states in the block.
-
-    Returns:
-        torch.Tensor: The transition block.
-
-    """
-    trans_block = torch.zeros((n_states, n_states))
-    # Outflow from states (diagonal elements)
-    trans_block = trans_block.fill_diagonal_(-transition_param * n_states)
-    # Inflow to states (elements under the diagonal)
-    trans_block[: n_states - 1, 1:] = trans_block[: n_states - 1, 1:].fill_diagonal_(
-        transition_param * n_states
-    )
-    return trans_block
-
-
-def generate_transition_matrix(
-    states_dict: Dict[str, Any],
-    parameters: Dict[str, float],
-    n_age: int,
-    n_comp: int,
-    c_idx: Dict[str, int],
-) -> torch.Tensor:
-    """
-    Generate the transition matrix for the model.
-
-    Args:
-        states_dict (Dict[str, Any]): Dictionary of states.
-        parameters (Dict[str, float]): A dictionary containing model parameters.
-        n_age (int): The number of age groups.
-        n_comp (int): The number of compartments.
-        c_idx (Dict[str, int]): A dictionary containing the indices of different compartments.
-
-    Returns:
-        torch.Tensor: The transition matrix.
-    """
-    trans_matrix = torch.zeros((n_age * n_comp, n_age * n_comp))
-    for age_group in range(n_age):
-        for state, data in states_dict.items():
-            n_states = data.get("n_substates", 1)
-            trans_param = parameters[data["rate"]]
-            diag_idx = age_group * n_comp + c_idx[f"{state}_0"]
-            block_slice = slice(diag_idx, diag_idx + n_states)
-            # Fill in transition block of each transitional state
-            trans_matrix[block_slice, block_slice] = generate_transition_block(
-                trans_param, n_states
-            )
-    return trans_matrix
-
-
-def get_susc_mul(tms_rule: dict, data) -> torch.Tensor:
+def get_susc_mul(tms_rule: dict, data, params: Optional[dict] = None) -> torch.Tensor:
     """
     Get the susceptibility multiplier.
 
     Args:
         tms_rule (Dict[str, Any]): Transmission rule.
         data (Any): Model data.
+        params (Optional[dict]): Parameters to use instead of data.params, e.g. batched parameters.
 
     Returns:
         torch.Tensor: Susceptibility multiplier.
     """
+    params = data.params if params is None else params
     susc_mul = torch.ones(data.n_age).to(data.device)
     for susc_param in tms_rule.get("susc_params", []):
-        susc_mul *= data.params[susc_param]
+        susc_mul = susc_mul * params[susc_param]
     return susc_mul
 
 
-def get_inf_mul(tms_rule: dict, data) -> torch.Tensor:
+def get_inf_mul(tms_rule: dict, data, params: Optional[dict] = None) -> torch.Tensor:
     """
     Get the infection multiplier.
 
     Args:
         tms_rule (Dict[str, Any]): Transmission rule.
         data (Any): Model data.
+        params (Optional[dict]): Parameters to use instead of data.params, e.g. batched parameters.
 
     Returns:
         torch.Tensor: Infection multiplier.
     """
+    params = data.params if params is None else params
     inf_mul = torch.ones(data.n_age).to(data.device)
     for inf_param in tms_rule.get("infection_params", []):
-        inf_mul *= data.params[inf_param]
+        inf_mul = inf_mul * params[inf_param]
     return inf_mul
 
 
+def get_batched_params(
+    params: dict, lhs_dict: Optional[dict] = None, device=None
+) -> Dict[str, torch.Tensor]:
+    """
+    Bring every numeric parameter to a common shape of (n_samples, n_age), where both
+    dimensions may be 1 and are broadcast as needed.
+
+    Values in lhs_dict carry a leading sample dimension, either (n_samples,) for scalar or
+    (n_samples, n_age) for age specific parameters, and take precedence over the values in params,
+    which are shared by all samples.
+
+    Args:
+        params (dict): Model parameters.
+        lhs_dict (Optional[dict]): Sampled parameter values with a leading sample dimension.
+        device: The device of the resulting tensors.
+
+    Returns:
+        Dict[str, torch.Tensor]: Parameters of shape (1 | n_samples, 1 | n_age).
+    """
+    batched_params = {
+        param: torch.as_tensor(value, dtype=torch.float32, device=device).reshape(1, -1)
+        for param, value in params.items()
+        if torch.is_tensor(value) or isinstance(value, (int, float))
+    }
+    for param, value in (lhs_dict or {}).items():
+        value = torch.as_tensor(value, dtype=torch.float32, device=device)
+        batched_params[param] = value.reshape(value.shape[0], -1)
+    return batched_params
+
+
 def get_param_mul(trans_params: List[str], params: dict) -> float:
     """
     Get the transition parameters multiplier.
@@ -132,6 +110,10 @@ class MatrixGenerator:
 
             vacc = (y @ V_1) / (y @ V_2).
 
+    Every matrix can be generated for a batch of samples at once by passing an lhs_dict containing
+    the sampled parameters with a leading sample dimension, in which case a stack of matrices of
+    shape (n_samples, n_eq, n_eq) is returned.
+
     Attributes:
         cm (torch.Tensor): The contact matrix.
         ps (Dict[str, float]): A dictionary containing model parameters.
@@ -173,10 +155,10 @@ class MatrixGenerator:
         self.n_comp = model.n_comp
         self.population = model.population
         self.device = model.device
-        self.idx = model.idx
+        self.idx = model.layout.indices
         self.c_idx = model.c_idx
 
-    def generate_matrix(self, matrix_name: str) -> torch.Tensor:
+    def generate_matrix(self, matrix_name: str, lhs_dict: Optional[dict] = None) -> torch.Tensor:
         matrix_methods = {
             "A": self.get_A,
             "T": self.get_T,
@@ -185,58 +167,103 @@ class MatrixGenerator:
             "V_2": self.get_V_2,
         }
         if matrix_name in matrix_methods:
-            get_matrix: Callable[[], torch.Tensor] = matrix_methods[matrix_name]
-            return get_matrix()
+            get_matrix: Callable[..., torch.Tensor] = matrix_methods[matrix_name]
+            return get_matrix(lhs_dict=lhs_dict)
         else:
             raise Exception("Not a valid matrix!")
 
-    def get_A(self) -> torch.Tensor:
+    def get_batched_params(self, lhs_dict: Optional[dict] = None) -> Dict[str, torch.Tensor]:
+        """
+        Get the model parameters overridden by the sampled values, see get_batched_params.
         """
+        return get_batched_params(params=self.ps, lhs_dict=lhs_dict, device=self.device)
+
+    def get_A(self, lhs_dict: Optional[dict] = None) -> torch.Tensor:
+        """
+        Args:
+            lhs_dict (Optional[dict]): Sampled parameters with a leading sample dimension.
+
         Returns:
             Torch.Tensor: When multiplied with y, the resulting tensor contains the rate of transmission for
             the susceptibles of age group i at the indices of compartments s^i and e_0^i
         """
-        A = torch.zeros((self.n_eq, self.n_eq)).to(self.device)
+        ps = self.get_batched_params(lhs_dict)
+        A = self._get_empty_matrix(n_samples=self._get_n_samples(lhs_dict))
         idx = self.idx
 
         for tms in self.tms_rules:
             source = f"{tms['source']}_0"
             target = f"{tms['target']}_0"
-            susc_mul = get_susc_mul(tms_rule=tms, data=self.data)
+            susc_mul = get_susc_mul(tms_rule=tms, data=self.data, params=ps)
             transmission_rate = susc_mul / self.population
-            A[idx(source), idx(source)] = -transmission_rate
-            A[idx(source), idx(target)] = transmission_rate
-        return A
+            A[:, idx(source), idx(source)] = -transmission_rate
+            A[:, idx(source), idx(target)] = transmission_rate
+        return self._format_output(A, is_batched=lhs_dict is not None)
+
+    def get_T(self, cm=None, lhs_dict: Optional[dict] = None) -> torch.Tensor:
+        """
+        Args:
+            cm (Optional[torch.Tensor]): Contact matrix, or a stack of contact matrices with a
+                leading sample dimension. Defaults to the contact matrix of the model.
+            lhs_dict (Optional[dict]): Sampled parameters with a leading sample dimension.
 
-    def get_T(self, cm=None) -> torch.Tensor:
-        T = torch.zeros((self.n_eq, self.n_eq)).to(self.device)
+        Returns:
+            Torch.Tensor: When multiplied with y, the resulting tensor contains the force of
+            infection acting on age group i at the indices of compartments s^i and e_0^i
+        """
         if cm is None:
             cm = self.cm
+        cm = torch.atleast_2d(torch.as_tensor(cm, device=self.device))
+        ps = self.get_batched_params(lhs_dict)
+        T = self._get_empty_matrix(n_samples=self._get_n_samples(lhs_dict, cm=cm))
         for tms in self.tms_rules:
             source = f"{tms['source']}_0"
             target = f"{tms['target']}_0"
-            inf_mul = get_inf_mul(tms_rule=tms, data=self.data)
+            inf_mul = get_inf_mul(tms_rule=tms, data=self.data, params=ps)
+            # Parameters are broadcast to the columns of the transposed contact matrix
             infection_spread_rate = (
-                self.ps["beta"] * torch.atleast_2d(cm).T * inf_mul.unsqueeze(0)
-            )  # Broadcast inf_mul to columns
+                ps["beta"].unsqueeze(1) * cm.transpose(-2, -1) * inf_mul.unsqueeze(1)
+            )
             for actor in tms["actors-params"].keys():
-                rel_inf = self.ps.get(tms["actors-params"][actor], 1)
+                rel_inf = ps.get(tms["actors-params"][actor], torch.ones(1, 1, device=self.device))
                 for substate in get_substates(
                     n_substates=self.state_data[actor].get("n_substates", 1),
                     comp_name=actor,
                 ):
-                    T[self._get_comp_slice(substate), self._get_comp_slice(source)] = (
-                        infection_spread_rate * rel_inf
+                    T[:, self._get_comp_slice(substate), self._get_comp_slice(source)] = (
+                        infection_spread_rate * rel_inf.unsqueeze(1)
                     )
-                    T[self._get_comp_slice(substate), self._get_comp_slice(target)] = (
-                        infection_spread_rate * rel_inf
+                    T[:, self._get_comp_slice(substate), self._get_comp_slice(target)] = (
+                        infection_spread_rate * rel_inf.unsqueeze(1)
                     )
-        return T
+        return self._format_output(T, is_batched=lhs_dict is not None or cm.dim() == 3)
+
+    def get_T_layers(self, layers, lhs_dict: Optional[dict] = None) -> torch.Tensor:
+        """
+        Generate one component of T for every contact layer, such that the T of a weighted sum of
+        the layers is the same weighted sum of the components, see LayeredMatrix.
 
-    def get_B(self) -> torch.Tensor:
-        ps = self.ps
+        Args:
+            layers: Contact layers of shape (n_layers, n_age, n_age), or a dictionary of them.
+            lhs_dict (Optional[dict]): Sampled parameters with a leading sample dimension.
+
+        Returns:
+            torch.Tensor: Components of shape (n_layers, n_eq, n_eq), or
+            (n_samples, n_layers, n_eq, n_eq) if lhs_dict is given.
+        """
+        if isinstance(layers, dict):
+            layers = torch.stack(list(layers.values()))
+        layers = torch.as_tensor(layers, device=self.device)
+        if lhs_dict is None:
+            # The layers form the leading dimension of the contact matrix stack
+            return self.get_T(cm=layers).reshape(-1, self.n_eq, self.n_eq)
+        return torch.stack([self.get_T(cm=layer, lhs_dict=lhs_dict) for layer in layers], dim=1)
+
+    def get_B(self, lhs_dict: Optional[dict] = None) -> torch.Tensor:
+        ps = self.get_batched_params(lhs_dict)
         state_data = self.state_data
         trans_data = self.trans_data
+        B = self._get_empty_matrix(n_samples=self._get_n_samples(lhs_dict))
 
         # We begin by filling in the transition blocks of the intermediate states
         intermediate_states = {
@@ -249,13 +276,7 @@ class MatrixGenerator:
                 "dead",
             ]
         }
-        B = generate_transition_matrix(
-            states_dict=intermediate_states,
-            parameters=ps,
-            n_age=self.n_age,
-            n_comp=self.n_comp,
-            c_idx=self.c_idx,
-        ).to(self.device)
+        self._fill_transition_blocks(B=B, states_dict=intermediate_states, ps=ps)
 
         # Fill in the rest of the first-order terms
         idx = self.idx
@@ -267,24 +288,25 @@ class MatrixGenerator:
             source = trans["source"]
             trans_param = ps[state_data[source]["rate"]]
             # Multiply the transition parameter by the parameter(s) given
-            trans_param = trans_param * get_param_mul(
-                trans.get("params"), self.ps
-            )  # Throws shape error with *= in some cases
+            trans_param = trans_param * get_param_mul(trans.get("params"), ps)
             target = f"{trans['target']}_0"
             n_substates = state_data[trans["source"]].get("n_substates", 1)
-            B[idx(end_state[source]), idx(target)] = trans_param * n_substates
-        return B
+            B[:, idx(end_state[source]), idx(target)] = trans_param * n_substates
+        return self._format_output(B, is_batched=lhs_dict is not None)
 
-    def get_V_1(self, daily_vac=None) -> torch.Tensor:
+    def get_V_1(self, daily_vac=None, lhs_dict: Optional[dict] = None) -> torch.Tensor:
         if daily_vac is None:
-            daily_vac = self.ps["daily_vac"]
-        V_1 = torch.zeros((self.n_eq, self.n_eq)).to(self.device)
+            daily_vac = self.get_batched_params(lhs_dict)["daily_vac"]
+        V_1 = self._get_empty_matrix(n_samples=self._get_n_samples(lhs_dict))
         # Tensor responsible for the nominators of the vaccination formula
-        V_1[self.idx("s_0"), self.idx("s_0")] = daily_vac
-        V_1[self.idx("s_0"), self.idx("v_0")] = daily_vac
-        return V_1
+        V_1[:, self.idx("s_0"), self.idx("s_0")] = daily_vac
+        V_1[:, self.idx("s_0"), self.idx("v_0")] = daily_vac
+        return self._format_output(V_1, is_batched=lhs_dict is not None)
 
-    def get_V_2(self) -> torch.Tensor:
+    def get_V_2(self, lhs_dict: Optional[dict] = None) -> torch.Tensor:
+        """
+        V_2 doesn't depend on any parameter, hence it is shared by all samples and lhs_dict is ignored.
+        """
         idx = self.idx
         V_2 = torch.zeros((self.n_eq, self.n_eq)).to(self.device)
         # Fill in all the terms such that we will divide the terms at the indices of s^i and v^i by (s^i + r^i)
@@ -294,6 +316,46 @@ class MatrixGenerator:
         V_2[idx("r_0"), idx("v_0")] = 1
         return V_2
 
+    def _fill_transition_blocks(self, B: torch.Tensor, states_dict: Dict[str, Any], ps: dict):
+        """
+        Fill in the transition blocks of the given states for every age group and sample at once.
+        The substates of a state form a chain, each of them left at the rate of the state times
+        the number of substates, into the next substate.
+
+        Args:
+            B (torch.Tensor): Matrix stack of shape (n_samples, n_eq, n_eq) to fill in.
+            states_dict (Dict[str, Any]): Dictionary of states.
+            ps (dict): Batched model parameters.
+        """
+        idx = self.idx
+        for state, data in states_dict.items():
+            n_states = data.get("n_substates", 1)
+            trans_param = ps[data["rate"]] * n_states
+            substates = get_substates(n_substates=n_states, comp_name=state)
+            # Outflow from states
+            for substate in substates:
+                B[:, idx(substate), idx(substate)] = -trans_param
+            # Inflow to the next substate
+            for substate, next_substate in zip(substates[:-1], substates[1:]):
+                B[:, idx(substate), idx(next_substate)] = trans_param
+
+    def _get_n_samples(self, lhs_dict: Optional[dict], cm: Optional[torch.Tensor] = None) -> int:
+        """
+        Get the number of samples, based on the leading dimension of the sampled values.
+        """
+        if lhs_dict:
+            return next(iter(lhs_dict.values())).shape[0]
+        if cm is not None and cm.dim() == 3:
+            return cm.shape[0]
+        return 1
+
+    def _get_empty_matrix(self, n_samples: int) -> torch.Tensor:
+        return torch.zeros((n_samples, self.n_eq, self.n_eq)).to(self.device)
+
+    @staticmethod
+    def _format_output(matrix: torch.Tensor, is_batched: bool) -> torch.Tensor:
+        return matrix if is_batched else matrix[0]
+
     def _get_comp_slice(self, comp: str) -> slice:
         """
         Get a slice representing the indices of a given compartment.
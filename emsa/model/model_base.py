@@ -5,9 +5,27 @@ from typing import Any, Dict, Callable
 import torch
 import torchode as to
 
+from .factored_ode import FactoredODE
+from .layered_matrix import LayeredMatrix
+from .matrix_cache import select_samples
+from .sparse_matrix import SparseMatrix
+from .ode_solver import get_solver, get_solver_config, solve_fixed_step, solve_segmented
+from .schedule import SegmentedODE
+from .state_layout import StateLayout
+
 
 class EpidemicModelBase(ABC):
-    def __init__(self, data, model_struct: Dict[str, Any]):
+    ode_engines = ["dense", "factored", "compiled"]
+    # Attributes which may hold matrix stacks with one matrix per sample of the batch
+    per_sample_attrs = ["A", "T", "B"]
+
+    def __init__(
+        self,
+        data,
+        model_struct: Dict[str, Any],
+        ode_engine: str = "dense",
+        solver_config: Dict[str, Any] = None,
+    ):
         """
         Initialises Abstract base class for epidemic models.
 
@@ -17,10 +35,26 @@ class EpidemicModelBase(ABC):
         Args:
             data (Any): Data for the epidemic model.
             model_struct (Dict[str, Any]): Structure of the epidemic model.
+            ode_engine (str): Method of evaluating the right-hand side of the ODE, either "dense" for
+                the matrix products, "factored" for FactoredODE, or "compiled" for the right-hand
+                side generated from the model structure by compile_model_struct.
+            solver_config (Dict[str, Any]): Integration method and its settings, see get_solver_config.
 
         Returns:
             None
         """
+        if ode_engine not in self.ode_engines:
+            raise ValueError(f"Unknown ODE engine {ode_engine}, choose from {self.ode_engines}")
+        self.ode_engine = ode_engine
+        self.solver_config = get_solver_config(solver_config)
+        # Per-sample statistics of the last solve, e.g. the number of steps
+        self.solver_stats = None
+        # Object accumulating reductions of the solution while solving, see TargetReducer
+        self.reducer = None
+        # Per-sample matrices of the batch being solved, and whether they were loaded from a cache
+        self.batch_matrices = None
+        self.matrices_loaded = False
+        self._engine_ode = None
         self.data = data
         self.model_struct = model_struct
         self.state_data = model_struct["state_data"]
@@ -37,6 +71,12 @@ class EpidemicModelBase(ABC):
 
         self.c_idx = {comp: idx for idx, comp in enumerate(self.compartments)}
         self.n_eq = self.n_age * self.n_comp
+        self.layout = StateLayout(
+            state_data=self.state_data,
+            compartments=self.compartments,
+            n_age=self.n_age,
+            device=self.device,
+        )
 
         from emsa.model.matrix_generator import MatrixGenerator
 
@@ -45,6 +85,12 @@ class EpidemicModelBase(ABC):
         self.A = None
         self.T = None
         self.B = None
+        # Contact layers summing to the contact matrix, and the components of T generated from them
+        self.contact_layers = getattr(data, "contact_layers", None)
+        self._T_layers = None
+        # Sampled parameters and contact matrices of the current batch, used by the compiled engine
+        self.batch_params = None
+        self.batch_cm = None
 
     def validate_params(self):
         for param, value in self.ps.items():
@@ -63,8 +109,168 @@ class EpidemicModelBase(ABC):
         mtx_gen = self.matrix_generator
         self.A = mtx_gen.get_A()
         self.T = mtx_gen.get_T()
+        if self.has_layer_weights():
+            # The contact layers are scaled by the model parameters contact_<layer>
+            self.T = self.get_layered_T(layer_weights=self.get_layer_weights()).to_dense()[0]
         self.B = mtx_gen.get_B()
 
+    @property
+    def layer_params(self) -> Dict[str, str]:
+        """
+        Names of the parameters scaling the contact layers, contact_<layer>, mapped to the layers.
+        """
+        return {f"contact_{layer}": layer for layer in self.contact_layers or {}}
+
+    def has_layer_weights(self, lhs_dict: dict = None) -> bool:
+        """
+        Whether any contact layer is scaled by a parameter contact_<layer>, either sampled, i.e. in
+        lhs_dict, or set in the model parameters.
+        """
+        lhs_dict = lhs_dict or {}
+        return any(param in lhs_dict or param in self.ps for param in self.layer_params)
+
+    def get_layer_weights(self, lhs_dict: dict = None) -> torch.Tensor:
+        """
+        Get the weights of the contact layers, given by the parameters contact_<layer> of the
+        sampled or the model parameters, and 1 for the layers without such a parameter.
+
+        Args:
+            lhs_dict (dict): Sampled parameters with a leading sample dimension.
+
+        Returns:
+            torch.Tensor: Weights of shape (n_samples, n_layers), or (1, n_layers).
+        """
+        lhs_dict = lhs_dict or {}
+        weights = [
+            torch.as_tensor(
+                lhs_dict.get(param, self.ps.get(param, 1.0)),
+                dtype=torch.float32,
+                device=self.device,
+            ).reshape(-1)
+            for param in self.layer_params
+        ]
+        return torch.stack(torch.broadcast_tensors(*weights), dim=1)
+
+    def get_layered_T(self, layer_weights: torch.Tensor, lhs_dict: dict = None) -> LayeredMatrix:
+        """
+        Get T as a weighted sum of its components corresponding to the contact layers. Without
+        sampled parameters affecting T, the components are generated once and reused.
+
+        Args:
+            layer_weights (torch.Tensor): Weights of the layers of shape (n_samples, n_layers).
+            lhs_dict (dict): Sampled parameters of T with a leading sample dimension.
+
+        Returns:
+            LayeredMatrix: The stack of T matrices.
+        """
+        if self.contact_layers is None:
+            raise ValueError("The data of the model has no contact layers!")
+        if lhs_dict:
+            layers = self.matrix_generator.get_T_layers(self.contact_layers, lhs_dict=lhs_dict)
+        else:
+            if self._T_layers is None:
+                self._T_layers = self.matrix_generator.get_T_layers(self.contact_layers)
+            layers = self._T_layers
+        return LayeredMatrix(layers=layers, weights=layer_weights)
+
+    def get_layered_cm(self, layer_weights: torch.Tensor) -> torch.Tensor:
+        """
+        Get the contact matrices weighted by the given layer weights, of shape
+        (n_samples, n_age, n_age).
+        """
+        layers = torch.stack(list(self.contact_layers.values())).to(self.device)
+        return torch.einsum("sl,lij->sij", layer_weights, layers)
+
+    def get_factored_ode(self):
+        """
+        Get the right-hand side of the ODE given by the current matrices of the model,
+        evaluated with FactoredODE.
+        """
+        return FactoredODE(model=self)
+
+    def get_compiled_ode(self, lhs_dict: dict = None, cm: torch.Tensor = None):
+        """
+        Get the right-hand side of the ODE generated from the model structure, with the parameters
+        bound once for the whole batch.
+
+        Args:
+            lhs_dict (dict): Sampled parameters with a leading sample dimension, defaults to the
+                parameters of the current batch.
+            cm (torch.Tensor): Contact matrix, or a stack of contact matrices with a leading sample
+                dimension, defaults to the contact matrices of the current batch.
+
+        Returns:
+            Callable: The compiled right-hand side.
+        """
+        lhs_dict = self.batch_params if lhs_dict is None else lhs_dict
+        cm = self.batch_cm if cm is None else cm
+        cm = self.matrix_generator.cm if cm is None else cm
+        params = self.matrix_generator.get_batched_params(lhs_dict or None)
+        params["_population"] = self.population.reshape(1, -1).float().to(self.device)
+        params["_cm"] = torch.atleast_2d(torch.as_tensor(cm, device=self.device)).float()
+        from emsa.model.ode_compiler import compile_model_struct
+
+        make_odefun = compile_model_struct(self.model_struct)
+        return make_odefun(params)
+
+    def get_engine_ode(self):
+        """
+        Get the right-hand side of the basic ODE evaluated by the factored or compiled engine.
+        The engine is built from the current matrices at the first evaluation, and rebuilt after
+        select_samples.
+        """
+        self._engine_ode = None
+
+        def odefun(t, y):
+            if self._engine_ode is None:
+                if self.ode_engine == "factored":
+                    self._engine_ode = self.get_factored_ode()
+                else:
+                    self._engine_ode = self.get_compiled_ode()
+            return self._engine_ode(t, y)
+
+        return odefun
+
+    def get_batch_matrices(self) -> Dict[str, Any]:
+        """
+        Get the per-sample matrices and parameters of the current batch, i.e. the matrix stacks
+        among per_sample_attrs, the sampled parameters and the stack of contact matrices.
+        """
+        matrices = {}
+        for attr in self.per_sample_attrs:
+            matrix = getattr(self, attr, None)
+            if isinstance(matrix, (SparseMatrix, LayeredMatrix)) and matrix.is_batched:
+                matrices[attr] = matrix
+            elif torch.is_tensor(matrix) and matrix.dim() == 3:
+                matrices[attr] = matrix
+        if self.batch_params is not None:
+            matrices["batch_params"] = self.batch_params
+        if self.batch_cm is not None and self.batch_cm.dim() == 3:
+            matrices["batch_cm"] = self.batch_cm
+        return matrices
+
+    def load_batch_matrices(self, matrices: Dict[str, Any]) -> None:
+        """
+        Set the per-sample matrices and parameters of the batch, as returned by get_batch_matrices.
+        Models generating matrices in get_solution can skip them when matrices_loaded is set.
+        """
+        for attr, value in matrices.items():
+            setattr(self, attr, value)
+        self.matrices_loaded = True
+        self._engine_ode = None
+
+    def select_samples(self, keep: torch.Tensor) -> None:
+        """
+        Restrict the per-sample matrices and parameters of the current batch to the samples at the
+        given positions. Used by the solver to drop the finished samples from the integration.
+
+        Args:
+            keep (torch.Tensor): Positions of the kept samples in the current batch.
+        """
+        for attr, value in self.get_batch_matrices().items():
+            setattr(self, attr, select_samples(value, keep))
+        self._engine_ode = None
+
     def visualize_transmission_graph(self):
         from emsa.utils.plotter import visualize_transmission_graph
 
@@ -93,23 +299,58 @@ class EpidemicModelBase(ABC):
         self, y0: torch.Tensor, t_eval: torch.Tensor, odefun: Callable
     ) -> to.Solution:
         """
-        Solve the ODE system using the Euler method with a step size of 1.
+        Solve the ODE system using the method given by the solver config, by default the Euler
+        method with a step size of 1. The per-sample statistics of the solver are saved
+        in solver_stats. With the inference backend, the fixed step methods are solved by
+        solve_fixed_step instead of torchode.
+
+        If a reducer is set, it is updated with the states at every evaluation time. The inference
+        backend then doesn't store the trajectories, and the returned solution has no ys.
+
+        If odefun is a SegmentedODE, the integration is split at the breakpoints of its schedules,
+        and every segment is solved with its own right-hand side.
 
         Args:
             y0 (torch.Tensor): Initial values.
             t_eval (torch.Tensor): Evaluation times.
-            odefun (Any): ODE function.
+            odefun (Any): ODE function, or a SegmentedODE.
 
         Returns:
             Any: Solution of the ODE system.
         """
+        # The solver may restrict the matrices to the unfinished samples, see select_samples
+        self.batch_matrices = self.get_batch_matrices()
+        if self.solver_config["backend"] == "inference":
+            sol = solve_fixed_step(
+                odefun=odefun,
+                y0=y0,
+                t_eval=t_eval,
+                solver_config=self.solver_config,
+                reducer=self.reducer,
+                on_compact=self.select_samples,
+            )
+            self.solver_stats = sol.stats
+            return sol
+        if isinstance(odefun, SegmentedODE):
+            sol = solve_segmented(solve=self._solve_torchode, odefun=odefun, y0=y0, t_eval=t_eval)
+        else:
+            sol = self._solve_torchode(odefun=odefun, y0=y0, t_eval=t_eval)
+        self.solver_stats = sol.stats
+        if self.reducer is not None:
+            self.reducer.reduce(sol.ys)
+        return sol
+
+    def _solve_torchode(
+        self, odefun: Callable, y0: torch.Tensor, t_eval: torch.Tensor
+    ) -> to.Solution:
         term = to.ODETerm(odefun)
-        step_method = to.Euler(term=term)
-        step_size_controller = to.FixedStepController()
-        solver = to.AutoDiffAdjoint(step_method, step_size_controller)
-        problem = to.InitialValueProblem(y0=torch.atleast_2d(y0), t_eval=torch.atleast_2d(t_eval))
-        dt0 = torch.full((y0.shape[0],), 1).to(self.device)
-
+        solver = get_solver(term=term, solver_config=self.solver_config)
+        # Times are floating point, so that the step size isn't truncated for non-integer steps
+        problem = to.InitialValueProblem(
+            y0=torch.atleast_2d(y0), t_eval=torch.atleast_2d(t_eval).to(torch.float32)
+        )
+        dt = self.solver_config["dt"]
+        dt0 = None if dt is None else torch.full((problem.batch_size,), float(dt)).to(self.device)
         return solver.solve(problem, dt0=dt0)
 
     def get_compartments(self) -> list:
@@ -155,26 +396,34 @@ class EpidemicModelBase(ABC):
         Returns:
             torch.BoolTensor: Index tensor.
         """
-        return torch.arange(self.n_eq) % self.n_comp == self.c_idx[state]
+        return self.layout.mask(state)
 
     def aggregate_by_age(self, solution, comp):
         """
-        Aggregate the solution by age for a compartment.
+        Aggregate the solution by age for a compartment, summing all of its substates.
 
         Args:
-            solution (torch.Tensor): Solution tensor.
+            solution (torch.Tensor): Solution tensor of shape (..., n_eq).
             comp (str): Compartment name.
 
         Returns:
-            torch.Tensor: Aggregated solution.
+            torch.Tensor: Aggregated solution of shape (...).
         """
-        substates = get_substates(
-            n_substates=self.state_data[comp].get("n_substates", 1), comp_name=comp
-        )
-        return torch.stack(
-            tensors=[solution[:, self.idx(state)].sum(dim=1) for state in substates],
-            dim=0,
-        ).sum(dim=0)
+        return self.layout.sum_state(solution, state=comp)
+
+    def aggregate(self, solution, groups, by_age=False):
+        """
+        Aggregate the solution for several compartments, states or state types at once.
+
+        Args:
+            solution (torch.Tensor): Solution tensor of shape (..., n_eq).
+            groups (List[str]): Compartments, states or state types, see StateLayout.aggregate.
+            by_age (bool): Whether to keep the age groups separate.
+
+        Returns:
+            torch.Tensor: Aggregated solution of shape (..., n_groups), or (..., n_age, n_groups).
+        """
+        return self.layout.aggregate(solution, groups=groups, by_age=by_age)
 
 
 def get_substates(n_substates, comp_name):
@@ -0,0 +1,257 @@
+import hashlib
+import importlib.util
+import json
+import os
+from typing import Any, Callable, Dict, List, Tuple
+
+from .model_base import get_substates
+
+COMPILER_VERSION = 1
+
+_compiled_modules = {}
+
+
+def get_cache_dir() -> str:
+    """
+    Get the directory of the compiled ODE functions, which can be set with the EMSA_CACHE_DIR
+    environment variable.
+    """
+    return os.environ.get("EMSA_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "emsa"
+    )
+
+
+def get_struct_hash(model_struct: Dict[str, Any]) -> str:
+    """
+    Get the hash identifying the compiled ODE function of a model structure.
+    """
+    key = json.dumps({"version": COMPILER_VERSION, "model_struct": model_struct}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def compile_model_struct(model_struct: Dict[str, Any]) -> Callable:
+    """
+    Compile the model structure into a specialized right-hand side, see ODECompiler. The generated
+    source is cached on disk by the hash of the structure, and loaded only once per process.
+
+    Args:
+        model_struct (Dict[str, Any]): Structure of the epidemic model.
+
+    Returns:
+        Callable: make_odefun(p), binding the parameters in the dict p and returning odefun(t, y).
+    """
+    struct_hash = get_struct_hash(model_struct)
+    if struct_hash not in _compiled_modules:
+        cache_dir = get_cache_dir()
+        path = os.path.join(cache_dir, f"ode_{struct_hash}.py")
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(ODECompiler(model_struct).generate_source(struct_hash))
+            os.replace(tmp_path, path)
+        spec = importlib.util.spec_from_file_location(f"emsa_ode_{struct_hash}", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _compiled_modules[struct_hash] = module
+    return _compiled_modules[struct_hash].make_odefun
+
+
+class ODECompiler:
+    """
+    Compiler generating the source of a right-hand side specialized to a model structure.
+
+    The entries of the matrices A, T and B are collected the same way MatrixGenerator fills them in,
+    but instead of matrices, the generated function only contains the needed multiplications of
+    the compartment columns of y, viewed as (n_samples, n_age, n_comp), and one contact product
+    per actor of every transmission rule. Coefficients depending only on the parameters are
+    evaluated once, when the parameters are bound by make_odefun.
+
+    The generated function expects the parameters in the layout of get_batched_params, along with
+    the population under "_population" and the contact matrix (or a stack of contact matrices)
+    under "_cm".
+
+    Attributes:
+        state_data (Dict[str, Any]): Data related to states.
+        trans_data (List[Dict[str, Any]]): Data related to transitions.
+        tms_rules (List[Dict[str, Any]]): Transmission rules.
+        compartments (List[str]): List of compartments.
+        c_idx (Dict[str, int]): Indices of the compartments.
+    """
+
+    def __init__(self, model_struct: Dict[str, Any]):
+        self.state_data = model_struct["state_data"]
+        self.trans_data = model_struct["trans_data"]
+        self.tms_rules = model_struct["tms_rules"]
+        self.compartments = [
+            substate
+            for state, data in self.state_data.items()
+            for substate in get_substates(data.get("n_substates", 1), state)
+        ]
+        self.c_idx = {comp: idx for idx, comp in enumerate(self.compartments)}
+
+        self.coeffs: Dict[str, str] = {}
+
+    def generate_source(self, struct_hash: str) -> str:
+        """
+        Generate the source of the module containing make_odefun.
+        """
+        A_entries = self._get_A_entries()
+        T_entries = self._get_T_entries()
+        B_entries = self._get_B_entries()
+
+        forces: Dict[Tuple, str] = {}
+        force_lines = []
+        derivatives = []
+        for col, comp in enumerate(self.compartments):
+            terms = [
+                f"{coeff} * y_{self.c_idx[row]}"
+                for (row, col_comp), coeff in B_entries
+                if col_comp == comp
+            ]
+            susc_terms = [
+                f"{coeff} * y_{self.c_idx[row]}"
+                for (row, col_comp), coeff in A_entries
+                if col_comp == comp
+            ]
+            # Substates of the same actor share their kernel, so they are summed before the contact product
+            kernels: Dict[str, List[str]] = {}
+            for (row, col_comp), kernel in T_entries:
+                if col_comp == comp:
+                    kernels.setdefault(kernel, []).append(row)
+            force_terms = []
+            for kernel, rows in kernels.items():
+                force_key = (kernel, tuple(rows))
+                if force_key not in forces:
+                    forces[force_key] = f"f_{len(forces)}"
+                    actors = " + ".join(f"y_{self.c_idx[row]}" for row in rows)
+                    force_lines.append(
+                        f"        {forces[force_key]} = {kernel} * contact({actors})"
+                    )
+                force_terms.append(forces[force_key])
+            if susc_terms and force_terms:
+                terms.append(f"({' + '.join(susc_terms)}) * ({' + '.join(force_terms)})")
+            derivatives.append(" + ".join(terms) if terms else "torch.zeros_like(y_0)")
+
+        lines = [
+            f"# Generated by emsa.model.ode_compiler from the model structure {struct_hash}, do not edit.",
+            "import torch",
+            "",
+            f"N_COMP = {len(self.compartments)}",
+            "",
+            "",
+            "def make_odefun(p):",
+            '    cm = p["_cm"]',
+            *[f"    {name} = {expr}" for expr, name in self.coeffs.items()],
+            "",
+            "    def contact(x):",
+            "        return (cm @ x.unsqueeze(-1)).squeeze(-1)",
+            "",
+            "    def odefun(t, y):",
+            "        y = y.reshape(y.shape[0], -1, N_COMP)",
+            *[
+                f"        y_{idx} = y[..., {idx}]  # {comp}"
+                for idx, comp in enumerate(self.compartments)
+            ],
+            *force_lines,
+            "        dy = torch.stack(",
+            "            [",
+            *[
+                f"                {derivative},  # {comp}"
+                for derivative, comp in zip(derivatives, self.compartments)
+            ],
+            "            ],",
+            "            dim=-1,",
+            "        )",
+            "        return dy.reshape(y.shape[0], -1)",
+            "",
+            "    return odefun",
+            "",
+        ]
+        return "\n".join(lines)
+
+    def _coeff(self, expr: str) -> str:
+        """
+        Register a coefficient evaluated when binding the parameters, and get its name.
+        """
+        if expr not in self.coeffs:
+            self.coeffs[expr] = f"c_{len(self.coeffs)}"
+        return self.coeffs[expr]
+
+    @staticmethod
+    def _param(param: str) -> str:
+        return f"p[{param!r}]"
+
+    def _param_mul(self, params: List[str]) -> List[str]:
+        return [
+            f"(1 - {self._param(param[:-1])})" if param[-1] == "_" else self._param(param)
+            for param in params
+        ]
+
+    @staticmethod
+    def _product(*factors) -> str:
+        """
+        Get the expression of the product of the factors, omitting the factors equal to 1.
+        """
+        factors = [str(factor) for factor in factors if str(factor) != "1"]
+        return " * ".join(factors) if factors else "1"
+
+    def _get_A_entries(self) -> List[Tuple[Tuple[str, str], str]]:
+        """
+        Get the nonzero entries of A, see MatrixGenerator.get_A.
+        """
+        entries = {}
+        for tms in self.tms_rules:
+            source = f"{tms['source']}_0"
+            target = f"{tms['target']}_0"
+            susc_mul = self._product(*self._param_mul(tms.get("susc_params", [])))
+            entries[(source, source)] = self._coeff(f"-{susc_mul} / p['_population']")
+            entries[(source, target)] = self._coeff(f"{susc_mul} / p['_population']")
+        return list(entries.items())
+
+    def _get_T_entries(self) -> List[Tuple[Tuple[str, str], str]]:
+        """
+        Get the nonzero entries of T, see MatrixGenerator.get_T. The entries are given by the
+        coefficient multiplying the contact product, the kernel.
+        """
+        entries = {}
+        for tms in self.tms_rules:
+            source = f"{tms['source']}_0"
+            target = f"{tms['target']}_0"
+            inf_mul = self._param_mul(tms.get("infection_params", []))
+            for actor, rel_inf_param in tms["actors-params"].items():
+                rel_inf = f"p.get({rel_inf_param!r}, 1)" if rel_inf_param else 1
+                kernel = self._coeff(self._product(self._param("beta"), *inf_mul, rel_inf))
+                for substate in get_substates(
+                    n_substates=self.state_data[actor].get("n_substates", 1), comp_name=actor
+                ):
+                    entries[(substate, source)] = kernel
+                    entries[(substate, target)] = kernel
+        return list(entries.items())
+
+    def _get_B_entries(self) -> List[Tuple[Tuple[str, str], str]]:
+        """
+        Get the nonzero entries of B, see MatrixGenerator.get_B.
+        """
+        entries = {}
+        for state, data in self.state_data.items():
+            if data.get("type", "") in ["susceptible", "recovered", "dead"]:
+                continue
+            n_states = data.get("n_substates", 1)
+            rate = self._coeff(self._product(self._param(data["rate"]), n_states))
+            neg_rate = self._coeff(f"-{rate}")
+            substates = get_substates(n_substates=n_states, comp_name=state)
+            for substate in substates:
+                entries[(substate, substate)] = neg_rate
+            for substate, next_substate in zip(substates[:-1], substates[1:]):
+                entries[(substate, next_substate)] = rate
+
+        for trans in [trans for trans in self.trans_data if trans.get("type", "basic") == "basic"]:
+            source = trans["source"]
+            n_substates = self.state_data[source].get("n_substates", 1)
+            end_state = f"{source}_{n_substates - 1}"
+            target = f"{trans['target']}_0"
+            rate = self._param(self.state_data[source]["rate"])
+            param_mul = self._param_mul(trans.get("params") or [])
+            entries[(end_state, target)] = self._coeff(self._product(rate, *param_mul, n_substates))
+        return list(entries.items())
@@ -0,0 +1,345 @@
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+import torch
+import torchode as to
+from torchode.interpolation import LinearInterpolation
+from torchode.single_step_methods.runge_kutta import (
+    ButcherTableau,
+    ERKInterpolationData,
+    ExplicitRungeKutta,
+)
+
+from .schedule import SegmentedODE
+
+
+class RK4(ExplicitRungeKutta):
+    """
+    The classical fourth order Runge-Kutta method, meant to be used with a fixed step size.
+    """
+
+    TABLEAU = ButcherTableau.from_lists(
+        c=[0.0, 1 / 2, 1 / 2, 1.0],
+        a=[[], [1 / 2], [0.0, 1 / 2], [0.0, 0.0, 1.0]],
+        b=[1 / 6, 1 / 3, 1 / 3, 1 / 6],
+        b_low_order=[1.0, 0.0, 0.0, 0.0],
+    )
+
+    def __init__(self, term: Optional[to.ODETerm] = None):
+        super().__init__(term, RK4.TABLEAU)
+
+    @torch.jit.export
+    def convergence_order(self):
+        return 4
+
+    @torch.jit.export
+    def build_interpolation(self, data: ERKInterpolationData):
+        return LinearInterpolation(data.t0, data.dt, data.y0, data.y1)
+
+
+step_methods = {"euler": to.Euler, "rk4": RK4, "dopri5": to.Dopri5, "tsit5": to.Tsit5}
+adaptive_methods = ["dopri5", "tsit5"]
+
+default_solver_config = {
+    "method": "euler",
+    "dt": 1,
+    "atol": 1e-6,
+    "rtol": 1e-3,
+    "pcoeff": 0.2,
+    "icoeff": 0.5,
+    "dcoeff": 0.0,
+    "dt_max": None,
+    "backend": "torchode",
+    "compact_ratio": 0.25,
+}
+backends = ["torchode", "inference"]
+
+
+def get_solver_config(solver_config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Complete the solver configuration with the default values, see default_solver_config.
+
+    With the fixed step methods (euler, rk4), dt is the step size. With the adaptive methods
+    (dopri5, tsit5), the step size of every sample is chosen by a PID controller with the given
+    tolerances and coefficients, dt is the initial step size and dt_max an optional upper bound.
+    The fixed step methods can also be solved by the inference backend, see solve_fixed_step,
+    which drops the finished samples from the integration once their share reaches compact_ratio.
+
+    Args:
+        solver_config (Optional[Dict[str, Any]]): Solver configuration.
+
+    Returns:
+        Dict[str, Any]: The completed configuration.
+
+    Raises:
+        ValueError: If the method or the backend is unknown, or the inference backend is used with an
+            adaptive method.
+    """
+    solver_config = {**default_solver_config, **(solver_config or {})}
+    solver_config["method"] = solver_config["method"].lower()
+    if solver_config["method"] not in step_methods:
+        raise ValueError(
+            f"Unknown solver method {solver_config['method']}, choose from {list(step_methods)}"
+        )
+    if solver_config["backend"] not in backends:
+        raise ValueError(
+            f"Unknown solver backend {solver_config['backend']}, choose from {backends}"
+        )
+    if solver_config["backend"] == "inference" and solver_config["method"] not in fixed_steps:
+        raise ValueError(f"The inference backend only supports the methods {list(fixed_steps)}")
+    return solver_config
+
+
+def get_solver(term: to.ODETerm, solver_config: Dict[str, Any]) -> to.AutoDiffAdjoint:
+    """
+    Create the torchode solver corresponding to the solver configuration.
+    """
+    method = solver_config["method"]
+    step_method = step_methods[method](term=term)
+    if method in adaptive_methods:
+        step_size_controller = to.PIDController(
+            atol=solver_config["atol"],
+            rtol=solver_config["rtol"],
+            pcoeff=solver_config["pcoeff"],
+            icoeff=solver_config["icoeff"],
+            dcoeff=solver_config["dcoeff"],
+            term=term,
+            dt_max=solver_config["dt_max"],
+        )
+    else:
+        step_size_controller = to.FixedStepController()
+    return to.AutoDiffAdjoint(step_method, step_size_controller)
+
+
+class FixedStepSolution(NamedTuple):
+    """
+    Solution of the fixed step inference solver, with the fields of the torchode solution used
+    in this package.
+    """
+
+    ts: torch.Tensor
+    ys: torch.Tensor
+    stats: Dict[str, torch.Tensor]
+
+
+def euler_step(
+    odefun: Callable, t: torch.Tensor, y: torch.Tensor, dt: float, out: torch.Tensor
+) -> torch.Tensor:
+    return torch.add(y, odefun(t, y), alpha=dt, out=out)
+
+
+def rk4_step(
+    odefun: Callable, t: torch.Tensor, y: torch.Tensor, dt: float, out: torch.Tensor
+) -> torch.Tensor:
+    k1 = odefun(t, y)
+    k2 = odefun(t + dt / 2, y + dt / 2 * k1)
+    k3 = odefun(t + dt / 2, y + dt / 2 * k2)
+    k4 = odefun(t + dt, y + dt * k3)
+    return torch.add(y, k1 + 2 * k2 + 2 * k3 + k4, alpha=dt / 6, out=out)
+
+
+fixed_steps = {"euler": (euler_step, 1), "rk4": (rk4_step, 4)}
+
+
+def solve_fixed_step(
+    odefun: Callable,
+    y0: torch.Tensor,
+    t_eval: torch.Tensor,
+    solver_config: Dict[str, Any],
+    reducer=None,
+    on_compact: Optional[Callable[[torch.Tensor], None]] = None,
+) -> FixedStepSolution:
+    """
+    Solve the ODE with a fixed step method, without the autograd and bookkeeping of torchode.
+
+    The state is advanced under inference mode, alternating between two preallocated state
+    buffers, and the values at the evaluation times are written into a preallocated output buffer,
+    interpolating linearly between steps as torchode does.
+    The evaluation times of every sample have to be the same relative to the first one, as is
+    the case for the time windows of TargetCalc.
+
+    If a reducer is given, it is updated with the states at every evaluation time, and finalized
+    with the last state, instead of allocating the output buffer. If the reducer also has a
+    stopping condition, it is evaluated at every evaluation time, and the finished samples are
+    finalized with their current states and frozen. Once the share of frozen samples reaches
+    compact_ratio of the solver config, they are dropped from the integration, and on_compact is
+    called with the positions of the kept samples, so that the ODE function can be restricted to
+    them as well. Without on_compact, the frozen samples are integrated until the end.
+
+    If odefun is a SegmentedODE, the steps are shortened to end at the breakpoints of its
+    schedules, and the right-hand side is swapped for the one of the next segment there.
+
+    Args:
+        odefun (Callable): ODE function, or a SegmentedODE.
+        y0 (torch.Tensor): Initial values of shape (n_samples, n_eq).
+        t_eval (torch.Tensor): Evaluation times of shape (n_samples, n_t).
+        solver_config (Dict[str, Any]): Solver configuration, see get_solver_config.
+        reducer: Object with the methods update(y, idx), finalize(y, idx), get_finished(y, idx)
+            and the attribute stopping_condition, e.g. a TargetReducer.
+        on_compact (Optional[Callable[[torch.Tensor], None]]): Callback restricting the ODE
+            function to the samples at the given positions of the current batch.
+
+    Returns:
+        FixedStepSolution: The solution, with ys of shape (n_samples, n_t, n_eq), or None
+        if a reducer is given.
+    """
+    step, n_f_evals = fixed_steps[solver_config["method"]]
+    dt = float(solver_config["dt"])
+    early_stop = reducer is not None and reducer.stopping_condition is not None
+    with torch.inference_mode():
+        y = torch.atleast_2d(y0).clone()
+        y_next = torch.empty_like(y)
+        t_eval = torch.atleast_2d(t_eval).to(dtype=torch.float32, device=y.device)
+        t_rel = (t_eval[0] - t_eval[0, 0]).tolist()
+        if not torch.equal(t_eval - t_eval[:, :1], t_eval[:1] - t_eval[:1, :1].expand_as(t_eval)):
+            raise ValueError("The evaluation times of the samples have to be equally offset!")
+
+        n_samples = y.shape[0]
+        # Positions of the integrated samples in the batch, and which of them are still running
+        rows = torch.arange(n_samples, device=y.device)
+        active = torch.ones(n_samples, dtype=torch.bool, device=y.device)
+        all_active = True
+        n_steps = torch.zeros(n_samples, dtype=torch.long, device=y.device)
+
+        if reducer is None:
+            ys = torch.empty((n_samples, len(t_rel), y.shape[1]), dtype=y.dtype, device=y.device)
+
+            def save(out_idx: int, y_out: torch.Tensor):
+                ys[:, out_idx] = y_out
+
+        else:
+            ys = None
+
+            def save(out_idx: int, y_out: torch.Tensor):
+                if all_active:
+                    reducer.update(y_out, rows)
+                else:
+                    reducer.update(y_out[active], rows[active])
+
+        save(0, y)
+        t_start = t_eval[:, 0]
+        # Ends of the segments of the right-hand side, the last one is the final evaluation time
+        segment_ends = [t_rel[-1]]
+        if isinstance(odefun, SegmentedODE):
+            segment_ends = odefun.get_breakpoints(t_start, t_rel[-1]) + segment_ends
+        segment_idx = 0
+        segment_start = 0.0
+        rhs = get_segment_rhs(odefun, t_start, segment_start, segment_ends[0])
+        t_curr = 0.0
+        n_taken = 0
+        out_idx = 1
+        while out_idx < len(t_rel):
+            # Steps are shortened not to overshoot the end of the segment
+            t_next = min(t_curr + dt, segment_ends[segment_idx])
+            step_size = t_next - t_curr
+            step(rhs, t_start + t_curr, y, step_size, out=y_next)
+            n_taken += 1
+            n_saved = 0
+            while out_idx < len(t_rel) and t_rel[out_idx] <= t_next:
+                if t_rel[out_idx] == t_next:
+                    save(out_idx, y_next)
+                else:
+                    save(out_idx, torch.lerp(y, y_next, (t_rel[out_idx] - t_curr) / step_size))
+                out_idx += 1
+                n_saved += 1
+            y, y_next, t_curr = y_next, y, t_next
+            if t_curr == segment_ends[segment_idx] and segment_idx + 1 < len(segment_ends):
+                segment_idx += 1
+                segment_start = t_curr
+                rhs = get_segment_rhs(odefun, t_start, segment_start, segment_ends[segment_idx])
+
+            if not (early_stop and n_saved):
+                continue
+            finished = active & reducer.get_finished(y, rows)
+            if not finished.any():
+                continue
+            reducer.finalize(y[finished], rows[finished])
+            n_steps[rows[finished]] = n_taken
+            active = active & ~finished
+            all_active = False
+            if not active.any():
+                break
+            n_frozen = int((~active).sum())
+            if on_compact is not None and n_frozen >= solver_config["compact_ratio"] * len(rows):
+                keep = active.nonzero().flatten()
+                y, t_start, rows = y[keep], t_start[keep], rows[keep]
+                y_next = torch.empty_like(y)
+                active = active[keep]
+                all_active = True
+                on_compact(keep)
+                if isinstance(odefun, SegmentedODE):
+                    odefun.select(keep)
+                    rhs = get_segment_rhs(odefun, t_start, segment_start, segment_ends[segment_idx])
+
+        n_steps[rows[active]] = n_taken
+        if reducer is not None and active.any():
+            reducer.finalize(y[active], rows[active])
+
+    # The outputs are normal tensors, so that they can be modified outside of inference mode
+    if ys is not None:
+        ys = ys.clone()
+    return FixedStepSolution(
+        ts=t_eval, ys=ys, stats={"n_steps": n_steps, "n_f_evals": n_steps * n_f_evals}
+    )
+
+
+def get_segment_rhs(
+    odefun: Callable, t_start: torch.Tensor, segment_start: float, segment_end: float
+) -> Callable:
+    """
+    Get the right-hand side on a segment of a SegmentedODE, given by its start and end relative to
+    the starting times of the samples. Other ODE functions are returned unchanged.
+    """
+    if not isinstance(odefun, SegmentedODE):
+        return odefun
+    # The midpoint is unaffected by the rounding of the breakpoints relative to t_start
+    return odefun.get_odefun(t_start + (segment_start + segment_end) / 2)
+
+
+def solve_segmented(
+    solve: Callable[[Callable, torch.Tensor, torch.Tensor], Any],
+    odefun: SegmentedODE,
+    y0: torch.Tensor,
+    t_eval: torch.Tensor,
+) -> FixedStepSolution:
+    """
+    Solve an ODE with a piecewise right-hand side by solving its segments one after the other,
+    each continuing from the last state of the previous one.
+
+    The evaluation times of every sample have to be the same relative to the first one, see
+    solve_fixed_step. Each segment is solved at its evaluation times and its end points, and the
+    solution is assembled from the values at the evaluation times.
+
+    Args:
+        solve (Callable): Function solving an ODE function from the initial values at the given
+            evaluation times, returning a solution with ys and stats, e.g. a torchode solver.
+        odefun (SegmentedODE): The piecewise right-hand side.
+        y0 (torch.Tensor): Initial values of shape (n_samples, n_eq).
+        t_eval (torch.Tensor): Evaluation times of shape (n_samples, n_t).
+
+    Returns:
+        FixedStepSolution: The solution, with the statistics of the solver summed over the segments.
+    """
+    t_eval = torch.atleast_2d(t_eval).to(torch.float32)
+    y = torch.atleast_2d(y0)
+    t_rel = (t_eval[0] - t_eval[0, 0]).tolist()
+    if not torch.equal(t_eval - t_eval[:, :1], t_eval[:1] - t_eval[:1, :1].expand_as(t_eval)):
+        raise ValueError("The evaluation times of the samples have to be equally offset!")
+    t_start = t_eval[:, 0]
+    bounds = [0.0] + odefun.get_breakpoints(t_start, t_rel[-1]) + [t_rel[-1]]
+
+    ys, stats = [], {}
+    for segment_start, segment_end in zip(bounds[:-1], bounds[1:]):
+        inner = [t for t in t_rel if segment_start < t < segment_end]
+        segment_t = [segment_start] + inner + [segment_end]
+        sol = solve(
+            get_segment_rhs(odefun, t_start, segment_start, segment_end),
+            y,
+            t_start.unsqueeze(1) + torch.tensor(segment_t, device=t_eval.device),
+        )
+        # The start of a segment is the end of the previous one, which was already saved
+        is_saved = [segment_start == 0.0] + [True] * len(inner) + [segment_end in t_rel]
+        ys.append(sol.ys[:, torch.tensor(is_saved, device=sol.ys.device)])
+        y = sol.ys[:, -1]
+        for key, value in sol.stats.items():
+            stats[key] = stats[key] + value if key in stats else value
+    return FixedStepSolution(ts=t_eval, ys=torch.cat(ys, dim=1), stats=stats)
@@ -1,24 +1,119 @@
 import torch
 
 from .matrix_generator import (
-    generate_transition_matrix,
+    get_batched_params,
     get_susc_mul,
     get_inf_mul,
     get_param_mul,
 )
 from . import get_substates
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
+
+eig_methods = ["eigvals", "power"]
+default_eig_config = {"method": "eigvals", "tol": 1e-6, "max_iter": 1000}
+
+
+def get_eig_config(eig_config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Complete the configuration of the dominant eigenvalue computation with the default values,
+    see default_eig_config.
+
+    With the eigvals method, every eigenvalue of the NGM is computed by a dense decomposition.
+    With the power method, the dominant eigenvalue is found by power iteration, which stops once
+    the lower and upper Collatz-Wielandt bounds of the eigenvalue, the smallest and the largest of
+    the ratios (Kx)_i / x_i, differ by at most tol times the estimate, so tol bounds the relative
+    error of the eigenvalue. The samples not converged after max_iter iterations fall back to the
+    dense decomposition, see get_spectral_radius.
+
+    Raises:
+        ValueError: If the method is unknown.
+    """
+    eig_config = {**default_eig_config, **(eig_config or {})}
+    if eig_config["method"] not in eig_methods:
+        raise ValueError(
+            f"Unknown eigenvalue method {eig_config['method']}, choose from {eig_methods}"
+        )
+    return eig_config
+
+
+def get_spectral_radius(
+    matrices: torch.Tensor,
+    tol: float,
+    max_iter: int,
+    x0: Optional[torch.Tensor] = None,
+    check_every: int = 10,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Compute the spectral radii of a stack of matrices with entries of the same sign, e.g. NGMs,
+    by power iteration. By the Perron-Frobenius theorem, the spectral radius of such a matrix is
+    the dominant eigenvalue of the absolute values of its entries, with a nonnegative eigenvector.
+
+    For a positive vector x, the spectral radius lies between the smallest and the largest of the
+    ratios (Kx)_i / x_i (Collatz-Wielandt bounds). The iteration of a sample stops once these
+    bounds are within tol of each other relative to the estimate. Samples which don't converge
+    within max_iter iterations, e.g. for reducible or periodic matrices, fall back to a dense
+    eigenvalue decomposition.
+
+    Args:
+        matrices (torch.Tensor): Matrices of shape (n_samples, m, m).
+        tol (float): Relative tolerance of the eigenvalue estimates.
+        max_iter (int): Maximal number of iterations.
+        x0 (Optional[torch.Tensor]): Starting vector of shape (m,) or (n_samples, m), e.g. the
+            eigenvector of a previous, similar matrix.
+        check_every (int): Number of iterations between the convergence checks.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: The spectral radii of shape (n_samples,), and the
+        eigenvectors of shape (n_samples, m), normalized to sum to one.
+    """
+    matrices = matrices.abs()
+    n_samples, size = matrices.shape[0], matrices.shape[-1]
+    x = torch.ones((n_samples, size), device=matrices.device) if x0 is None else x0
+    # The iteration has to start from a positive vector, to have a component along the eigenvector
+    x = x.expand(n_samples, size).clamp(min=0) + 1e-6 * x.abs().max() + 1e-12
+    x = x / x.sum(dim=-1, keepdim=True)
+    radii = torch.zeros(n_samples, device=matrices.device)
+    eig_vecs = x.clone()
+    active = torch.arange(n_samples, device=matrices.device)
+    active_matrices = matrices
+    for _ in range(0, max_iter, check_every):
+        for _ in range(check_every):
+            y = (active_matrices @ x.unsqueeze(-1)).squeeze(-1)
+            x_prev, x = x, y / y.sum(dim=-1, keepdim=True).clamp(min=torch.finfo(y.dtype).tiny)
+        ratios = y / x_prev
+        upper, lower = ratios.max(dim=-1).values, ratios.min(dim=-1).values
+        estimates = y.sum(dim=-1)
+        converged = (upper - lower) <= tol * estimates
+        radii[active] = estimates
+        eig_vecs[active] = x
+        active_matrices, x, active = (
+            active_matrices[~converged],
+            x[~converged],
+            active[~converged],
+        )
+        if not active.numel():
+            break
+    if active.numel():
+        radii[active] = torch.linalg.eigvals(matrices[active]).abs().max(dim=-1).values
+    return radii, eig_vecs
 
 
 class R0Generator:
-    def __init__(self, data, model_struct: Dict[str, Any]):
+    def __init__(
+        self, data, model_struct: Dict[str, Any], eig_config: Optional[Dict[str, Any]] = None
+    ):
         """
         This class generates the basic reproduction number (R0) for the epidemic model.
 
         Args:
             data (Any): Data for the epidemic model.
             model_struct (Dict[str, Any]): Structure of the epidemic model.
+            eig_config (Optional[Dict[str, Any]]): Method of computing the dominant eigenvalue of
+                the NGM and its settings, see get_eig_config.
         """
+        self.eig_config = get_eig_config(eig_config)
+        # Eigenvector of the last NGM, the starting vector of the next power iteration
+        self.eig_vec = None
         self.data = data
         self.device = data.device
         self.state_data = model_struct["state_data"]
@@ -32,8 +127,8 @@ class R0Generator:
         self.params = data.params
         self.i = {self.inf_states[index]: index for index in torch.arange(0, self.n_states)}
         self.s_mtx = self.n_age * self.n_states
-
-        self._get_e()
+        # Inverse transition blocks computed from the parameters of the model, with their values
+        self._v_inv_cache: Optional[Tuple[tuple, torch.Tensor]] = None
 
     def isinf_state(self, state):
         return state in [
@@ -53,67 +148,146 @@ class R0Generator:
                 states += get_substates(data.get("n_substates", 1), state)
         return states
 
-    def _idx(self, state: str) -> torch.BoolTensor:
+    def get_eig_val(
+        self,
+        susceptibles: torch.Tensor,
+        population: torch.Tensor,
+        contact_mtx: torch.Tensor,
+    ) -> float:
         """
-        Get a BoolTensor representing the indices of the compartments corresponding to a given state.
+        Compute the dominant eigenvalue of the next-generation matrix (NGM).
 
         Args:
-            state (str): State name.
+            susceptibles (torch.Tensor): Susceptible population.
+            population (torch.Tensor): Total population.
+            contact_mtx (torch.Tensor): Contact matrix.
 
         Returns:
-            torch.BoolTensor: Index tensor.
+            float: Dominant eigenvalue representing the basic reproduction number (R0).
         """
-        return torch.arange(self.n_age * self.n_states) % self.n_states == self.i[state]
+        eig_vals = self.get_eig_vals(
+            susceptibles=susceptibles, population=population, contact_mtx=contact_mtx
+        )
+        return float(eig_vals[0])
 
-    def get_eig_val(
+    def get_eig_vals(
         self,
         susceptibles: torch.Tensor,
         population: torch.Tensor,
         contact_mtx: torch.Tensor,
-    ) -> float:
+        lhs_dict: Optional[dict] = None,
+    ) -> torch.Tensor:
         """
-        Compute the dominant eigenvalue of the next-generation matrix (NGM).
+        Compute the dominant eigenvalues of the next-generation matrices of a batch of samples at
+        once, see get_eig_val. The samples are given by the sampled parameters and/or a stack of
+        contact matrices, and the NGMs of shape (n_samples, n_age, n_age) are built in one pass.
+
+        The NGM is K = E V^{-1} F E^T, where E selects the first infected state of every age group.
+        Since V is block diagonal, with one n_states x n_states block per age group, only the
+        blocks are inverted, and only the first rows of their inverses are needed. Likewise, only
+        the columns of F belonging to the first infected states are built, so that
+
+            K[a, b] = sum_s V_a^{-1}[0, s] * F[(a, s), (b, 0)].
 
         Args:
             susceptibles (torch.Tensor): Susceptible population.
             population (torch.Tensor): Total population.
-            contact_mtx (torch.Tensor): Contact matrix.
+            contact_mtx (torch.Tensor): Contact matrix, or a stack of contact matrices with a
+                leading sample dimension.
+            lhs_dict (Optional[dict]): Sampled parameters with a leading sample dimension, which
+                override the parameters of the model.
 
         Returns:
-            float: Dominant eigenvalue representing the basic reproduction number (R0).
+            torch.Tensor: Dominant eigenvalues of shape (n_samples,).
         """
+        ps = get_batched_params(params=self.params, lhs_dict=lhs_dict, device=self.device)
         # contact matrix needed for effective reproduction number: [c_{j,i} * S_i(t) / N_i(t)]
-        cm = contact_mtx / population.reshape((-1, 1))
-        cm = cm * susceptibles
-        f = self._get_f(cm)
-        v_inv = self._get_v()
-        ngm_large = v_inv @ f
-        ngm = self.e @ ngm_large @ self.e.T if self.n_age > 1 else self.e @ ngm_large @ self.e
+        cm = torch.as_tensor(contact_mtx, dtype=torch.float32, device=self.device)
+        cm = cm / population.reshape((-1, 1)).to(self.device)
+        cm = cm * susceptibles.flatten().to(self.device)
+        # First rows of the inverse blocks of shape (1 | n_samples, 1 | n_age, n_states)
+        v_inv_first = self.get_v_inv_blocks(ps=ps, lhs_dict=lhs_dict)[..., 0, :]
+        # Columns of F of shape (1 | n_samples, n_states, n_age, n_age)
+        f_first = self._get_f(cm, ps=ps)
+        ngm = (v_inv_first.unsqueeze(-1) * f_first.transpose(1, 2)).sum(dim=2)
+        return self.get_spectral_radii(ngm)
 
-        if self.n_age == 1:
-            dom_eig_val = torch.abs(ngm)
-        else:
-            dom_eig_val = torch.sort(torch.abs(torch.linalg.eigvals(ngm)))[0][-1]
-        return float(dom_eig_val)
+    def get_spectral_radii(self, ngm: torch.Tensor) -> torch.Tensor:
+        """
+        Compute the spectral radii of a stack of NGMs with the method given by eig_config. Power
+        iteration is warm started from the eigenvector of the last NGM.
+        """
+        if self.eig_config["method"] == "eigvals":
+            return torch.linalg.eigvals(ngm).abs().max(dim=-1).values
+        eig_vals, eig_vecs = get_spectral_radius(
+            matrices=ngm,
+            tol=self.eig_config["tol"],
+            max_iter=self.eig_config["max_iter"],
+            x0=self.eig_vec,
+        )
+        self.eig_vec = eig_vecs[-1]
+        return eig_vals
 
-    def _get_v(self) -> torch.Tensor:
+    def get_v_inv_blocks(self, ps: dict, lhs_dict: Optional[dict] = None) -> torch.Tensor:
         """
-        Compute the inverse of the transition matrix.
+        Get the inverses of the diagonal blocks of the transition matrix V. If none of the sampled
+        parameters affects V, the inverse is computed once for the parameters of the model and
+        cached until their values change.
+
+        Args:
+            ps (dict): Batched parameters, see get_batched_params.
+            lhs_dict (Optional[dict]): Sampled parameters with a leading sample dimension.
 
         Returns:
-            torch.Tensor: Inverse of the transition matrix.
+            torch.Tensor: Inverse blocks of shape (1 | n_samples, 1 | n_age, n_states, n_states).
+        """
+        v_params = self._get_v_params()
+        if lhs_dict and any(param in v_params for param in lhs_dict):
+            return torch.linalg.inv(self._get_v(ps=ps))
+        key = tuple((param, tuple(ps[param].flatten().tolist())) for param in sorted(v_params))
+        if self._v_inv_cache is None or self._v_inv_cache[0] != key:
+            self._v_inv_cache = (key, torch.linalg.inv(self._get_v(ps=ps)))
+        return self._v_inv_cache[1]
+
+    def _get_v_params(self) -> set:
+        """
+        Get the names of the parameters the transition matrix V depends on.
         """
         isinf = self.isinf_state
+        v_params = {data["rate"] for state, data in self.state_data.items() if isinf(state)}
+        for trans in self.trans_data:
+            if isinf(state=trans["source"]) and isinf(state=trans["target"]):
+                v_params |= {param.rstrip("_") for param in trans.get("params") or []}
+        return v_params
+
+    def _get_v(self, ps: dict) -> torch.Tensor:
+        """
+        Compute the diagonal blocks of the transition matrix, one per age group. If the parameters
+        don't depend on the age groups, a single block is computed.
+
+        Args:
+            ps (dict): Batched parameters, see get_batched_params.
+
+        Returns:
+            torch.Tensor: Transition blocks of shape (1 | n_samples, 1 | n_age, n_states, n_states).
+        """
+        i = self.i
+        isinf = self.isinf_state
         inf_state_dict = {
             state: data for state, data in self.state_data.items() if isinf(state=state)
         }
-        trans_mtx = generate_transition_matrix(
-            states_dict=inf_state_dict,
-            parameters=self.params,
-            n_age=self.n_age,
-            n_comp=self.n_states,
-            c_idx=self.i,
-        ).to(self.device)
+        # Positions and values of the entries, the values are of shape (1 | n_samples, 1 | n_age)
+        entries = []
+        for state, data in inf_state_dict.items():
+            n_states = data.get("n_substates", 1)
+            trans_param = ps[data["rate"]] * n_states
+            substates = get_substates(n_substates=n_states, comp_name=state)
+            # Outflow from states
+            for substate in substates:
+                entries.append((i[substate], i[substate], -trans_param))
+            # Inflow to the next substate
+            for substate, next_substate in zip(substates[:-1], substates[1:]):
+                entries.append((i[substate], i[next_substate], trans_param))
 
         end_state_dict = {
             state: f"{state}_{data.get('n_substates', 1) - 1}"
@@ -124,56 +298,55 @@ class R0Generator:
             for trans in self.trans_data
             if isinf(state=trans["source"]) and isinf(state=trans["target"])
         ]
-        idx = self._idx
-
         for trans in inf_trans:
             source = trans["source"]
             target = f"{trans['target']}_0"
-            param = self.params[self.state_data[source]["rate"]]
+            param = ps[self.state_data[source]["rate"]]
             n_substates = self.state_data[source].get("n_substates", 1)
-            distr = get_param_mul(trans_params=trans.get("params"), params=self.params)
-            trans_mtx[idx(end_state_dict[source]), idx(target)] = param * distr * n_substates
-        return torch.linalg.inv(trans_mtx)
+            distr = get_param_mul(trans_params=trans.get("params"), params=ps)
+            entries.append((i[end_state_dict[source]], i[target], param * distr * n_substates))
+
+        n_samples = max(value.shape[0] for _, _, value in entries)
+        n_blocks = max(value.shape[1] for _, _, value in entries)
+        blocks = torch.zeros(
+            (n_samples, n_blocks, self.n_states, self.n_states), device=self.device
+        )
+        for row, col, value in entries:
+            blocks[:, :, row, col] = value
+        return blocks
 
-    def _get_f(self, contact_mtx: torch.Tensor) -> torch.Tensor:
+    def _get_f(self, contact_mtx: torch.Tensor, ps: dict) -> torch.Tensor:
         """
-        Compute the matrix representing the rate of infection.
+        Compute the columns of the matrix representing the rate of infection, which belong to the
+        first infected states. The rows of the substates are given separately.
 
         Args:
-            contact_mtx (torch.Tensor): The contact matrix.
+            contact_mtx (torch.Tensor): The contact matrix, or a stack of contact matrices.
+            ps (dict): Batched parameters, see get_batched_params.
 
         Returns:
-            torch.Tensor: The matrix representing the rate of infection.
+            torch.Tensor: The entries F[(a, s), (b, 0)] of shape
+            (1 | n_samples, n_states, n_age, n_age).
         """
         i = self.i
-        s_mtx = self.s_mtx
-        n_states = self.n_states
-        f = torch.zeros((s_mtx, s_mtx)).to(self.device)
+        contact_mtx = contact_mtx if contact_mtx.dim() == 3 else contact_mtx.unsqueeze(0)
+        n_samples = max([contact_mtx.shape[0]] + [value.shape[0] for value in ps.values()])
+        f = torch.zeros((n_samples, self.n_states, self.n_age, self.n_age), device=self.device)
 
         for tms in self.tms_rules:
-            susc_mul = get_susc_mul(tms_rule=tms, data=self.data)
-            inf_mul = get_inf_mul(tms_rule=tms, data=self.data)
+            # Only the infections of the first infected states enter the NGM
+            if i[f"{tms['target']}_0"] != 0:
+                continue
+            # The multipliers of shape (1 | n_samples, n_age) are broadcast to the columns
+            susc_mul = get_susc_mul(tms_rule=tms, data=self.data, params=ps).unsqueeze(1)
+            inf_mul = get_inf_mul(tms_rule=tms, data=self.data, params=ps).unsqueeze(1)
             for actor in tms["actors-params"]:
-                rel_inf = self.params.get(tms["actors-params"][actor], 1)
+                rel_inf = ps.get(tms["actors-params"][actor], torch.ones(1, 1, device=self.device))
                 for substate in get_substates(
                     n_substates=self.state_data[actor].get("n_substates", 1),
                     comp_name=actor,
                 ):
-                    substate_slice = slice(i[substate], s_mtx, n_states)
-                    target_slice = slice(i[f"{tms['target']}_0"], s_mtx, n_states)
-                    f[substate_slice, target_slice] = (
-                        susc_mul * contact_mtx.T * inf_mul.unsqueeze(0) * rel_inf
+                    f[:, i[substate]] = (
+                        susc_mul * contact_mtx.transpose(-2, -1) * inf_mul * rel_inf.unsqueeze(1)
                     )
         return f
-
-    def _get_e(self):
-        """
-        Compute and store the matrix 'e' used in the next-generation matrix (NGM) calculation.
-        """
-        block = torch.zeros(
-            self.n_states,
-        ).to(self.device)
-        block[0] = 1
-        self.e = block
-        for i in range(1, self.n_age):
-            self.e = torch.block_diag(self.e, block)
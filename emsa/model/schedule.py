@@ -0,0 +1,152 @@
+from typing import Callable, Dict, List, Optional
+
+import torch
+
+
+class Schedule:
+    """
+    Piecewise-constant value of a time-varying intervention, e.g. the rate of vaccination, a scaling
+    factor of the contacts, or the value of a parameter, with breakpoints shared by all samples or
+    given for every sample.
+
+    The value on the k-th segment applies from the (k-1)-th breakpoint (inclusive) to the k-th
+    breakpoint (exclusive), the first value before the first breakpoint and the last value after
+    the last breakpoint.
+
+    Attributes:
+        breakpoints (torch.Tensor): Sorted times where the value changes, of shape
+            (n_samples, n_breakpoints), or (1, n_breakpoints) if shared by all samples.
+        values (torch.Tensor): Value on each segment, of shape
+            (n_samples, n_breakpoints + 1, *value_shape), or (1, n_breakpoints + 1, *value_shape).
+    """
+
+    def __init__(self, breakpoints, values):
+        """
+        Args:
+            breakpoints: Breakpoints of shape (n_breakpoints,) shared by all samples, or of shape
+                (n_samples, n_breakpoints).
+            values: Values of the segments of shape (n_breakpoints + 1, *value_shape) with shared
+                breakpoints, otherwise of shape (n_samples, n_breakpoints + 1, *value_shape).
+        """
+        breakpoints = torch.as_tensor(breakpoints, dtype=torch.float32)
+        values = torch.as_tensor(values, dtype=torch.float32)
+        if breakpoints.dim() < 2:
+            breakpoints = breakpoints.reshape(1, -1)
+            values = values.unsqueeze(0)
+        if values.shape[1] != breakpoints.shape[1] + 1:
+            raise ValueError("A schedule needs one more value than breakpoints!")
+        self.breakpoints = breakpoints
+        self.values = values.to(breakpoints.device)
+
+    @classmethod
+    def from_config(cls, config: dict, device=None) -> "Schedule":
+        """
+        Create a schedule from a dictionary with the keys breakpoints and values.
+        """
+        schedule = cls(breakpoints=config["breakpoints"], values=config["values"])
+        return schedule.to(device) if device is not None else schedule
+
+    @classmethod
+    def window(cls, start, duration, value=1.0, default=0.0) -> "Schedule":
+        """
+        Create a schedule taking the given value from start until start + duration, and the
+        default value otherwise. Start and duration may be given for every sample.
+        """
+        start = torch.as_tensor(start, dtype=torch.float32).reshape(-1)
+        end = start + torch.as_tensor(duration, dtype=torch.float32, device=start.device).reshape(
+            -1
+        )
+        breakpoints = torch.stack(torch.broadcast_tensors(start, end), dim=1)
+        values = torch.tensor([default, value, default], device=start.device)
+        return cls(breakpoints=breakpoints, values=values.expand(breakpoints.shape[0], -1))
+
+    @property
+    def n_samples(self) -> int:
+        return max(self.breakpoints.shape[0], self.values.shape[0])
+
+    def to(self, device) -> "Schedule":
+        return Schedule(breakpoints=self.breakpoints.to(device), values=self.values.to(device))
+
+    def value_at(self, t: torch.Tensor) -> torch.Tensor:
+        """
+        Get the values at the times t of shape (n_samples,), of shape (n_samples, *value_shape).
+        """
+        t = torch.as_tensor(t, dtype=torch.float32, device=self.breakpoints.device).reshape(-1, 1)
+        n_samples = max(t.shape[0], self.n_samples)
+        breakpoints = self.breakpoints.expand(n_samples, -1).contiguous()
+        segment = torch.searchsorted(breakpoints, t.expand(n_samples, 1).contiguous(), right=True)
+        values = self.values.expand(n_samples, *self.values.shape[1:])
+        return values[torch.arange(n_samples, device=values.device), segment.flatten()]
+
+    def select(self, idx: torch.Tensor) -> "Schedule":
+        """
+        Select the samples at the given positions, schedules shared by all samples are unchanged.
+        """
+        if self.n_samples == 1:
+            return self
+        return Schedule(
+            breakpoints=self.breakpoints.expand(self.n_samples, -1)[idx],
+            values=self.values.expand(self.n_samples, *self.values.shape[1:])[idx],
+        )
+
+
+def get_schedules(config: Optional[Dict[str, dict]], device=None) -> Dict[str, Schedule]:
+    """
+    Create the schedules given in the sampling config, see Schedule.from_config.
+    """
+    return {name: Schedule.from_config(value, device) for name, value in (config or {}).items()}
+
+
+class SegmentedODE:
+    """
+    Right-hand side of an ODE depending on piecewise-constant schedules.
+
+    Instead of checking the schedules at every evaluation, the solvers split the integration at
+    the breakpoints, and build the right-hand side of every segment once by calling make_odefun
+    with the values of the schedules on the segment. Values shared by all samples on a segment
+    are passed with a leading dimension of 1, so that they broadcast.
+
+    Attributes:
+        schedules (Dict[str, Schedule]): Schedules by name.
+        make_odefun (Callable): Function creating the right-hand side of a segment from the
+            values of the schedules on it.
+    """
+
+    def __init__(
+        self,
+        schedules: Dict[str, Schedule],
+        make_odefun: Callable[[Dict[str, torch.Tensor]], Callable],
+    ):
+        self.schedules = schedules
+        self.make_odefun = make_odefun
+
+    def get_breakpoints(self, t_start: torch.Tensor, t_end: float) -> List[float]:
+        """
+        Get the breakpoints of the schedules relative to the starting times t_start of the samples,
+        which lie strictly between 0 and t_end.
+        """
+        t_start = t_start.reshape(-1, 1).to(torch.float32)
+        breakpoints = [
+            (schedule.breakpoints.to(t_start.device) - t_start).flatten()
+            for schedule in self.schedules.values()
+        ]
+        if not breakpoints:
+            return []
+        breakpoints = torch.unique(torch.cat(breakpoints))
+        return breakpoints[(breakpoints > 0) & (breakpoints < t_end)].tolist()
+
+    def get_odefun(self, t: torch.Tensor) -> Callable:
+        """
+        Get the right-hand side of the segment containing the times t of the samples.
+        """
+        values = {}
+        for name, schedule in self.schedules.items():
+            value = schedule.value_at(t)
+            values[name] = value[:1] if (value == value[:1]).all() else value
+        return self.make_odefun(values)
+
+    def select(self, idx: torch.Tensor) -> None:
+        """
+        Restrict the schedules to the samples at the given positions.
+        """
+        self.schedules = {name: schedule.select(idx) for name, schedule in self.schedules.items()}
@@ -0,0 +1,101 @@
+from typing import List
+
+import torch
+
+
+class SparseMatrix:
+    """
+    COO representation of a matrix, or of a stack of matrices sharing the same sparsity pattern.
+
+    The matrices generated by MatrixGenerator have the same structure for every sample, only the
+    values of the nonzero entries differ. Hence the row and column indices are stored once, while
+    the values are of shape (nnz,) for a single matrix, or (n_samples, nnz) for a stack of matrices.
+    Both the memory usage and the cost of multiplication grow with the number of nonzero entries,
+    instead of n_eq^2.
+
+    Attributes:
+        rows (torch.Tensor): Row indices of the nonzero entries.
+        cols (torch.Tensor): Column indices of the nonzero entries.
+        values (torch.Tensor): Values of the nonzero entries, with a leading sample dimension if batched.
+        n_eq (int): Number of rows (and columns) of the matrix.
+    """
+
+    def __init__(self, rows: torch.Tensor, cols: torch.Tensor, values: torch.Tensor, n_eq: int):
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+        self.n_eq = n_eq
+
+    @classmethod
+    def from_dense(cls, matrix: torch.Tensor) -> "SparseMatrix":
+        """
+        Create a sparse matrix from a dense matrix of shape (n_eq, n_eq), or from a stack of
+        dense matrices of shape (n_samples, n_eq, n_eq).
+        """
+        pattern = matrix != 0 if matrix.dim() < 3 else (matrix != 0).any(dim=0)
+        rows, cols = pattern.nonzero(as_tuple=True)
+        return cls(rows=rows, cols=cols, values=matrix[..., rows, cols], n_eq=matrix.shape[-1])
+
+    @classmethod
+    def cat(cls, matrices: List["SparseMatrix"]) -> "SparseMatrix":
+        """
+        Concatenate stacks of sparse matrices along the sample dimension, merging their sparsity patterns.
+        """
+        n_eq = matrices[0].n_eq
+        lin_idx = [matrix.rows * n_eq + matrix.cols for matrix in matrices]
+        pattern = torch.unique(torch.cat(lin_idx))
+        values = []
+        for matrix, matrix_lin_idx in zip(matrices, lin_idx):
+            matrix_values = torch.zeros(
+                (matrix.values.shape[0], pattern.numel()), device=matrix.values.device
+            )
+            matrix_values[:, torch.searchsorted(pattern, matrix_lin_idx)] = matrix.values
+            values.append(matrix_values)
+        return cls(
+            rows=torch.div(pattern, n_eq, rounding_mode="floor"),
+            cols=pattern % n_eq,
+            values=torch.cat(values),
+            n_eq=n_eq,
+        )
+
+    @property
+    def is_batched(self) -> bool:
+        return self.values.dim() > 1
+
+    @property
+    def shape(self) -> torch.Size:
+        if self.is_batched:
+            return torch.Size((self.values.shape[0], self.n_eq, self.n_eq))
+        return torch.Size((self.n_eq, self.n_eq))
+
+    def dim(self) -> int:
+        return len(self.shape)
+
+    def size(self) -> torch.Size:
+        return self.shape
+
+    def to(self, device) -> "SparseMatrix":
+        return SparseMatrix(
+            rows=self.rows.to(device),
+            cols=self.cols.to(device),
+            values=self.values.to(device),
+            n_eq=self.n_eq,
+        )
+
+    def select(self, idx: torch.Tensor) -> "SparseMatrix":
+        """
+        Select the matrices at the given positions of the stack.
+        """
+        return SparseMatrix(rows=self.rows, cols=self.cols, values=self.values[idx], n_eq=self.n_eq)
+
+    def to_dense(self) -> torch.Tensor:
+        dense = torch.zeros(self.shape, device=self.values.device)
+        dense[..., self.rows, self.cols] = self.values
+        return dense
+
+    def __rmatmul__(self, y: torch.Tensor) -> torch.Tensor:
+        """
+        Compute y @ M, where y is of shape (n_samples, n_eq).
+        """
+        out = torch.zeros((y.shape[0], self.n_eq), dtype=y.dtype, device=y.device)
+        return out.index_add_(1, self.cols, y[:, self.rows] * self.values)
@@ -0,0 +1,149 @@
+from typing import Any, Dict, List
+
+import torch
+
+
+class StateLayout:
+    """
+    Registry of the positions of the compartments in the state vector, built once per model.
+
+    The state vector of length n_eq = n_age * n_comp is ordered by age group first, so the
+    compartment comp of age group a is found at a * n_comp + c_idx[comp]. Hence a tensor of shape
+    (..., n_eq) can be viewed as (..., n_age, n_comp) without copying, and compartments and groups
+    of compartments are selected along the last dimension of this view.
+
+    Attributes:
+        compartments (List[str]): List of compartments.
+        c_idx (Dict[str, int]): Position of the compartments within an age group.
+        n_age (int): The number of age groups.
+        n_comp (int): The number of compartments per age group.
+        n_eq (int): Length of the state vector.
+        state_comps (Dict[str, torch.Tensor]): Positions of the substates of every state.
+        type_comps (Dict[str, torch.Tensor]): Positions of the substates of every state type,
+            e.g. all substates of the infected states.
+    """
+
+    def __init__(self, state_data: Dict[str, Any], compartments: List[str], n_age: int, device):
+        self.compartments = compartments
+        self.c_idx = {comp: idx for idx, comp in enumerate(compartments)}
+        self.n_age = n_age
+        self.n_comp = len(compartments)
+        self.n_eq = n_age * self.n_comp
+        self.device = device
+
+        self.state_comps = {
+            state: self._get_positions(
+                [comp for comp in compartments if comp.rsplit("_", 1)[0] == state]
+            )
+            for state in state_data
+        }
+        state_types = {data.get("type") for data in state_data.values() if data.get("type")}
+        self.type_comps = {
+            state_type: self._get_positions(
+                [
+                    comp
+                    for comp in compartments
+                    if state_data[comp.rsplit("_", 1)[0]].get("type") == state_type
+                ]
+            )
+            for state_type in state_types
+        }
+
+        age_offsets = torch.arange(n_age, device=device) * self.n_comp
+        self._indices = {comp: age_offsets + idx for comp, idx in self.c_idx.items()}
+        self._masks = {}
+        self._aggregation_matrices = {}
+
+    def _get_positions(self, comps: List[str]) -> torch.Tensor:
+        return torch.tensor([self.c_idx[comp] for comp in comps], device=self.device)
+
+    def indices(self, comp: str) -> torch.Tensor:
+        """
+        Get the indices of a compartment in the state vector, one per age group.
+        """
+        return self._indices[comp]
+
+    def mask(self, comp: str) -> torch.BoolTensor:
+        """
+        Get the boolean mask of a compartment in the state vector.
+        """
+        if comp not in self._masks:
+            self._masks[comp] = torch.arange(self.n_eq) % self.n_comp == self.c_idx[comp]
+        return self._masks[comp]
+
+    def view(self, tensor: torch.Tensor) -> torch.Tensor:
+        """
+        View a tensor of shape (..., n_eq) as (..., n_age, n_comp).
+        """
+        return tensor.reshape(*tensor.shape[:-1], self.n_age, self.n_comp)
+
+    def get_comp(self, tensor: torch.Tensor, comp: str) -> torch.Tensor:
+        """
+        Get the values of a compartment of shape (..., n_age) from a tensor of shape (..., n_eq).
+        """
+        return self.view(tensor)[..., self.c_idx[comp]]
+
+    def sum_state(self, tensor: torch.Tensor, state: str) -> torch.Tensor:
+        """
+        Sum the substates of a state over all age groups.
+
+        Args:
+            tensor (torch.Tensor): Tensor of shape (..., n_eq).
+            state (str): Name of the state.
+
+        Returns:
+            torch.Tensor: Sums of shape (...).
+        """
+        return self._sum_positions(tensor, self.state_comps[state])
+
+    def sum_type(self, tensor: torch.Tensor, state_type: str) -> torch.Tensor:
+        """
+        Sum the substates of the states of a type over all age groups, see sum_state.
+        """
+        if state_type not in self.type_comps:
+            return torch.zeros(tensor.shape[:-1], device=tensor.device)
+        return self._sum_positions(tensor, self.type_comps[state_type])
+
+    def get_aggregation_matrix(self, groups: List[str]) -> torch.Tensor:
+        """
+        Get the matrix of shape (n_comp, n_groups) whose columns are the indicators of the groups
+        within an age group. A group is either a compartment, e.g. "i_0", a state, standing for all
+        of its substates, e.g. "i", or a state type, e.g. "infected".
+        """
+        key = tuple(groups)
+        if key not in self._aggregation_matrices:
+            matrix = torch.zeros((self.n_comp, len(groups)), device=self.device)
+            for col, group in enumerate(groups):
+                if group in self.c_idx:
+                    matrix[self.c_idx[group], col] = 1
+                elif group in self.state_comps:
+                    matrix[self.state_comps[group], col] = 1
+                elif group in self.type_comps:
+                    matrix[self.type_comps[group], col] = 1
+                else:
+                    raise ValueError(f"Unknown compartment, state or state type {group}")
+            self._aggregation_matrices[key] = matrix
+        return self._aggregation_matrices[key]
+
+    def aggregate(
+        self, tensor: torch.Tensor, groups: List[str], by_age: bool = False
+    ) -> torch.Tensor:
+        """
+        Sum the compartments of several groups at once, for a whole block of states, e.g. the
+        solution of a batch of shape (n_samples, n_t, n_eq). See get_aggregation_matrix for the
+        possible groups.
+
+        Args:
+            tensor (torch.Tensor): Tensor of shape (..., n_eq).
+            groups (List[str]): Compartments, states or state types to sum.
+            by_age (bool): Whether to keep the age groups separate.
+
+        Returns:
+            torch.Tensor: Sums of shape (..., n_groups), or (..., n_age, n_groups) if by_age.
+        """
+        matrix = self.get_aggregation_matrix(groups).to(device=tensor.device, dtype=tensor.dtype)
+        sums = self.view(tensor) @ matrix
+        return sums if by_age else sums.sum(dim=-2)
+
+    def _sum_positions(self, tensor: torch.Tensor, positions: torch.Tensor) -> torch.Tensor:
+        return self.view(tensor).index_select(-1, positions.to(tensor.device)).sum(dim=(-2, -1))
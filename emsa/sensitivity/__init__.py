@@ -3,5 +3,6 @@ from .sensitivity_model_base import (
     SensitivityModelBase,
     get_lhs_dict,
     get_params_col_idx,
+    split_scenario_columns,
 )
 from .sampler_base import SamplerBase
@@ -1,11 +1,13 @@
+import json
 import os
-from abc import ABC, abstractmethod
+from abc import ABC
+from typing import Iterator, List, Optional, Tuple
 
 import numpy as np
 from smt.sampling_methods import LHS
 
 from .sensitivity_model_base import get_params_col_idx
-from .target_calc import OutputGenerator
+from .target_calc import Checkpoint, OutputGenerator, ParallelExecutor
 
 
 class SamplerBase(ABC):
@@ -42,15 +44,194 @@ class SamplerBase(ABC):
             self.lhs_bounds_dict = {param: np.array(spb[param]) for param in spb}
             self.pci = get_params_col_idx(spb)
 
-    @abstractmethod
     def run(self):
-        pass
+        """
+        Generate the samples of the scenario, run the simulations and save the results. With the
+        chunk_size key of the sampling config set, the samples are generated, solved and saved in
+        chunks, see get_sim_output_streamed.
+
+        When resuming, see SimulationBase.resume_sampling, a completed scenario is skipped, and a
+        scenario with a checkpoint continues from it with the samples saved when it started. A
+        streamed scenario continues from the first chunk not saved, see get_streamed_start.
+        Otherwise, a checkpoint left by an earlier run is discarded.
+
+        With more than one worker, see the parallel key of the sampling config, the worker
+        processes are started once for the scenario, and solve all its chunks of samples.
+        """
+        sim_object = self.sim_object
+        filename = sim_object.get_filename(self.variable_params)
+        if sim_object.resume and self.is_complete():
+            print(f"\n Skipping the completed scenario ({filename})")
+            return
+        with ParallelExecutor(config=sim_object.parallel_config) as executor:
+            self._run(executor=executor)
+
+    def _run(self, executor: ParallelExecutor):
+        sim_object = self.sim_object
+        filename = sim_object.get_filename(self.variable_params)
+        if sim_object.chunk_size is not None:
+            self.get_sim_output_streamed(executor=executor)
+            return
+        checkpoint = self.get_checkpoint()
+        if checkpoint is not None and checkpoint.exists() and sim_object.resume:
+            lhs_table = np.array(
+                sim_object.results_store.load(output_name="lhs", filename=filename)
+            )
+        else:
+            if checkpoint is not None:
+                checkpoint.remove()
+            lhs_table = self.get_samples()
+        self.get_sim_output(lhs_table, checkpoint=checkpoint, executor=executor)
+
+    def get_checkpoint(self) -> Optional[Checkpoint]:
+        """
+        Get the checkpoint of the target calculation of the scenario, in the checkpoints folder of
+        the simulation, if the checkpoint_every key of the sampling config is set.
+        """
+        sim_object = self.sim_object
+        if sim_object.checkpoint_every is None:
+            return None
+        filename = sim_object.get_filename(self.variable_params)
+        return Checkpoint(
+            path=os.path.join(sim_object.folder_name, "checkpoints", f"checkpoint_{filename}.pt"),
+            every=sim_object.checkpoint_every,
+            config_hash=sim_object.config_hash,
+        )
+
+    def is_complete(self) -> bool:
+        """
+        Whether all the outputs of the scenario are saved for every sample with the current
+        configuration, i.e. with the config_hash of the simulation, and no checkpoint of it is left.
+        """
+        sim_object = self.sim_object
+        checkpoint = self.get_checkpoint()
+        if checkpoint is not None and checkpoint.exists():
+            return False
+        results_store = sim_object.results_store
+        outputs = self.get_output_filenames()
+        return all(
+            results_store.count_rows(output_name=output_name, filename=output_filename)
+            == self.n_samples
+            and results_store.load_config_hash(output_name=output_name, filename=output_filename)
+            == sim_object.config_hash
+            for output_name, output_filename in outputs
+        )
+
+    def get_samples(self) -> np.ndarray:
+        """
+        Get the table of samples of the scenario, the transformed LHS table.
+        """
+        return self.transform_samples(self.get_lhs_table())
+
+    def transform_samples(self, lhs_table: np.ndarray) -> np.ndarray:
+        """
+        Transform rows of the LHS table into the samples, applied row by row, so that it can be
+        applied to chunks of the table. By default, the samples are the rows of the LHS table.
+        """
+        return lhs_table
 
     def get_lhs_table(self):
         bounds = self._get_lhs_bounds()
         sampling = LHS(xlimits=bounds)
         return sampling(self.n_samples)
 
+    def get_lhs_chunks(self, chunk_size: int, start: int = 0) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Generate the LHS table out of core, and yield it in chunks of chunk_size rows, together with
+        the index of their first row.
+
+        Every column is a random permutation of the centers of n_samples equally wide strata of
+        the bounds, which is the design of get_lhs_table. The columns are generated one by one
+        into a memory-mapped file, see get_lhs_table_path, so only a column and a chunk of the
+        table are held in memory. With start > 0, the table of an interrupted run is read from the
+        row start instead of generating a new one.
+        """
+        path = self.get_lhs_table_path()
+        if start == 0:
+            self.generate_lhs_file(path)
+        lhs_table = np.load(path, mmap_mode="r")
+        for chunk_start in range(start, self.n_samples, chunk_size):
+            yield chunk_start, np.array(lhs_table[slice(chunk_start, chunk_start + chunk_size)])
+        del lhs_table
+
+    def generate_lhs_file(self, path: str) -> None:
+        """
+        Generate the LHS table column by column into an npy file, which is written under a
+        temporary name first, so an interruption doesn't leave a table generated in part. The hash
+        of the configuration and the shape of the table are saved in a json file next to it, see
+        get_lhs_table_metadata.
+        """
+        bounds = self._get_lhs_bounds()
+        n_samples = self.n_samples
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        metadata_path = os.path.splitext(path)[0] + ".json"
+        if os.path.exists(metadata_path):
+            os.remove(metadata_path)
+        tmp_path = f"{path}.tmp"
+        lhs_table = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.float64, shape=(n_samples, len(bounds))
+        )
+        for col, (lower, upper) in enumerate(bounds):
+            strata = np.random.permutation(n_samples)
+            lhs_table[:, col] = lower + (strata + 0.5) / n_samples * (upper - lower)
+        lhs_table.flush()
+        del lhs_table
+        os.replace(tmp_path, path)
+        with open(metadata_path, "w") as f:
+            json.dump(self.get_lhs_table_metadata(), f)
+
+    def get_lhs_table_metadata(self) -> dict:
+        """
+        Get the metadata of the LHS table of a streamed run, which is only resumed if it was
+        generated with the same metadata.
+        """
+        return {
+            "config_hash": self.sim_object.config_hash,
+            "shape": [self.n_samples, len(self._get_lhs_bounds())],
+        }
+
+    def get_lhs_table_path(self) -> str:
+        """
+        Get the path of the LHS table of a streamed run, in the checkpoints folder of the
+        simulation. It is kept until all the chunks are saved, so an interrupted run can be resumed.
+        """
+        filename = self.sim_object.get_filename(self.variable_params)
+        return os.path.join(self.sim_object.folder_name, "checkpoints", f"lhs_table_{filename}.npy")
+
+    def get_streamed_start(self) -> int:
+        """
+        Get the index of the first sample of an interrupted streamed run whose outputs aren't all
+        saved, 0 if the run can't be resumed, i.e. its LHS table is missing, or the table or the
+        outputs were saved with another configuration, see get_lhs_table_metadata. The rows written
+        after it, e.g. the samples of a chunk whose targets weren't saved, are dropped.
+        """
+        path = self.get_lhs_table_path()
+        if not os.path.exists(path):
+            return 0
+        results_store = self.sim_object.results_store
+        outputs = self.get_output_filenames()
+        metadata_path = os.path.splitext(path)[0] + ".json"
+        if not os.path.exists(metadata_path):
+            metadata = None
+        else:
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+        if metadata != self.get_lhs_table_metadata() or any(
+            results_store.count_rows(output_name=output_name, filename=filename) > 0
+            and results_store.load_config_hash(output_name=output_name, filename=filename)
+            != self.sim_object.config_hash
+            for output_name, filename in outputs
+        ):
+            print(" Starting over, the interrupted run was saved with another configuration")
+            return 0
+        start = min(
+            results_store.count_rows(output_name=output_name, filename=filename)
+            for output_name, filename in outputs
+        )
+        for output_name, filename in outputs:
+            results_store.truncate(output_name=output_name, filename=filename, n_rows=start)
+        return start
+
     def _get_lhs_bounds(self):
         general_bounds = self._get_general_param_bounds()
         age_spec_bounds = self._get_age_spec_param_bounds()
@@ -85,35 +266,145 @@ class SamplerBase(ABC):
             bounds[:, idx] = param_bounds
         return bounds.T
 
-    def get_sim_output(self, lhs_table: np.ndarray):
+    def get_output_filenames(self) -> List[Tuple[str, str]]:
+        """
+        Get the names of the outputs of the scenario and of their datasets, see ResultsStore.
+        """
+        filename = self.sim_object.get_filename(self.variable_params)
+        return [("lhs", filename)] + [
+            ("simulations", f"{filename}_{target}") for target in self.sim_object.target_vars
+        ]
+
+    def get_sim_output(
+        self,
+        lhs_table: np.ndarray,
+        checkpoint: Optional[Checkpoint] = None,
+        executor: Optional[ParallelExecutor] = None,
+    ):
+        """
+        Run the simulations of the samples of the scenario and save the results.
+
+        Args:
+            lhs_table (np.ndarray): Samples of the scenario.
+            checkpoint (Optional[Checkpoint]): Checkpoint of the target calculation. Without an
+                existing checkpoint file, the samples are saved before solving, so that an
+                interrupted run can be resumed with them. The checkpoint is removed once the results
+                are saved.
+            executor (Optional[ParallelExecutor]): Executor of the worker processes, see
+                OutputGenerator.
+        """
         print(
             f"\n Simulation for {self.n_samples} samples ({self.sim_object.get_filename(self.variable_params)})"
         )
         print(f"Batch size: {self.batch_size}\n")
 
-        output_generator = OutputGenerator(sim_object=self.sim_object)
-        sim_outputs = output_generator.get_output(lhs_table=lhs_table)
+        if checkpoint is not None and not checkpoint.exists():
+            self.save_samples(lhs_table=lhs_table)
+        output_generator = OutputGenerator(sim_object=self.sim_object, executor=executor)
+        sim_outputs = output_generator.get_output(lhs_table=lhs_table, checkpoint=checkpoint)
+        self.save_sim_output(lhs_table=lhs_table, sim_outputs=sim_outputs)
+        if checkpoint is not None:
+            checkpoint.remove()
+
+    def get_sim_output_streamed(self, executor: Optional[ParallelExecutor] = None):
+        """
+        Run the simulations of the scenario in chunks of the samples, given by the chunk_size key of
+        the sampling config. The LHS table is generated out of core, see get_lhs_chunks, and the
+        samples and the values of the targets of every chunk are appended to the saved results as
+        soon as the chunk is solved, so neither is held in memory for all the samples, and the
+        chunks solved before an interruption are kept. With an executor kept open for the run, see
+        ParallelExecutor, the worker processes solve all the chunks.
+        """
+        sim_object = self.sim_object
+        chunk_size = sim_object.chunk_size
+        print(
+            f"\n Simulation for {self.n_samples} samples ({sim_object.get_filename(self.variable_params)})"
+        )
+        print(f"Batch size: {self.batch_size}, chunk size: {chunk_size}\n")
+
+        first_start = self.get_streamed_start() if sim_object.resume else 0
+        if first_start > 0:
+            print(f" Resuming from sample {first_start}")
+        output_generator = OutputGenerator(sim_object=sim_object, executor=executor)
+        for start, lhs_chunk in self.get_lhs_chunks(chunk_size=chunk_size, start=first_start):
+            print(f" Chunk of samples {start} - {start + lhs_chunk.shape[0]} / {self.n_samples}")
+            lhs_chunk = self.transform_samples(lhs_chunk)
+            sim_outputs = output_generator.get_output(lhs_table=lhs_chunk)
+            self.save_sim_output(lhs_table=lhs_chunk, sim_outputs=sim_outputs, start=start)
+        path = self.get_lhs_table_path()
+        os.remove(path)
+        os.remove(os.path.splitext(path)[0] + ".json")
+
+    def save_sim_output(self, lhs_table: np.ndarray, sim_outputs: dict, start: int = None):
+        """
+        Save the samples and the values of the target variables of the scenario.
+
+        Args:
+            lhs_table (np.ndarray): Samples of the scenario.
+            sim_outputs (dict): Values of the target variables of the samples, by target name.
+            start (int): Index of the first sample, if only a chunk of the samples is saved.
+        """
         if sim_outputs == {}:
             raise Exception("No output was produced by OutputGenerator instance!")
 
         # Save samples, target values
         filename = self.sim_object.get_filename(self.variable_params)
-        self.save_output(output=lhs_table, output_name="lhs", filename=filename)
+        self.save_samples(lhs_table=lhs_table, start=start)
         for target_var, sim_output in sim_outputs.items():
             self.save_output(
                 output=sim_output.cpu(),
                 output_name="simulations",
                 filename=filename + f"_{target_var}",
+                metadata={"target": target_var, "variable_params": self.variable_params},
+                start=start,
             )
 
-    def save_output(self, output, output_name: str, filename: str):
-        folder_name = self.sim_object.folder_name
-        os.makedirs(folder_name, exist_ok=True)
+    def save_samples(self, lhs_table: np.ndarray, start: int = None):
+        """
+        Save the samples of the scenario, or a chunk of them starting at start.
+        """
+        self.save_output(
+            output=lhs_table,
+            output_name="lhs",
+            filename=self.sim_object.get_filename(self.variable_params),
+            metadata={"columns": self.get_column_labels(), "variable_params": self.variable_params},
+            start=start,
+        )
+
+    def get_column_labels(self) -> list:
+        """
+        Get the labels of the columns of the LHS table, the names of the sampled parameters, with
+        the index of the age group appended for the age specific ones.
+        """
+        labels = []
+        for param, bounds in getattr(self, "lhs_bounds_dict", {}).items():
+            if len(bounds.shape) == 2:
+                labels += [f"{param}_{idx}" for idx in range(bounds.shape[1])]
+            else:
+                labels.append(param)
+        return labels
 
-        dirname = os.path.join(folder_name, output_name)
-        filename = os.path.join(dirname, f"{output_name}_{filename}")
-        os.makedirs(dirname, exist_ok=True)
-        np.savetxt(fname=filename + ".csv", X=output)
+    def save_output(
+        self, output, output_name: str, filename: str, metadata: dict = None, start: int = None
+    ):
+        """
+        Save an output of the scenario. With start given, the output holds the rows from start of
+        an output of n_samples rows, see ResultsStore.append.
+        """
+        results_store = self.sim_object.results_store
+        if start is None:
+            results_store.save(
+                output=output, output_name=output_name, filename=filename, metadata=metadata
+            )
+        else:
+            results_store.append(
+                output=output,
+                output_name=output_name,
+                filename=filename,
+                start=start,
+                n_rows=self.n_samples,
+                metadata=metadata,
+            )
 
 
 def create_latin_table(n_of_samples, lower, upper):
@@ -2,7 +2,8 @@ from abc import ABC
 
 import torch
 
-from emsa.model import EpidemicModelBase
+from emsa.model import EpidemicModelBase, LayeredMatrix, SparseMatrix
+from emsa.model.schedule import SegmentedODE, get_schedules
 
 
 def get_params_col_idx(sampled_params_boundaries: dict):
@@ -21,6 +22,30 @@ def get_lhs_dict(params: list, lhs_table: torch.Tensor, params_col_idx: dict) ->
     return {param: lhs_table[:, params_col_idx[param]] for param in params}
 
 
+def split_scenario_columns(samples: torch.Tensor, scenario_cols: dict):
+    """
+    Split the samples into the sampled columns and the parameters of the scenarios, which are
+    appended to the samples when the scenarios are solved in a single batch, see
+    SimulationBase.run_batched_scenarios.
+
+    Args:
+        samples (torch.Tensor): Samples of shape (n_samples, n_cols).
+        scenario_cols (dict): Columns of the scenario parameters, by parameter name.
+
+    Returns:
+        tuple: The sampled columns, and the dictionary of the scenario parameters of the samples.
+    """
+    if not scenario_cols:
+        return samples, {}
+    n_sampled_cols = min(
+        col if isinstance(col, int) else col.start for col in scenario_cols.values()
+    )
+    scenario_lhs = get_lhs_dict(
+        params=scenario_cols, lhs_table=samples, params_col_idx=scenario_cols
+    )
+    return samples[:, :n_sampled_cols], scenario_lhs
+
+
 class SensitivityModelBase(EpidemicModelBase, ABC):
     """
     Base class for implementing epidemic models with the capacity
@@ -28,20 +53,114 @@ class SensitivityModelBase(EpidemicModelBase, ABC):
     """
 
     def __init__(self, sim_object):
-        super().__init__(data=sim_object.data, model_struct=sim_object.model_struct)
+        super().__init__(
+            data=sim_object.data,
+            model_struct=sim_object.model_struct,
+            ode_engine=sim_object.ode_engine,
+            solver_config=sim_object.solver_config,
+        )
         self.sim_object = sim_object
         self.test = sim_object.test
+        self.sparse = sim_object.sparse_matrices
+        # Piecewise-constant interventions by name, either contact_scale or a model parameter
+        self.schedules = get_schedules(sim_object.schedules, device=self.device)
+        for name in self.schedules:
+            if name not in self.schedule_names:
+                raise ValueError(f"Unknown schedule {name}, choose from {self.schedule_names}")
+
+    @property
+    def schedule_names(self) -> list:
+        """
+        Names of the schedules the model supports.
+        """
+        return ["contact_scale"] + list(self.ps)
+
+    def format_matrix(self, matrix: torch.Tensor):
+        """
+        Convert the matrix stack to the storage format given in the sampling config. Matrices shared
+        by all samples are left dense, since their size doesn't depend on the batch size.
+
+        Args:
+            matrix (torch.Tensor): Dense matrix of shape (n_eq, n_eq) or (n_samples, n_eq, n_eq).
+
+        Returns:
+            The matrix stack as a SparseMatrix if sparse storage is enabled, otherwise unchanged.
+        """
+        if self.sparse and torch.is_tensor(matrix) and matrix.dim() == 3:
+            return SparseMatrix.from_dense(matrix)
+        return matrix
 
     def get_basic_ode(self):
+        """
+        Get the right-hand side of the basic ODE, or a SegmentedODE if the model has schedules.
+        """
+        if self.schedules:
+            return SegmentedODE(schedules=self.schedules, make_odefun=self.get_segment_ode)
+        return self.get_segment_ode(values={})
+
+    def get_segment_ode(self, values: dict):
+        """
+        Get the right-hand side of the basic ODE on a segment of the schedules. The transmission
+        term is scaled by contact_scale, and the matrices are generated again with the values of
+        the scheduled parameters. Without values, the current matrices of the model are used.
+
+        Args:
+            values (dict): Values of the schedules on the segment, with a leading sample dimension.
+
+        Returns:
+            Callable: The right-hand side.
+        """
+        contact_scale = values.get("contact_scale")
+        param_values = {name: value for name, value in values.items() if name in self.ps}
+        if self.ode_engine != "dense":
+            if contact_scale is not None or param_values:
+                raise ValueError("Contact and parameter schedules require the dense ODE engine")
+            return self.get_engine_ode()
+        matrices = self.get_segment_matrices(param_values) if param_values else None
         A_mul = self.get_mul_method(self.A)
         T_mul = self.get_mul_method(self.T)
         B_mul = self.get_mul_method(self.B)
+        if matrices is not None:
+            A_mul, T_mul, B_mul = [self.get_mul_method(matrix) for matrix in matrices]
 
         def odefun(t, y):
-            return torch.mul(A_mul(y, self.A), T_mul(y, self.T)) + B_mul(y, self.B)
+            # The matrices are looked up at every call, since the solver may restrict them
+            A, T, B = matrices or (self.A, self.T, self.B)
+            transmission = torch.mul(A_mul(y, A), T_mul(y, T))
+            if contact_scale is not None:
+                transmission = transmission * contact_scale.reshape(-1, 1)
+            return transmission + B_mul(y, B)
 
         return odefun
 
+    def get_segment_matrices(self, param_values: dict):
+        """
+        Generate the matrices A, T and B with the scheduled parameters overriding the sampled
+        parameters of the current batch.
+
+        Args:
+            param_values (dict): Values of the scheduled parameters, with a leading sample dimension.
+
+        Returns:
+            tuple: The matrices A, T and B, shared by the samples if none of the values differ.
+        """
+        lhs_dict = {**(self.batch_params or {}), **param_values}
+        n_samples = max(value.shape[0] for value in lhs_dict.values())
+        if self.batch_cm is not None and self.batch_cm.dim() == 3:
+            n_samples = max(n_samples, self.batch_cm.shape[0])
+        lhs_dict = {
+            param: value.expand(n_samples, *value.shape[1:]) for param, value in lhs_dict.items()
+        }
+        matrix_generator = self.matrix_generator
+        matrices = [
+            matrix_generator.get_A(lhs_dict=lhs_dict),
+            matrix_generator.get_T(cm=self.batch_cm, lhs_dict=lhs_dict),
+            matrix_generator.get_B(lhs_dict=lhs_dict),
+        ]
+        if n_samples == 1:
+            return tuple(matrix[0] for matrix in matrices)
+        return tuple(self.format_matrix(matrix) for matrix in matrices)
+
     @staticmethod
     def get_mul_method(tensor: torch.Tensor):
         def mul_by_2d(y, tensor):
@@ -50,35 +169,69 @@ class SensitivityModelBase(EpidemicModelBase, ABC):
         def mul_by_3d(y, tensor):
             return torch.einsum("ij,ijk->ik", y, tensor)
 
+        # SparseMatrix and LayeredMatrix handle both single matrices and stacks in y @ tensor
+        if isinstance(tensor, (SparseMatrix, LayeredMatrix)):
+            return mul_by_2d
         return mul_by_2d if len(tensor.size()) < 3 else mul_by_3d
 
-    def get_matrix_from_lhs(self, lhs_dict: dict, matrix_name: str):
-        n_eq = self.n_eq
+    def get_matrix_from_lhs(self, lhs_dict: dict, matrix_name: str, chunk_size: int = 64):
+        """
+        Generate the matrix stack of shape (n_samples, n_eq, n_eq) corresponding to the sampled
+        parameters in a single batched pass of the matrix generator.
+
+        With sparse storage, the stack is generated in chunks of chunk_size samples, so that the
+        dense intermediate matrices never have to be held for the whole batch.
+
+        Args:
+            lhs_dict (dict): Sampled parameters, each with a leading sample dimension.
+            matrix_name (str): Name of the matrix to generate.
+            chunk_size (int): Number of samples generated at once with sparse storage.
+
+        Returns:
+            The generated matrices.
+        """
+        generate_matrix = self.matrix_generator.generate_matrix
+        if not self.sparse:
+            return generate_matrix(matrix_name=matrix_name, lhs_dict=lhs_dict)
         n_samples = next(iter(lhs_dict.values())).shape[0]
-        mtx = torch.zeros((n_samples, n_eq, n_eq)).to(self.device)
-        ps_original = self.matrix_generator.ps.copy()
-        for idx in range(n_samples):
-            # Select idx. value from lhs table for each parameter
-            row_dict = {
-                key: value[idx] if len(value.size()) < 2 else value[idx, :]
-                for key, value in lhs_dict.items()
-            }
-            self.matrix_generator.ps.update(row_dict)
-
-            mtx[idx, :, :] = self.matrix_generator.generate_matrix(matrix_name)
-        self.matrix_generator.ps = ps_original
-        return mtx
+        chunks = [slice(idx, idx + chunk_size) for idx in range(0, n_samples, chunk_size)]
+        return SparseMatrix.cat(
+            [
+                SparseMatrix.from_dense(
+                    generate_matrix(
+                        matrix_name=matrix_name,
+                        lhs_dict={param: value[chunk] for param, value in lhs_dict.items()},
+                    )
+                )
+                for chunk in chunks
+            ]
+        )
 
     def get_initial_values(self):
         return self.get_initial_values_from_dict(self.sim_object.init_vals)
 
+    def split_samples(self, samples: torch.Tensor):
+        """
+        Split the samples into the sampled columns and the parameters of the scenarios, see
+        split_scenario_columns.
+        """
+        return split_scenario_columns(samples=samples, scenario_cols=self.sim_object.scenario_cols)
+
     def generate_3D_matrices(self, samples: torch.Tensor):
+        self.matrices_loaded = False
         spb = self.sim_object.sampled_params_boundaries
         # If the matrix containing the analysed parameter isn't part of the basic representation,
         # the 3D version has to be generated manually. If a matrix isn't used, the desired effect
         # needs to be incorporated somehow else in the odefun used in the solver.
         if spb is None:
             return
+        samples, scenario_lhs = self.split_samples(samples)
+        pci = get_params_col_idx(sampled_params_boundaries=spb)
+        # The parameters of the scenarios are overridden by the sampled ones
+        sampled = {
+            **scenario_lhs,
+            **get_lhs_dict(params=spb, lhs_table=samples, params_col_idx=pci),
+        }
         # Params in B
         trans_params = [
             param
@@ -87,12 +240,12 @@ class SensitivityModelBase(EpidemicModelBase, ABC):
             for param in trans.get("params")
         ]
         trans_rates = [self.state_data[trans["source"]]["rate"] for trans in self.trans_data]
-        linear_params = [param for param in spb if param in trans_rates + trans_params]
+        linear_params = [param for param in sampled if param in trans_rates + trans_params]
         # Params in T_1
         susc_params = [
             param for tms_rule in self.tms_rules for param in tms_rule.get("susc_params", [])
         ]
-        transmission_params_left = [param for param in spb if param in susc_params]
+        transmission_params_left = [param for param in sampled if param in susc_params]
         # Params in T_2
         actor_params = [
             param for tms_rule in self.tms_rules for param in tms_rule["actors-params"].values()
@@ -100,23 +253,32 @@ class SensitivityModelBase(EpidemicModelBase, ABC):
         inf_params = actor_params + [
             param for tms_rule in self.tms_rules for param in tms_rule.get("infection_params", [])
         ]
-        transmission_params_right = [param for param in spb if param in inf_params + ["beta"]]
+        transmission_params_right = [param for param in sampled if param in inf_params + ["beta"]]
+        # Params scaling the contact layers
+        layer_params = [param for param in sampled if param in self.layer_params]
 
-        pci = get_params_col_idx(sampled_params_boundaries=spb)
-
-        tpl_lhs = get_lhs_dict(transmission_params_left, samples, pci)
-        tpr_lhs = get_lhs_dict(transmission_params_right, samples, pci)
-        lp_lhs = get_lhs_dict(linear_params, samples, pci)
+        tpl_lhs = {param: sampled[param] for param in transmission_params_left}
+        tpr_lhs = {param: sampled[param] for param in transmission_params_right}
+        lp_lhs = {param: sampled[param] for param in linear_params}
+        layer_lhs = {param: sampled[param] for param in layer_params}
+        self.batch_params = {**tpl_lhs, **tpr_lhs, **lp_lhs, **layer_lhs}
         self.A = (
             self.get_matrix_from_lhs(tpl_lhs, "A")
             if len(tpl_lhs) > 0
             else self.matrix_generator.get_A()
         )
-        self.T = (
-            self.get_matrix_from_lhs(tpr_lhs, "T")
-            if len(tpr_lhs) > 0
-            else self.matrix_generator.get_T()
-        )
+        if self.has_layer_weights(layer_lhs):
+            # Only the weights of the precomputed layers of T differ between the samples
+            layer_weights = self.get_layer_weights(layer_lhs).expand(samples.shape[0], -1)
+            self.T = self.get_layered_T(layer_weights=layer_weights, lhs_dict=tpr_lhs)
+            self.batch_cm = self.get_layered_cm(layer_weights)
+        else:
+            self.batch_cm = None
+            self.T = (
+                self.get_matrix_from_lhs(tpr_lhs, "T")
+                if len(tpr_lhs) > 0
+                else self.matrix_generator.get_T()
+            )
         self.B = (
             self.get_matrix_from_lhs(lp_lhs, "B")
             if len(lp_lhs) > 0
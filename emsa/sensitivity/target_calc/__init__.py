@@ -1,3 +1,7 @@
+from .active_set import ActiveSet
+from .checkpoint import Checkpoint
+from .target_reducer import TargetReducer
 from .sol_based_target_calc import TargetCalc
+from .parallel_executor import ParallelExecutor
 from .output_generator import OutputGenerator
 from .r0_calculator_lhs import R0CalculatorLHS
@@ -0,0 +1,68 @@
+from typing import Iterator
+
+import torch
+
+
+class ActiveSet:
+    """
+    Unfinished samples of TargetCalc, with the states to continue their simulations from.
+
+    The indices of the samples in the LHS table and their states are stored compactly, in the
+    same order. The batches of a time window are consecutive slices of them, after solving a
+    batch its states and finished samples are saved with update, and at the end of the window
+    the finished samples are dropped with compact. Every operation is a tensor operation over
+    the active samples, so the bookkeeping of a window costs O(n_active).
+
+    Attributes:
+        indices (torch.Tensor): Indices of the active samples in the LHS table.
+        y (torch.Tensor): States of the active samples at the end of the last time window.
+        keep (torch.BoolTensor): Whether the active samples are still unfinished after the
+            batches of the current time window solved so far.
+    """
+
+    def __init__(self, y0: torch.Tensor):
+        self.indices = torch.arange(y0.shape[0], device=y0.device)
+        self.y = y0.clone()
+        self.keep = torch.ones(y0.shape[0], dtype=torch.bool, device=y0.device)
+
+    @classmethod
+    def from_state(cls, indices: torch.Tensor, y: torch.Tensor) -> "ActiveSet":
+        """
+        Restore the active samples with the given indices and states, e.g. from a checkpoint saved
+        at the end of a time window.
+        """
+        active = cls(y0=y)
+        active.indices = indices.to(y.device)
+        return active
+
+    def __len__(self) -> int:
+        return self.indices.numel()
+
+    def batches(self, batch_size: int) -> Iterator[slice]:
+        """
+        Iterate over the slices of the active samples forming the batches of a time window.
+        """
+        for batch_idx in range(0, len(self), batch_size):
+            yield slice(batch_idx, batch_idx + batch_size)
+
+    def update(self, batch: slice, y: torch.Tensor, finished: torch.BoolTensor) -> None:
+        """
+        Save the last states and the finished samples of a solved batch.
+
+        Args:
+            batch (slice): Slice of the active samples forming the batch.
+            y (torch.Tensor): Last states of the samples of the batch.
+            finished (torch.BoolTensor): Whether the samples of the batch are finished.
+        """
+        self.y[batch] = y
+        self.keep[batch] = ~finished
+
+    def compact(self) -> None:
+        """
+        Drop the finished samples at the end of a time window.
+        """
+        if self.keep.all():
+            return
+        self.indices = self.indices[self.keep]
+        self.y = self.y[self.keep]
+        self.keep = torch.ones_like(self.indices, dtype=torch.bool)
@@ -0,0 +1,73 @@
+import os
+from typing import Any, Dict, Optional
+
+import torch
+
+
+class Checkpoint:
+    """
+    File holding the state of a TargetCalc run at the end of a time window, from which an
+    interrupted run continues instead of starting over.
+
+    The state, i.e. the time window, the indices and the states of the unfinished samples, the
+    finished masks and the partial outputs of the targets, is saved together with the samples and
+    the hash of the configuration. It is only loaded for the same samples and configuration. The
+    file is written to a temporary file first and then renamed, so an interruption while saving
+    leaves the previous checkpoint intact.
+
+    Attributes:
+        path (str): Path of the checkpoint file.
+        every (int): Number of time windows between two saves.
+        config_hash (Optional[str]): Hash of the configuration of the run, see get_config_hash.
+    """
+
+    def __init__(self, path: str, every: int = 1, config_hash: Optional[str] = None):
+        if every < 1:
+            raise ValueError("The number of time windows between checkpoints has to be positive")
+        self.path = path
+        self.every = every
+        self.config_hash = config_hash
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def save(self, state: Dict[str, Any]) -> None:
+        """
+        Save the state of the run, replacing the previous checkpoint.
+
+        Args:
+            state (Dict[str, Any]): State of the run, tensors on the CPU, numbers and strings, in
+                nested dictionaries and lists.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        torch.save({**state, "config_hash": self.config_hash}, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def load(self, lhs_table: torch.Tensor, device=None) -> Dict[str, Any]:
+        """
+        Load the state of the run with the given samples.
+
+        Args:
+            lhs_table (torch.Tensor): Samples of the run.
+            device: Device the tensors of the state are moved to.
+
+        Returns:
+            Dict[str, Any]: The saved state.
+
+        Raises:
+            ValueError: If the checkpoint was saved with another configuration or other samples.
+        """
+        state = torch.load(self.path, map_location=device, weights_only=True)
+        if state["config_hash"] != self.config_hash:
+            raise ValueError(
+                f"The checkpoint {self.path} was saved with another configuration "
+                f"({state['config_hash']}, expected {self.config_hash})"
+            )
+        if not torch.equal(state["lhs_table"], lhs_table.to(state["lhs_table"].device)):
+            raise ValueError(f"The checkpoint {self.path} was saved with other samples")
+        return state
+
+    def remove(self) -> None:
+        if self.exists():
+            os.remove(self.path)
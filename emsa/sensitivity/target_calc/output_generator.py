@@ -1,20 +1,58 @@
 import torch
 import numpy as np
 
+from .checkpoint import Checkpoint
+from .parallel_executor import ParallelExecutor, get_parallel_config
 from .r0_calculator_lhs import R0CalculatorLHS
 from .sol_based_target_calc import TargetCalc
-from typing import Dict
+from typing import Dict, Optional
 
 from emsa.utils.simulation_base import SimulationBase
 
 
 class OutputGenerator:
-    def __init__(self, sim_object: SimulationBase):
+    def __init__(self, sim_object: SimulationBase, executor: Optional[ParallelExecutor] = None):
+        """
+        Args:
+            sim_object (SimulationBase): The simulation object.
+            executor (Optional[ParallelExecutor]): Executor of the worker processes, kept by the
+                caller for several calls of get_output, see ParallelExecutor. By default, a new
+                one is created for every call, if more than one worker is configured.
+        """
         self.batch_size = sim_object.batch_size
         self.sim_object = sim_object
+        self.parallel_config = get_parallel_config(sim_object.parallel_config)
+        self.executor = executor
 
-    def get_output(self, lhs_table: np.ndarray) -> Dict[str, torch.Tensor]:
-        lhs = torch.from_numpy(lhs_table).float().to(self.sim_object.device)
+    def get_output(
+        self, lhs_table: np.ndarray, checkpoint: Optional[Checkpoint] = None
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Get the values of the target variables for the samples, either in this process, or split
+        between worker processes if more than one worker is configured, see ParallelExecutor.
+
+        Args:
+            lhs_table (np.ndarray): Samples of shape (n_samples, n_cols).
+            checkpoint (Optional[Checkpoint]): Checkpoint of the solution based targets, see
+                TargetCalc.get_output. Only supported without worker processes.
+
+        Raises:
+            ValueError: If a checkpoint is given with more than one worker.
+        """
+        if self.parallel_config["n_workers"] > 1:
+            if checkpoint is not None:
+                raise ValueError("Checkpoints are not supported with more than one worker")
+            executor = self.executor or ParallelExecutor(config=self.parallel_config)
+            output = executor.map_shards(
+                func=_get_shard_output, sim_object=self.sim_object, samples=lhs_table
+            )
+            return {key: value.to(self.sim_object.device) for key, value in output.items()}
+        return self.get_serial_output(lhs_table=lhs_table, checkpoint=checkpoint)
+
+    def get_serial_output(
+        self, lhs_table: np.ndarray, checkpoint: Optional[Checkpoint] = None
+    ) -> Dict[str, torch.Tensor]:
+        lhs = torch.as_tensor(lhs_table).float().to(self.sim_object.device)
         targets = self.sim_object.target_vars
         output = {}
         target_endings = [target[-3:] for target in targets if target != "r0"]
@@ -25,10 +63,22 @@ class OutputGenerator:
                 targets=targets,
                 config=self.sim_object.target_calc_config,
             )
-            sol_based_output = target_calc.get_output(lhs_table=lhs, batch_size=self.batch_size)
+            sol_based_output = target_calc.get_output(
+                lhs_table=lhs, batch_size=self.batch_size, checkpoint=checkpoint
+            )
             output.update(sol_based_output)
 
         if "r0" in targets:
             r0calc = R0CalculatorLHS(self.sim_object)
             output["r0"] = r0calc.get_output(lhs_table=lhs)
         return output
+
+
+def _get_shard_output(
+    sim_object: SimulationBase, lhs_table: torch.Tensor
+) -> Dict[str, torch.Tensor]:
+    """
+    Get the values of the target variables for a shard of the samples in a worker process.
+    """
+    output = OutputGenerator(sim_object=sim_object).get_serial_output(lhs_table=lhs_table)
+    return {key: value.cpu() for key, value in output.items()}
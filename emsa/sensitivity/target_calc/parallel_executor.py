@@ -0,0 +1,162 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+from emsa.utils.shared_memory import share_tensors
+
+start_methods = ["spawn", "forkserver", "fork"]
+default_parallel_config = {"n_workers": 1, "threads_per_worker": None, "start_method": "spawn"}
+
+
+def get_parallel_config(parallel_config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Complete the configuration of the parallel execution with the default values, see
+    default_parallel_config.
+
+    With n_workers > 1, the samples are split into as many shards, which are solved in separate
+    worker processes, each using threads_per_worker threads for the torch operations. By default,
+    the cores of the machine are divided evenly between the workers.
+
+    Raises:
+        ValueError: If the number of workers isn't positive, or the start method is unknown.
+    """
+    parallel_config = {**default_parallel_config, **(parallel_config or {})}
+    if parallel_config["n_workers"] < 1:
+        raise ValueError("The number of workers has to be positive")
+    if parallel_config["start_method"] not in start_methods:
+        raise ValueError(
+            f"Unknown start method {parallel_config['start_method']}, choose from {start_methods}"
+        )
+    return parallel_config
+
+
+# Simulation object of a worker process, received once when the worker starts
+_worker_sim_object = None
+
+
+def _init_worker(n_threads: int, sim_object) -> None:
+    """
+    Pin the number of threads of the torch operations in a worker process, so that the workers
+    don't compete for the same cores, and keep the simulation object of the worker.
+    """
+    global _worker_sim_object
+    torch.set_num_threads(n_threads)
+    _worker_sim_object = sim_object
+
+
+def _run_shard(func: Callable, samples: torch.Tensor) -> Dict[str, torch.Tensor]:
+    return func(_worker_sim_object, samples)
+
+
+class ParallelExecutor:
+    """
+    Runs a function of the simulation object on shards of the samples in a pool of worker
+    processes, and merges the outputs back in sample order.
+
+    The shards are contiguous blocks of the samples, and the outputs are concatenated in the order
+    of the shards, so the result doesn't depend on the order in which the workers finish.
+
+    The tensors of the simulation object and the samples are moved to shared memory, see
+    share_tensors, and the workers attach to them without copying. The simulation object is sent
+    to every worker once, when it starts, and only the shards of the samples with the tasks. The
+    other attributes of the simulation object are copied, so the function must not rely on its
+    changes being seen by the calling process.
+
+    Used as a context manager, the pool of workers is started by the first call of map_shards and
+    kept until the end of the block, so the workers aren't started again for every chunk of the
+    samples. The workers keep the simulation object they were started with, so it must not be
+    changed within the block, other than in place changes of its shared tensors. Otherwise, a
+    pool is started and shut down by every call of map_shards.
+
+    Attributes:
+        config (Dict[str, Any]): Configuration of the parallel execution, see get_parallel_config.
+        n_workers (int): Number of worker processes.
+        threads_per_worker (int): Number of threads of the torch operations in every worker.
+    """
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        self.config = get_parallel_config(config)
+        self.n_workers = self.config["n_workers"]
+        self.threads_per_worker = self.config["threads_per_worker"] or max(
+            1, (os.cpu_count() or 1) // self.n_workers
+        )
+        self._pool = None
+        self._pool_sim_object = None
+        self._keep_pool = False
+
+    def __enter__(self) -> "ParallelExecutor":
+        self._keep_pool = True
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._keep_pool = False
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        """
+        Shut down the pool of workers, if started.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._pool = None
+        self._pool_sim_object = None
+
+    def get_pool(self, sim_object) -> ProcessPoolExecutor:
+        """
+        Get the pool of workers started with the simulation object, starting it if needed. A pool
+        started with another simulation object is shut down first.
+        """
+        if self._pool is not None and self._pool_sim_object is not sim_object:
+            self.shutdown()
+        if self._pool is None:
+            share_tensors(sim_object)
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                mp_context=multiprocessing.get_context(self.config["start_method"]),
+                initializer=_init_worker,
+                initargs=(self.threads_per_worker, sim_object),
+            )
+            self._pool_sim_object = sim_object
+        return self._pool
+
+    def get_shards(self, n_samples: int) -> List[slice]:
+        """
+        Split the samples into at most n_workers contiguous shards of nearly equal size.
+        """
+        n_shards = max(1, min(self.n_workers, n_samples))
+        bounds = [n_samples * idx // n_shards for idx in range(n_shards + 1)]
+        return [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def map_shards(
+        self,
+        func: Callable[[Any, torch.Tensor], Dict[str, torch.Tensor]],
+        sim_object,
+        samples,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Evaluate func(sim_object, shard) on every shard of the samples in the worker processes.
+
+        Args:
+            func (Callable): Function defined at the top level of a module, so that the workers can
+                import it, returning a dictionary of tensors with a leading sample dimension.
+            sim_object: Simulation object, sent to every worker.
+            samples: Samples of shape (n_samples, n_cols), given as an array or a tensor, and
+                passed to func as a tensor.
+
+        Returns:
+            Dict[str, torch.Tensor]: The outputs of the shards concatenated in sample order, on
+            the CPU.
+        """
+        samples = torch.as_tensor(samples).cpu().share_memory_()
+        shards = self.get_shards(samples.shape[0])
+        pool = self.get_pool(sim_object)
+        try:
+            futures = [pool.submit(_run_shard, func, samples[shard]) for shard in shards]
+            outputs = [future.result() for future in futures]
+        finally:
+            if not self._keep_pool:
+                self.shutdown()
+        return {key: torch.cat([output[key].cpu() for output in outputs]) for key in outputs[0]}
@@ -2,7 +2,7 @@ import torch
 from tqdm import tqdm
 
 from emsa.model import R0Generator
-from emsa.sensitivity import get_params_col_idx, get_lhs_dict
+from emsa.sensitivity import get_params_col_idx, get_lhs_dict, split_scenario_columns
 from emsa.utils import SimulationBase
 
 
@@ -37,22 +37,42 @@ class R0CalculatorLHS:
             raise ValueError(
                 "Sampled parameters boundaries not specified, automatic R0 generation isn't possible"
             )
+        lhs_table, scenario_lhs = split_scenario_columns(
+            samples=lhs_table, scenario_cols=sim_object.scenario_cols
+        )
         pci = get_params_col_idx(sampled_params_boundaries=spb)
-        lhs_dict = get_lhs_dict(params=spb.keys(), lhs_table=lhs_table, params_col_idx=pci)
-        r0gen = R0Generator(sim_object.data, sim_object.model_struct)
+        lhs_dict = {
+            **scenario_lhs,
+            **get_lhs_dict(params=spb.keys(), lhs_table=lhs_table, params_col_idx=pci),
+        }
+        r0gen = R0Generator(
+            sim_object.data, sim_object.model_struct, eig_config=sim_object.r0_config
+        )
+        batch_size = sim_object.batch_size
         r0s = []
         print(f"Calculating R0 for {n_samples} samples")
-        for idx in tqdm(range(n_samples)):
-            # Select idx. value from lhs table for each parameter
-            row_dict = {
-                key: value[idx] if len(value.size()) < 2 else value[idx, :]
-                for key, value in lhs_dict.items()
-            }
-            r0gen.params.update(row_dict)
-            r0 = sim_object.params["beta"] * r0gen.get_eig_val(
-                contact_mtx=sim_object.cm,
+        # The NGMs of a batch are built and decomposed at once
+        for batch_idx in tqdm(range(0, n_samples, batch_size)):
+            batch_slice = slice(batch_idx, batch_idx + batch_size)
+            batch_dict = {key: value[batch_slice] for key, value in lhs_dict.items()}
+            eig_vals = r0gen.get_eig_vals(
+                contact_mtx=self.get_contact_matrices(batch_dict),
                 susceptibles=sim_object.susceptibles.reshape(1, -1),
                 population=sim_object.population,
+                lhs_dict=batch_dict,
             )
-            r0s.append(r0)
-        return torch.tensor(r0s, device=sim_object.device)
+            beta = batch_dict.get("beta", sim_object.params["beta"])
+            r0s.append(torch.as_tensor(beta, device=eig_vals.device) * eig_vals)
+        return torch.cat(r0s).to(sim_object.device)
+
+    def get_contact_matrices(self, batch_dict: dict) -> torch.Tensor:
+        """
+        Get the contact matrices of a batch of samples. If the contact layers of the model are
+        scaled by the parameters contact_<layer>, sampled or set in the model parameters, these are
+        the weighted sums of the layers, of shape (n_samples | 1, n_age, n_age), as in the ODE, see
+        SensitivityModelBase.generate_3D_matrices. Otherwise, it is the contact matrix.
+        """
+        model = self.sim_object.model
+        if model is None or not model.has_layer_weights(batch_dict):
+            return self.sim_object.cm
+        return model.get_layered_cm(model.get_layer_weights(batch_dict))
@@ -2,8 +2,12 @@ import math
 from time import time
 
 import torch
-from typing import Dict
+from typing import Any, Dict, List, Optional, Tuple
+from emsa.model.matrix_cache import MatrixCache, select_samples
 from emsa.sensitivity.sensitivity_model_base import SensitivityModelBase
+from .active_set import ActiveSet
+from .checkpoint import Checkpoint
+from .target_reducer import TargetReducer
 
 
 class TargetCalc:
@@ -15,21 +19,44 @@ class TargetCalc:
         self.tlim_ini = config["tlim_ini"]
         self.tlim_final = config["tlim_final"]
         self.tdelta = config["tdelta"]
+        # Accumulate the targets within the integration loop instead of storing the trajectories
+        self.streaming = config.get("streaming", False)
+        # Stop integrating the finished samples within the time windows, implies streaming
+        self.early_stopping = config.get("early_stopping", False)
+        # Reuse the per-sample matrices of the unfinished samples in the later time windows
+        self.cache_matrices = config.get("cache_matrices", False)
+        self.matrix_cache = None
 
         self.max_targets_finished: Dict[str, torch.Tensor] = {}
         self.sup_finished = None
         self.max_targets_output: Dict[str, torch.Tensor] = {}
         self.sup_targets_output: Dict[str, torch.Tensor] = {}
         self.finished = None
+        # Per-sample statistics of the solver summed over the time windows, e.g. n_steps
+        self.solver_stats: Dict[str, torch.Tensor] = {}
 
-    def get_output(self, lhs_table: torch.Tensor, batch_size: int) -> Dict[str, torch.Tensor]:
+    def get_output(
+        self, lhs_table: torch.Tensor, batch_size: int, checkpoint: Optional[Checkpoint] = None
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Get the values of the targets for the samples, solving the unfinished samples in time
+        windows of increasing length until all of them are finished or tlim_final is reached.
+
+        Args:
+            lhs_table (torch.Tensor): Samples of shape (n_samples, n_cols).
+            batch_size (int): Number of samples solved at once.
+            checkpoint (Optional[Checkpoint]): Checkpoint the state of the run is saved to at the
+                end of every checkpoint.every time windows. If the file exists, the run continues
+                from the saved state instead of starting over.
+
+        Returns:
+            Dict[str, torch.Tensor]: The values of the targets by name.
+        """
         device = self.model.device
         model = self.model
 
         n_samples = lhs_table.shape[0]
-        self.finished = torch.zeros(n_samples, dtype=torch.bool, device=self.model.device)
-
-        indices = torch.IntTensor(range(0, n_samples)).to(device)
+        self.finished = torch.zeros(n_samples, dtype=torch.bool, device=device)
 
         self.max_targets_output = {
             comp: torch.zeros(n_samples, device=device) for comp in self.max_targets
@@ -38,128 +65,238 @@ class TargetCalc:
             comp: torch.zeros(n_samples, device=device) for comp in self.sup_targets
         }
         self.max_targets_finished = {
-            comp: torch.BoolTensor(range(0, n_samples)).to(device) for comp in self.max_targets
+            comp: torch.zeros(n_samples, dtype=torch.bool, device=device)
+            for comp in self.max_targets
         }
-        self.sup_finished = torch.BoolTensor(range(0, n_samples)).to(device)
+        self.sup_finished = torch.zeros(n_samples, dtype=torch.bool, device=device)
+        self.solver_stats = {}
+        self.matrix_cache = MatrixCache(n_samples, device) if self.cache_matrices else None
 
         t_limit = [0, self.tlim_ini]
-        y0 = torch.stack([model.get_initial_values()] * n_samples).to(device)
+        y0 = model.get_initial_values().to(device).expand(n_samples, -1)
+        active = ActiveSet(y0=y0)
+        n_windows = 0
+        if checkpoint is not None and checkpoint.exists():
+            state = checkpoint.load(lhs_table=lhs_table, device=device)
+            t_limit, active, n_windows = self.load_state(state)
+            print(f"\n Resuming from the checkpoint {checkpoint.path} at t={t_limit[0]}")
         time_start = time()
         # Iterate until all the eqs are solved or we reach t=5000
-        while indices.numel() and t_limit[1] < self.tlim_final:
-            t_eval = torch.stack([torch.arange(*t_limit)] * len(indices)).to(self.model.device)
-            ind_to_keep = []
-            print(f"\n Time limit: {t_limit[1]} \n" f" Samples left: {indices.numel()} \n")
-            for batch_idx in range(0, len(indices), batch_size):
-                print(
-                    f" Solving batch {int(batch_idx / batch_size) + 1} / {math.ceil(len(indices) / batch_size)}"
-                )
-                batch_slice = slice(batch_idx, batch_idx + batch_size)
-                curr_indices = indices[batch_slice]
+        while len(active) and t_limit[1] < self.tlim_final:
+            t_eval = torch.arange(*t_limit, device=device).expand(len(active), -1)
+            print(f"\n Time limit: {t_limit[1]} \n" f" Samples left: {len(active)} \n")
+            n_batches = math.ceil(len(active) / batch_size)
+            for batch_num, batch_slice in enumerate(active.batches(batch_size)):
+                print(f" Solving batch {batch_num + 1} / {n_batches}")
+                curr_indices = active.indices[batch_slice]
                 batch = lhs_table[curr_indices]
 
-                self.model.generate_3D_matrices(
-                    samples=batch
-                )  # Only relevant with automatic sampling
+                if self.matrix_cache is not None and curr_indices in self.matrix_cache:
+                    self.model.load_batch_matrices(self.matrix_cache.get(curr_indices))
+                else:
+                    self.model.generate_3D_matrices(
+                        samples=batch
+                    )  # Only relevant with automatic sampling
                 # Solve for the current batch
-                solutions = self.get_batch_solution(
-                    y0=y0[curr_indices], t_eval=t_eval[batch_slice], samples=batch
+                reducer = self.get_batch_reducer(
+                    y0=active.y[batch_slice], t_eval=t_eval[batch_slice], samples=batch
                 )
-                self.save_finished_indices(solutions=solutions, indices=curr_indices)
-                self.save_output_for_finished(solutions=solutions, indices=curr_indices)
-
-                # Save the last values and indices of unfinished simulations
-                # to use as initial values in the next iteration
-                true_finished = self.get_true_finished()
-                last_val = solutions[:, -1, :]
-                batch_unfinished_indices = curr_indices[~true_finished[curr_indices]]
-                y0[batch_unfinished_indices] = last_val[~true_finished[curr_indices]]
-                ind_to_keep += batch_unfinished_indices
+                self.save_solver_stats(indices=curr_indices)
+                self.save_finished_indices(reducer=reducer, indices=curr_indices)
+                self.save_output_for_finished(reducer=reducer, indices=curr_indices)
+
+                # Save the last values of the batch, the unfinished simulations
+                # continue from them in the next iteration
+                true_finished = self.get_true_finished(indices=curr_indices)
+                self.finished[curr_indices] = true_finished
+                active.update(batch=batch_slice, y=reducer.last_val, finished=true_finished)
+                if self.matrix_cache is not None:
+                    self.update_matrix_cache(indices=curr_indices, finished=true_finished)
             # Adjust time period
             t_limit[0] = t_limit[1]
             t_limit[1] += self.tdelta
             # Remove indices of completed simulations
-            indices = indices[torch.isin(indices, torch.Tensor(ind_to_keep).to(device))]
+            active.compact()
+            n_windows += 1
+            if checkpoint is not None and n_windows % checkpoint.every == 0:
+                checkpoint.save(
+                    self.get_state(
+                        lhs_table=lhs_table, t_limit=t_limit, active=active, n_windows=n_windows
+                    )
+                )
         print("\n Elapsed time: ", time() - time_start)
         return {
             **{f"{comp}_max": output for comp, output in self.max_targets_output.items()},
             **{f"{comp}_sup": output for comp, output in self.sup_targets_output.items()},
         }
 
-    def get_batch_solution(
+    def get_state(
+        self, lhs_table: torch.Tensor, t_limit: List[int], active: ActiveSet, n_windows: int
+    ) -> Dict[str, Any]:
+        """
+        Get the state of the run at the end of a time window, with the tensors on the CPU, see
+        Checkpoint. The matrix cache isn't saved, the matrices are generated again after resuming.
+        """
+
+        def to_cpu(tensors: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+            return {key: value.cpu() for key, value in tensors.items()}
+
+        return {
+            "lhs_table": lhs_table.cpu(),
+            "t_limit": list(t_limit),
+            "n_windows": n_windows,
+            "indices": active.indices.cpu(),
+            "y": active.y.cpu(),
+            "finished": self.finished.cpu(),
+            "sup_finished": self.sup_finished.cpu(),
+            "max_targets_finished": to_cpu(self.max_targets_finished),
+            "max_targets_output": to_cpu(self.max_targets_output),
+            "sup_targets_output": to_cpu(self.sup_targets_output),
+            "solver_stats": to_cpu(self.solver_stats),
+        }
+
+    def load_state(self, state: Dict[str, Any]) -> Tuple[List[int], ActiveSet, int]:
+        """
+        Restore the state of the run saved by get_state.
+
+        Returns:
+            Tuple[List[int], ActiveSet, int]: The next time window, the active samples and the
+            number of time windows solved.
+        """
+        device = self.model.device
+        self.finished = state["finished"].to(device)
+        self.sup_finished = state["sup_finished"].to(device)
+        self.max_targets_finished = {
+            comp: value.to(device) for comp, value in state["max_targets_finished"].items()
+        }
+        self.max_targets_output = {
+            comp: value.to(device) for comp, value in state["max_targets_output"].items()
+        }
+        self.sup_targets_output = {
+            comp: value.to(device) for comp, value in state["sup_targets_output"].items()
+        }
+        self.solver_stats = {key: value.to(device) for key, value in state["solver_stats"].items()}
+        active = ActiveSet.from_state(indices=state["indices"], y=state["y"].to(device))
+        return list(state["t_limit"]), active, state["n_windows"]
+
+    def get_batch_reducer(
         self, y0: torch.Tensor, t_eval: torch.Tensor, samples: torch.Tensor
-    ) -> torch.Tensor:
-        sol = self.model.get_solution(y0=y0, t_eval=t_eval, lhs_table=samples).ys
+    ) -> TargetReducer:
+        reducer = TargetReducer(
+            layout=self.model.layout,
+            max_targets=self.max_targets,
+            stopping_condition=self.is_finished if self.early_stopping else None,
+        )
+        if self.streaming or self.early_stopping:
+            # The solver feeds the reducer at every evaluation time
+            self.model.reducer = reducer
+            try:
+                self.model.get_solution(y0=y0, t_eval=t_eval, lhs_table=samples)
+            finally:
+                self.model.reducer = None
+        else:
+            reducer.reduce(self.model.get_solution(y0=y0, t_eval=t_eval, lhs_table=samples).ys)
         if self.model.test:
             # Check if population size changed
-            if any(
-                [
-                    abs(self.model.population.sum() - sol[i, -1, :].sum()) > 50
-                    for i in range(sol.shape[0])
-                ]
-            ):
+            if torch.any((self.model.population.sum() - reducer.last_val.sum(dim=1)).abs() > 50):
                 raise Exception("Unexpected change in population size!")
-        return sol
+        return reducer
+
+    def update_matrix_cache(self, indices: torch.Tensor, finished: torch.BoolTensor) -> None:
+        """
+        Store the matrices of the unfinished samples of a newly generated batch, or evict the
+        finished samples of a batch loaded from the cache.
+        """
+        if indices in self.matrix_cache:
+            self.matrix_cache.evict(indices[finished])
+        else:
+            unfinished = (~finished).nonzero().flatten()
+            self.matrix_cache.store(
+                indices=indices[unfinished],
+                values=select_samples(self.model.batch_matrices, unfinished),
+            )
 
-    def save_finished_indices(self, solutions, indices) -> None:
-        last_val = solutions[:, -1, :]
-        last_diff = solutions[:, -2, :] - last_val
+    def save_solver_stats(self, indices: torch.Tensor) -> None:
+        n_samples = self.finished.shape[0]
+        for key, value in (self.model.solver_stats or {}).items():
+            if torch.is_tensor(value) and value.shape == indices.shape:
+                if key not in self.solver_stats:
+                    self.solver_stats[key] = torch.zeros(
+                        n_samples, dtype=value.dtype, device=value.device
+                    )
+                self.solver_stats[key][indices] += value
 
+    def save_finished_indices(self, reducer: TargetReducer, indices) -> None:
         for comp in self.max_targets:
-            if all(self.max_targets_finished[comp]):
+            if self.max_targets_finished[comp].all():
                 continue
             self.max_targets_finished[comp][indices] = self.max_stopping_condition(
-                comp=comp, last_diff=last_diff
+                last_diff=reducer.get_last_diff(comp)
             )
         if self.sup_targets:
-            self.sup_finished[indices] = self.sup_stopping_condition(last_val)
+            self.sup_finished[indices] = self.sup_stopping_condition(reducer.last_val)
 
-    def max_stopping_condition(self, comp, last_diff):
-        comp_idx = self.model.idx(f"{comp}_0")
-        return last_diff[:, comp_idx].sum(axis=1) > 0
+    def is_finished(
+        self, reducer: TargetReducer, y: torch.Tensor, idx: torch.Tensor
+    ) -> torch.BoolTensor:
+        """
+        Stopping condition evaluated within the integration loop, for the states y of the samples
+        at the positions idx of the batch, with the same rule as get_true_finished.
+
+        The first substates of the max targets may decrease long before the compartments peak,
+        e.g. while the initial infections recover, and the compartments themselves may have an
+        early local maximum, so within the loop the samples are only finished once the epidemic
+        is over, as with sup targets, not to cut off the running maxima.
+        """
+        finished = self.sup_stopping_condition(y)
+        if self.sup_targets:
+            return finished
+        for comp in self.max_targets:
+            finished &= self.max_stopping_condition(last_diff=reducer.get_last_diff(comp)[idx])
+        return finished
+
+    @staticmethod
+    def max_stopping_condition(last_diff):
+        return last_diff > 0
 
     def sup_stopping_condition(self, last_val):
-        inf_sum = torch.zeros(last_val.shape[0], device=self.model.device)
-        for state, data in self.model.state_data.items():
-            if data.get("type") in ["infected"]:
-                inf_sum += self.model.aggregate_by_age(solution=last_val, comp=state)
+        inf_sum = self.model.layout.sum_type(last_val, state_type="infected")
         finished = inf_sum < 1
         return finished
 
-    def save_output_for_finished(self, solutions: torch.Tensor, indices) -> None:
+    def save_output_for_finished(self, reducer: TargetReducer, indices) -> None:
         for comp in self.max_targets:
             finished = self.max_targets_finished[comp][indices]
-            if any(finished):
+            if finished.any():
                 # Only update maximums if the current value is 0, not to overwrite the true maximum
                 maxes = self.max_targets_output[comp][indices[finished]]
                 self.max_targets_output[comp][indices[finished]] = torch.where(
                     maxes == 0,
-                    self.max_metric(solutions=solutions[finished], comp=comp),
+                    reducer.max_values[comp][finished].to(self.model.device),
                     maxes,
                 )
 
         finished = self.sup_finished[indices]
-        if any(finished):
-            for comp in self.sup_targets:
-                self.sup_targets_output[comp][indices[finished]] = self.sup_metric(
-                    solutions=solutions[finished], comp=comp
-                )
-
-    def max_metric(self, solutions, comp) -> torch.Tensor:
-        comp_max = torch.stack(
-            [
-                torch.max(self.model.aggregate_by_age(solution=solutions[i, :, :], comp=comp))
-                for i in range(solutions.shape[0])
-            ]
-        ).to(self.model.device)
-        return comp_max
+        if self.sup_targets and finished.any():
+            sup_values = self.sup_metric(last_val=reducer.last_val[finished])
+            for col, comp in enumerate(self.sup_targets):
+                self.sup_targets_output[comp][indices[finished]] = sup_values[:, col]
 
-    def sup_metric(self, solutions, comp) -> torch.Tensor:
-        return solutions[:, -1, self.model.idx(f"{comp}_0")].sum(axis=1)
+    def sup_metric(self, last_val) -> torch.Tensor:
+        """
+        Get the sums of the first substates of the sup targets, of shape (n_samples, n_sup_targets).
+        """
+        return self.model.aggregate(last_val, groups=[f"{comp}_0" for comp in self.sup_targets])
 
-    def get_true_finished(self) -> torch.BoolTensor:
-        finished = self.finished
+    def get_true_finished(self, indices: torch.Tensor) -> torch.BoolTensor:
+        """
+        Get whether the simulations of the samples with the given indices are finished. With sup
+        targets, a simulation is finished once the epidemic is over, otherwise once the stopping
+        conditions of all max targets are met.
+        """
+        if self.sup_targets:
+            return self.sup_finished[indices]
+        finished = torch.ones(indices.shape[0], dtype=torch.bool, device=indices.device)
         for comp in self.max_targets:
-            finished &= self.max_targets_finished[comp]
-        finished = finished | self.sup_finished
+            finished = finished & self.max_targets_finished[comp][indices]
         return finished
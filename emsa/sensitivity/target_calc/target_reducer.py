@@ -0,0 +1,133 @@
+from typing import Callable, Dict, List, Optional
+
+import torch
+
+from emsa.model.state_layout import StateLayout
+
+
+class TargetReducer:
+    """
+    Accumulator of the quantities needed by TargetCalc from the states of a time window.
+
+    The reducer is either fed the full solution of a window at once with reduce, or the states at
+    the evaluation times one by one with update, from within the integration loop. In the latter
+    case, the trajectories never have to be stored, and the memory usage is O(n_samples * n_eq)
+    instead of O(n_samples * n_t * n_eq).
+
+    Within the integration loop, the updates may only concern a subset of the samples, given by
+    their positions in the batch. If a stopping condition is set, the solver uses it to freeze the
+    finished samples, finalizing them with their current states, and to drop them from the
+    integration, see solve_fixed_step.
+
+    Attributes:
+        layout (StateLayout): Layout of the state vector.
+        max_targets (List[str]): Compartments of the max targets.
+        stopping_condition (Optional[Callable]): Function of the reducer, the states of a subset
+            of the samples and their positions, telling which of them are finished.
+        groups (List[str]): States and first substates of the max targets, aggregated at once by
+            StateLayout.aggregate.
+        max_values (Dict[str, torch.Tensor]): Running maxima of the aggregated compartments.
+        prev_first (Dict[str, torch.Tensor]): Sums of the first substates at the second to last
+            evaluation time, used in the stopping condition of the max targets.
+        last_first (Dict[str, torch.Tensor]): Sums of the first substates at the last evaluation time.
+        last_val (torch.Tensor): States at the last evaluation time.
+    """
+
+    def __init__(
+        self,
+        layout: StateLayout,
+        max_targets: List[str],
+        stopping_condition: Optional[Callable] = None,
+    ):
+        self.layout = layout
+        self.max_targets = max_targets
+        self.stopping_condition = stopping_condition
+        # The states and first substates of the max targets are aggregated at once
+        self.groups = max_targets + [f"{comp}_0" for comp in max_targets]
+
+        self.max_values: Dict[str, torch.Tensor] = {}
+        self.prev_first: Dict[str, torch.Tensor] = {}
+        self.last_first: Dict[str, torch.Tensor] = {}
+        self.last_val = None
+        self._max = None
+        self._prev_first = None
+        self._last_first = None
+
+    def update(self, y: torch.Tensor, idx: Optional[torch.Tensor] = None) -> None:
+        """
+        Update the reductions with the states at the next evaluation time.
+
+        Args:
+            y (torch.Tensor): States of shape (n, n_eq).
+            idx (Optional[torch.Tensor]): Positions of the states in the batch, all samples by default.
+                The first update has to contain all samples.
+        """
+        if self.last_val is None:
+            self._allocate(y)
+        if not self.max_targets:
+            return
+        n_max = len(self.max_targets)
+        sums = self.layout.aggregate(y, groups=self.groups)
+        if idx is None:
+            torch.maximum(self._max, sums[:, :n_max], out=self._max)
+            self._prev_first.copy_(self._last_first)
+            self._last_first.copy_(sums[:, n_max:])
+            return
+        self._max[idx] = torch.maximum(self._max[idx], sums[:, :n_max])
+        self._prev_first[idx] = self._last_first[idx]
+        self._last_first[idx] = sums[:, n_max:]
+
+    def finalize(self, y: torch.Tensor, idx: Optional[torch.Tensor] = None) -> None:
+        """
+        Save the last states of the samples at the given positions, all samples by default.
+        """
+        if idx is None:
+            self.last_val[:] = y
+        else:
+            self.last_val[idx] = y
+
+    def get_finished(self, y: torch.Tensor, idx: torch.Tensor) -> torch.BoolTensor:
+        """
+        Evaluate the stopping condition for the states y of the samples at the positions idx.
+        """
+        if self.stopping_condition is None:
+            return torch.zeros(y.shape[0], dtype=torch.bool, device=y.device)
+        return self.stopping_condition(self, y, idx)
+
+    def reduce(self, solutions: torch.Tensor) -> None:
+        """
+        Compute the reductions from the full solution of shape (n_samples, n_t, n_eq).
+        """
+        n_max = len(self.max_targets)
+        sums = self.layout.aggregate(solutions, groups=self.groups)
+        self._set_reductions(
+            max_values=sums[:, :, :n_max].max(dim=1).values,
+            prev_first=sums[:, -2, n_max:],
+            last_first=sums[:, -1, n_max:],
+        )
+        self.last_val = solutions[:, -1, :]
+
+    def get_last_diff(self, comp: str) -> torch.Tensor:
+        """
+        Get the decrease of the first substates of a compartment during the last time step.
+        """
+        return self.prev_first[comp] - self.last_first[comp]
+
+    def _allocate(self, y: torch.Tensor) -> None:
+        shape = (y.shape[0], len(self.max_targets))
+        self._set_reductions(
+            max_values=torch.full(shape, -torch.inf, device=y.device),
+            prev_first=torch.zeros(shape, device=y.device),
+            last_first=torch.zeros(shape, device=y.device),
+        )
+        self.last_val = torch.zeros_like(y)
+
+    def _set_reductions(
+        self, max_values: torch.Tensor, prev_first: torch.Tensor, last_first: torch.Tensor
+    ) -> None:
+        # The reductions of the targets are the columns of the matrices, exposed as views
+        self._max, self._prev_first, self._last_first = max_values, prev_first, last_first
+        for col, comp in enumerate(self.max_targets):
+            self.max_values[comp] = max_values[:, col]
+            self.prev_first[comp] = prev_first[:, col]
+            self.last_first[comp] = last_first[:, col]
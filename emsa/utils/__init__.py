@@ -1,2 +1,4 @@
 from .dataloader import DataLoaderBase, PROJECT_PATH
+from .results_store import ResultsStore
+from .shared_memory import share_tensors
 from .simulation_base import SimulationBase
@@ -1,4 +1,7 @@
+import os
 from abc import ABC
+from typing import Dict, List, Optional
+
 import torch
 from os.path import dirname, realpath
 
@@ -10,9 +13,59 @@ class DataLoaderBase(ABC):
         self.project_path = PROJECT_PATH
         self.age_data = None
         self.cm = None
+        # Optional contact matrices of the layers summing to cm, e.g. home, work, school and other
+        self.contact_layers = None
         self.params = None
         self.device = None
 
     @property
     def n_age(self):
         return self.age_data.size(0)
+
+    @staticmethod
+    def get_source_stamps(sources: List[str]) -> Dict[str, List[int]]:
+        """
+        Get the modification times, in nanoseconds, and the sizes of the source files of the data,
+        by their absolute paths, which change when the files are edited or replaced.
+        """
+        stamps = {}
+        for source in sources:
+            stat = os.stat(source)
+            stamps[os.path.abspath(source)] = [stat.st_mtime_ns, stat.st_size]
+        return stamps
+
+    def save_cache(self, path: str, sources: Optional[List[str]] = None) -> None:
+        """
+        Save the loaded data, so that it can be loaded again by load_cache without parsing the
+        original files. The stamps of the source files are saved with it, see is_cache_valid.
+        """
+        torch.save(
+            {
+                "age_data": self.age_data,
+                "cm": self.cm,
+                "contact_layers": self.contact_layers,
+                "params": self.params,
+                "sources": self.get_source_stamps(sources or []),
+            },
+            path,
+        )
+
+    def is_cache_valid(self, path: str, sources: Optional[List[str]] = None) -> bool:
+        """
+        Whether the cache exists and was saved from the same source files, unchanged since.
+        """
+        if not os.path.exists(path):
+            return False
+        cache = torch.load(path, mmap=True, weights_only=True)
+        return cache.get("sources") == self.get_source_stamps(sources or [])
+
+    def load_cache(self, path: str) -> None:
+        """
+        Load the data saved by save_cache. The file is memory-mapped, so the tensors are read from
+        it on demand, and the processes loading the same file share its pages.
+        """
+        cache = torch.load(path, mmap=True, weights_only=True)
+        self.age_data = cache["age_data"]
+        self.cm = cache["cm"]
+        self.contact_layers = cache["contact_layers"]
+        self.params = cache["params"]
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+results_formats = ["csv", "npy"]
+
+
+def get_config_hash(config: Dict[str, Any]) -> str:
+    """
+    Get the hash identifying a configuration, e.g. the sampling configuration and the model
+    structure the results were produced with.
+    """
+    key = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+class ResultsStore:
+    """
+    Storage of the outputs of the sampling, e.g. the LHS tables, the values of the target variables
+    and the PRCC values, with one dataset per scenario and target in the folder of the simulation,
+    at <folder_name>/<output_name>/<output_name>_<filename>.
+
+    With the csv format, the datasets are text files written by np.savetxt. With the npy format,
+    they are binary .npy files, which are written and read without formatting the numbers, take a
+    fraction of the disk space, and are memory-mapped when loaded. Every binary dataset has a json
+    file next to it with its metadata, e.g. the labels of the parameter columns and the hash of the
+    configuration. The json file of a text dataset only holds the hash of the configuration.
+
+    Attributes:
+        folder_name (str): Folder of the simulation.
+        results_format (str): Either csv or npy.
+        config_hash (Optional[str]): Hash of the configuration, saved in the metadata.
+    """
+
+    def __init__(
+        self, folder_name: str, results_format: str = "csv", config_hash: Optional[str] = None
+    ):
+        if results_format not in results_formats:
+            raise ValueError(
+                f"Unknown results format {results_format}, choose from {results_formats}"
+            )
+        self.folder_name = folder_name
+        self.results_format = results_format
+        self.config_hash = config_hash
+
+    def get_path(self, output_name: str, filename: str) -> str:
+        return os.path.join(
+            self.folder_name, output_name, f"{output_name}_{filename}.{self.results_format}"
+        )
+
+    def save(
+        self, output, output_name: str, filename: str, metadata: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """
+        Save a dataset, overwriting the previous one with the same name.
+
+        Args:
+            output: Array of the dataset, or a tensor on the CPU.
+            output_name (str): Name of the output, e.g. lhs, simulations or prcc.
+            filename (str): Name of the dataset, e.g. the scenario and the target.
+            metadata (Optional[Dict[str, Any]]): Metadata of the dataset, saved with the npy format.
+        """
+        path = self.get_path(output_name=output_name, filename=filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        output = np.asarray(output)
+        if self.results_format == "csv":
+            np.savetxt(fname=path, X=output)
+            self.save_config_hash(path=path)
+            return
+        np.save(path, output)
+        self.save_metadata(
+            path=path, metadata=metadata or {}, shape=output.shape, dtype=output.dtype
+        )
+
+    def append(
+        self,
+        output,
+        output_name: str,
+        filename: str,
+        start: int,
+        n_rows: int,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        Write a chunk of the rows of a dataset of n_rows rows, starting at the row start. The chunks
+        are written in order, and the dataset is created by the chunk starting at 0.
+
+        With the csv format, the rows are appended to the text file. With the npy format, the file
+        of n_rows rows is created at once, and the chunks are written into it through a memory map.
+        The number of rows written so far is kept in the metadata as n_rows_written, since the rows
+        not yet written are zeros.
+
+        Args:
+            output: Rows of the chunk.
+            output_name (str): Name of the output, e.g. lhs or simulations.
+            filename (str): Name of the dataset, e.g. the scenario and the target.
+            start (int): Index of the first row of the chunk.
+            n_rows (int): Number of rows of the dataset.
+            metadata (Optional[Dict[str, Any]]): Metadata of the dataset, saved with the npy format.
+        """
+        path = self.get_path(output_name=output_name, filename=filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        output = np.asarray(output)
+        if self.results_format == "csv":
+            with open(path, "w" if start == 0 else "a") as f:
+                np.savetxt(fname=f, X=output)
+            if start == 0:
+                self.save_config_hash(path=path)
+            return
+        if start == 0:
+            dataset = np.lib.format.open_memmap(
+                path, mode="w+", dtype=output.dtype, shape=(n_rows, *output.shape[1:])
+            )
+        else:
+            dataset = np.lib.format.open_memmap(path, mode="r+")
+        dataset[slice(start, start + output.shape[0])] = output
+        dataset.flush()
+        del dataset
+        self.save_metadata(
+            path=path,
+            metadata={**(metadata or {}), "n_rows_written": start + output.shape[0]},
+            shape=(n_rows, *output.shape[1:]),
+            dtype=output.dtype,
+        )
+
+    def save_metadata(self, path: str, metadata: Dict[str, Any], shape, dtype) -> None:
+        metadata = {
+            **metadata,
+            "config_hash": self.config_hash,
+            "shape": list(shape),
+            "dtype": str(dtype),
+        }
+        with open(os.path.splitext(path)[0] + ".json", "w") as f:
+            json.dump(metadata, f)
+
+    def save_config_hash(self, path: str) -> None:
+        with open(os.path.splitext(path)[0] + ".json", "w") as f:
+            json.dump({"config_hash": self.config_hash}, f)
+
+    def load_config_hash(self, output_name: str, filename: str) -> Optional[str]:
+        """
+        Load the hash of the configuration a dataset was saved with, None if the dataset or its
+        json file doesn't exist.
+        """
+        path = self.get_path(output_name=output_name, filename=filename)
+        metadata_path = os.path.splitext(path)[0] + ".json"
+        if not os.path.exists(path) or not os.path.exists(metadata_path):
+            return None
+        with open(metadata_path) as f:
+            return json.load(f).get("config_hash")
+
+    def load(self, output_name: str, filename: str, mmap: bool = True) -> np.ndarray:
+        """
+        Load a dataset, memory-mapped in read-only mode with the npy format if mmap is set.
+        """
+        path = self.get_path(output_name=output_name, filename=filename)
+        if self.results_format == "csv":
+            return np.loadtxt(fname=path)
+        return np.load(path, mmap_mode="r" if mmap else None)
+
+    def count_rows(self, output_name: str, filename: str) -> int:
+        """
+        Count the rows of a dataset written so far, 0 if it doesn't exist.
+        """
+        path = self.get_path(output_name=output_name, filename=filename)
+        if not os.path.exists(path):
+            return 0
+        if self.results_format == "csv":
+            # A row written only in part doesn't end with a newline
+            with open(path, "rb") as f:
+                return sum(line.endswith(b"\n") for line in f)
+        metadata = self.load_metadata(output_name=output_name, filename=filename)
+        return metadata.get("n_rows_written", metadata["shape"][0])
+
+    def truncate(self, output_name: str, filename: str, n_rows: int) -> None:
+        """
+        Drop the rows of a dataset after its first n_rows, e.g. the rows of a chunk written before
+        an interruption, while the other outputs of the chunk weren't. With the npy format, the
+        rows are overwritten in place by the next chunks, see append, so only csv files are
+        truncated.
+        """
+        path = self.get_path(output_name=output_name, filename=filename)
+        if self.results_format != "csv" or not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            size = sum(len(line) for _, line in zip(range(n_rows), f))
+        with open(path, "r+b") as f:
+            f.truncate(size)
+
+    def load_metadata(self, output_name: str, filename: str) -> Dict[str, Any]:
+        """
+        Load the metadata of a dataset saved in the npy format.
+        """
+        path = self.get_path(output_name=output_name, filename=filename)
+        with open(os.path.splitext(path)[0] + ".json") as f:
+            return json.load(f)
@@ -0,0 +1,41 @@
+import types
+
+import torch
+
+
+def share_tensors(obj, memo=None):
+    """
+    Move the CPU tensors reachable from obj, through dictionaries, lists, tuples and the attributes
+    of objects, to shared memory in place.
+
+    Worker processes receiving a shared tensor attach to its memory instead of copying it, so the
+    model data, e.g. the age data, the contact layers and the matrices of the model, is only held
+    once, however many workers use it. Tensors already in shared memory, or not on the CPU, are left
+    unchanged.
+
+    Args:
+        obj: The object to traverse, e.g. a simulation object.
+        memo (set): Ids of the objects already traversed.
+
+    Returns:
+        The object itself.
+    """
+    memo = set() if memo is None else memo
+    if id(obj) in memo:
+        return obj
+    memo.add(id(obj))
+    if torch.is_tensor(obj):
+        if obj.device.type == "cpu" and obj.layout == torch.strided and not obj.is_shared():
+            obj.share_memory_()
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            share_tensors(value, memo)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            share_tensors(value, memo)
+    elif hasattr(obj, "__dict__") and not isinstance(
+        obj, (type, types.ModuleType, types.FunctionType, types.MethodType)
+    ):
+        for value in vars(obj).values():
+            share_tensors(value, memo)
+    return obj
@@ -4,11 +4,13 @@ import os
 from abc import ABC, abstractmethod
 
 import numpy as np
+import torch
 from scipy import stats as ss
 from torch import atleast_2d
 
 from .dataloader import PROJECT_PATH
 from .plotter import generate_tornado_plot
+from .results_store import ResultsStore, get_config_hash
 
 
 class SimulationBase(ABC):
@@ -21,11 +23,26 @@ class SimulationBase(ABC):
         self._load_simulation_data()
         self._load_config(sampling_config_path)
         self._load_model_structure(model_struct_path)
+        self.config_hash = get_config_hash(
+            {"sampling_config": self.sampling_config, "model_struct": self.model_struct}
+        )
 
     @property
     def susceptibles(self):
         return self.model.get_initial_values()[self.model.idx("s_0")]
 
+    @property
+    def results_store(self) -> ResultsStore:
+        """
+        Storage of the outputs in the folder of the simulation, in the format given by the
+        results_format key of the sampling config.
+        """
+        return ResultsStore(
+            folder_name=self.folder_name,
+            results_format=self.results_format,
+            config_hash=self.config_hash,
+        )
+
     def _load_simulation_data(self):
         self.params = self.data.params
         self.cm = atleast_2d(self.data.cm)
@@ -40,24 +57,45 @@ class SimulationBase(ABC):
     def _load_config(self, config_path):
         with open(config_path) as f:
             config = json.load(f)
+        self.sampling_config = config
 
         self.target_vars = config["target_vars"]
 
         self.variable_params_dict = config.get("variable_params", {})
 
         self.variable_param_combinations = self.process_variable_params()
+        # Solve all the combinations of the variable parameters as a single batched problem
+        self.batch_scenarios = config.get("batch_scenarios", False)
+        # Columns of the scenario parameters appended to the samples, see run_batched_scenarios
+        self.scenario_cols = {}
 
         self.sampled_params_boundaries = config.get("sampled_params_boundaries") or {}
         self.n_samples = config["n_samples"]
         self.batch_size = config["batch_size"]
 
         self.test = config.get("is_static") or True
+        self.sparse_matrices = config.get("sparse_matrices", False)
+        self.ode_engine = config.get("ode_engine", "dense")
+        self.solver_config = config.get("solver")
+        self.r0_config = config.get("r0_solver")
+        self.parallel_config = config.get("parallel")
+        self.schedules = config.get("schedules")
+        self.results_format = config.get("results_format", "csv")
+        # Number of samples generated, solved and saved at once, all of them if not set
+        self.chunk_size = config.get("chunk_size")
+        # Number of time windows between the checkpoints of the target calculation, none if not set
+        self.checkpoint_every = config.get("checkpoint_every")
+        # Whether run_sampling continues an interrupted run, see resume_sampling
+        self.resume = False
         self.init_vals = config["init_vals"]
 
         self.target_calc_config = {
             "tlim_ini": config.get("tlim_ini") or 300,
             "tlim_final": config.get("tlim_final") or 5000,
             "tdelta": config.get("tdelta") or 50,
+            "streaming": config.get("streaming_targets", False),
+            "early_stopping": config.get("early_stopping", False),
+            "cache_matrices": config.get("cache_matrices", False),
         }
 
     def process_variable_params(self):
@@ -94,6 +132,114 @@ class SimulationBase(ABC):
     def run_sampling(self):
         pass
 
+    def resume_sampling(self) -> None:
+        """
+        Continue an interrupted run_sampling. The scenarios with all their outputs saved are
+        skipped, the ones with a checkpoint continue from its last completed time window with the
+        samples saved when they started, see SamplerBase.run, and the others are run again.
+        """
+        self.resume = True
+        try:
+            self.run_sampling()
+        finally:
+            self.resume = False
+
+    def get_scenario_params(self, variable_params: dict) -> dict:
+        """
+        Get the values of the model parameters in the scenario given by the variable parameters,
+        and set them in the parameters of the simulation. The base reproduction number r0 is
+        converted to beta, with the other parameters of the scenario already set.
+
+        Args:
+            variable_params (dict): A combination of the variable parameters.
+
+        Returns:
+            dict: The values of the parameters by name, as tensors.
+        """
+        scenario_params = {}
+        for key, value in variable_params.items():
+            if key == "r0":
+                continue
+            if isinstance(value, dict):
+                value = next(iter(value.values()))
+            scenario_params[key] = torch.tensor(value, dtype=torch.float32, device=self.device)
+        self.params.update(scenario_params)
+        if "r0" in variable_params:
+            scenario_params["beta"] = torch.as_tensor(
+                self.get_beta_from_r0(variable_params["r0"]), dtype=torch.float32
+            )
+            self.params["beta"] = scenario_params["beta"]
+        return scenario_params
+
+    def run_batched_scenarios(self, sampler_cls) -> None:
+        """
+        Run the sampling of all the combinations of the variable parameters as a single batched
+        problem, instead of a separate sampling job for each of them.
+
+        The samples of the scenarios are concatenated, and the values of the scenario parameters,
+        see get_scenario_params, are appended to them as per-sample columns, which the models and
+        the R0 calculator read in place of the model parameters. The outputs are split back and
+        saved per scenario, under the same filenames as by the scenario-wise sampling.
+
+        Args:
+            sampler_cls: Subclass of SamplerBase generating the samples of a scenario.
+        """
+        from emsa.sensitivity.target_calc import OutputGenerator
+
+        params = dict(self.params)
+        samplers = []
+        lhs_tables = []
+        scenario_values = []
+        try:
+            for variable_params in self.variable_param_combinations:
+                sampler = sampler_cls(sim_object=self, variable_params=variable_params)
+                scenario_params = self.get_scenario_params(variable_params)
+                lhs_table = sampler.get_samples()
+                values = np.concatenate(
+                    [value.cpu().numpy().reshape(-1) for value in scenario_params.values()]
+                )
+                samplers.append(sampler)
+                lhs_tables.append(lhs_table)
+                scenario_values.append(np.tile(values, (lhs_table.shape[0], 1)))
+            self.scenario_cols = self.get_scenario_cols(
+                scenario_params=scenario_params, n_sampled_cols=lhs_tables[0].shape[1]
+            )
+            samples = np.concatenate(
+                [np.c_[lhs_table, values] for lhs_table, values in zip(lhs_tables, scenario_values)]
+            )
+            print(f"\n Simulation for {len(samplers)} scenarios, {samples.shape[0]} samples")
+            print(f"Batch size: {self.batch_size}\n")
+            sim_outputs = OutputGenerator(sim_object=self).get_output(lhs_table=samples)
+        finally:
+            self.scenario_cols = {}
+            self.params.update(params)
+
+        scenario_ends = np.cumsum([lhs_table.shape[0] for lhs_table in lhs_tables])
+        for sampler, lhs_table, end in zip(samplers, lhs_tables, scenario_ends):
+            scenario_slice = slice(end - lhs_table.shape[0], end)
+            sampler.save_sim_output(
+                lhs_table=lhs_table,
+                sim_outputs={
+                    target: output[scenario_slice] for target, output in sim_outputs.items()
+                },
+            )
+
+    @staticmethod
+    def get_scenario_cols(scenario_params: dict, n_sampled_cols: int) -> dict:
+        """
+        Get the columns of the scenario parameters appended after the sampled columns, an index
+        for scalar parameters and a slice for the others.
+        """
+        scenario_cols = {}
+        last_idx = n_sampled_cols
+        for param, value in scenario_params.items():
+            n_cols = value.numel()
+            scenario_cols[param] = (
+                last_idx if value.dim() == 0 else slice(last_idx, last_idx + n_cols)
+            )
+            last_idx += n_cols
+        return scenario_cols
+
     def run_func_for_all_configs(self, func):
         for variable_params, target in itertools.product(
             self.variable_param_combinations, self.target_vars
@@ -121,7 +267,7 @@ class SimulationBase(ABC):
     def get_beta_from_r0(self, base_r0):
         from emsa.model import R0Generator
 
-        r0generator = R0Generator(self.data, self.model_struct)
+        r0generator = R0Generator(self.data, self.model_struct, eig_config=self.r0_config)
         if isinstance(base_r0, tuple):
             base_r0 = base_r0[0]
         return base_r0 / r0generator.get_eig_val(
@@ -141,24 +287,17 @@ class SimulationBase(ABC):
         """
         from emsa.sensitivity import get_prcc_values
 
-        folder_name = self.folder_name
-        os.makedirs(os.path.join(folder_name, "prcc"), exist_ok=True)
-        lhs_path = os.path.join(folder_name, f"lhs/lhs_{filename}.csv")
-        output_path = os.path.join(folder_name, f"simulations/simulations_{filename}_{target}.csv")
-        lhs_table = np.loadtxt(lhs_path)
-        sim_output = np.loadtxt(output_path)
+        results_store = self.results_store
+        lhs_table = results_store.load(output_name="lhs", filename=filename)
+        sim_output = results_store.load(output_name="simulations", filename=f"{filename}_{target}")
 
         prcc = get_prcc_values(np.c_[lhs_table, sim_output.T])
 
-        prcc_path = os.path.join(folder_name, f"prcc/prcc_{filename}_{target}.csv")
-        np.savetxt(fname=prcc_path, X=prcc)
+        results_store.save(output=prcc, output_name="prcc", filename=f"{filename}_{target}")
 
     def calculate_p_values(self, filename, significance=0.05):
-        p_values_dir = os.path.join(self.folder_name, "p_values")
-        os.makedirs(p_values_dir, exist_ok=True)
-
-        prcc_path = os.path.join(self.folder_name, f"prcc/prcc_{filename}.csv")
-        prcc = np.loadtxt(fname=prcc_path)
+        results_store = self.results_store
+        prcc = results_store.load(output_name="prcc", filename=filename)
         denom = np.where(prcc**2 < 1 - 1e-6, 1 - prcc**2, 0.01)
         t = prcc * np.sqrt((self.n_samples - 2 - self.n_age) / denom)
         # p-value for 2-sided test
@@ -166,8 +305,7 @@ class SimulationBase(ABC):
         p_values = 2 * (1 - ss.t.cdf(x=abs(t), df=dof))
         p_values = np.atleast_1d(p_values)
 
-        p_values_path = os.path.join(self.folder_name, f"p_values/p_values_{filename}.csv")
-        np.savetxt(fname=p_values_path, X=p_values)
+        results_store.save(output=p_values, output_name="p_values", filename=filename)
 
         is_first = True
         if len(p_values) < 30:
@@ -209,11 +347,8 @@ class SimulationBase(ABC):
         prcc_plots_dir = os.path.join(self.folder_name, "prcc_plots")
         os.makedirs(prcc_plots_dir, exist_ok=True)
 
-        prcc_file = os.path.join(self.folder_name, f"prcc/prcc_{filename}.csv")
-        prcc = np.loadtxt(fname=prcc_file)
-
-        p_values_file = os.path.join(self.folder_name, f"p_values/p_values_{filename}.csv")
-        p_val = np.loadtxt(fname=p_values_file)
+        prcc = self.results_store.load(output_name="prcc", filename=filename)
+        p_val = self.results_store.load(output_name="p_values", filename=filename)
 
         generate_tornado_plot(
             sim_object=self, labels=labels, prcc=prcc, p_val=p_val, filename=filename
@@ -37,6 +37,9 @@ class SimulationSEIHR(SimulationBase):
         and 'sens_data_contact/simulations' directories, respectively.
 
         """
+        if self.batch_scenarios:
+            self.run_batched_scenarios(sampler_cls=GenericSampler)
+            return
         for variable_params in self.variable_param_combinations:
             susc = torch.Tensor(list(variable_params["susc"].values())[0], device=self.device)
             self.params.update({"susc": susc})
@@ -24,6 +24,9 @@ class SimulationSEIR(SimulationBase):
         self.model = GenericModel(sim_object=self)
 
     def run_sampling(self):
+        if self.batch_scenarios:
+            self.run_batched_scenarios(sampler_cls=GenericSampler)
+            return
         for variable_params in self.variable_param_combinations:
             base_r0 = variable_params["r0"]
             beta = self.get_beta_from_r0(base_r0)
@@ -15,7 +15,3 @@ class SamplerContact(SamplerBase):
                 ]
             ),
         }
-
-    def run(self):
-        lhs_table = self.get_lhs_table()
-        self.get_sim_output(lhs_table=lhs_table)
@@ -1,4 +1,3 @@
-import numpy as np
 import torch
 
 from emsa.model import R0Generator
@@ -22,45 +21,44 @@ class ContactModel(SensitivityModelBase):
         self.base_r0 = base_r0
         self.s_mtx = self.n_age * self.n_comp
         self.upper_tri_size = sim_object.upper_tri_size
+        # Shared by the batches, so that its caches and warm starts carry over
+        self.r0gen = R0Generator(
+            data=self.data, model_struct=self.model_struct, eig_config=sim_object.r0_config
+        )
 
     def get_solution(self, y0, t_eval, **kwargs):
-        lhs_table = kwargs["lhs_table"]
-        cm_samples = self.get_contacts_from_lhs(lhs_table=lhs_table)
-        betas = self._get_betas_from_contacts(cm_samples=cm_samples)
-        self.T = self._get_T_from_contacts(cm_samples=cm_samples, betas=betas)
+        lhs_table, scenario_lhs = self.split_samples(kwargs["lhs_table"])
+        if not self.matrices_loaded:
+            cm_samples = self.get_contacts_from_lhs(lhs_table=lhs_table)
+            betas = self._get_betas_from_contacts(
+                cm_samples=cm_samples, base_r0=scenario_lhs.get("r0", self.base_r0)
+            )
+            self.T = self.format_matrix(
+                self._get_T_from_contacts(cm_samples=cm_samples, betas=betas)
+            )
+            self.batch_params = {"beta": betas}
+            self.batch_cm = cm_samples
         odefun = self.get_basic_ode()
         return self.get_sol_from_ode(y0, t_eval, odefun)
 
     def _get_T_from_contacts(self, cm_samples: torch.Tensor, betas: torch.Tensor):
-        T = torch.zeros((cm_samples.size(0), self.s_mtx, self.s_mtx)).to(self.device)
-        for idx, (cm, beta) in enumerate(zip(cm_samples, betas)):
-            self.matrix_generator.ps.update({"beta": beta})
-            T[idx, :, :] = self.matrix_generator.get_T(cm=cm)
-        return T
-
-    def _get_betas_from_contacts(self, cm_samples: torch.Tensor):
-        r0gen = R0Generator(data=self.data, model_struct=self.model_struct)
-        betas = [
-            self.base_r0
-            / r0gen.get_eig_val(
-                contact_mtx=cm,
-                susceptibles=self.sim_object.susceptibles.flatten(),
-                population=self.sim_object.population,
-            )
-            for cm in cm_samples
-        ]
-        return torch.tensor(betas, device=self.device)
+        return self.matrix_generator.get_T(cm=cm_samples, lhs_dict={"beta": betas})
 
-    def get_contacts_from_lhs(self, lhs_table: np.ndarray):
-        contact_sim = torch.zeros(
-            (lhs_table.shape[0], self.sim_object.n_age, self.sim_object.n_age)
+    def _get_betas_from_contacts(self, cm_samples: torch.Tensor, base_r0=None):
+        base_r0 = self.base_r0 if base_r0 is None else base_r0
+        eig_vals = self.r0gen.get_eig_vals(
+            contact_mtx=cm_samples,
+            susceptibles=self.sim_object.susceptibles.flatten(),
+            population=self.sim_object.population,
         )
-        for idx, sample in enumerate(lhs_table):
-            ratio_mtx = get_ratio_matrix_from_upper_triu(
-                rvector=sample, age_vector=self.sim_object.population.flatten()
-            )
-            contact_sim[idx, :, :] = ratio_mtx * self.sim_object.cm
-        return contact_sim
+        return base_r0 / eig_vals
+
+    def get_contacts_from_lhs(self, lhs_table: torch.Tensor):
+        lhs_table = torch.as_tensor(lhs_table, device=self.device)
+        ratio_mtx = get_ratio_matrix_from_upper_triu(
+            rvector=lhs_table, age_vector=self.sim_object.population.flatten()
+        )
+        return (ratio_mtx * torch.as_tensor(self.sim_object.cm, device=self.device)).float()
 
 
 def get_ratio_matrix_from_upper_triu(rvector, age_vector):
@@ -68,9 +66,21 @@ def get_ratio_matrix_from_upper_triu(rvector, age_vector):
 
 
 def get_rectangular_matrix_from_upper_triu(rvector, matrix_size):
-    upper_tri_indexes = np.triu_indices(matrix_size)
-    new_contact_mtx = np.zeros((matrix_size, matrix_size))
-    new_contact_mtx[upper_tri_indexes] = rvector
-    new_2 = new_contact_mtx.T
-    new_2[upper_tri_indexes] = rvector
-    return torch.from_numpy(new_2)
+    """
+    Build symmetric matrices from their upper triangular entries, given row by row.
+
+    Args:
+        rvector: Upper triangular entries of shape (..., matrix_size * (matrix_size + 1) / 2).
+        matrix_size (int): Number of rows of the matrices.
+
+    Returns:
+        torch.Tensor: Symmetric matrices of shape (..., matrix_size, matrix_size).
+    """
+    rvector = torch.as_tensor(rvector)
+    rows, cols = torch.triu_indices(matrix_size, matrix_size, device=rvector.device)
+    new_contact_mtx = torch.zeros(
+        (*rvector.shape[:-1], matrix_size, matrix_size), dtype=rvector.dtype, device=rvector.device
+    )
+    new_contact_mtx[..., rows, cols] = rvector
+    new_contact_mtx[..., cols, rows] = rvector
+    return new_contact_mtx
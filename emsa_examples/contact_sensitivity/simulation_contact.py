@@ -1,6 +1,6 @@
 import os
 
-import numpy as np
+import torch
 
 from emsa_examples.contact_sensitivity.sampler_contact import SamplerContact
 from emsa_examples.contact_sensitivity.sensitivity_model_contact import ContactModel
@@ -54,6 +54,11 @@ class SimulationContact(SimulationBase):
         and 'sens_data_contact/simulations' directories, respectively.
 
         """
+        if self.batch_scenarios:
+            # The base reproduction numbers of the scenarios are given for every sample
+            self.model = ContactModel(sim_object=self, base_r0=None)
+            self.run_batched_scenarios(sampler_cls=SamplerContact)
+            return
         for variable_params in self.variable_param_combinations:
             # Get beta based on base reproduction number
             base_r0 = variable_params["r0"]
@@ -67,6 +72,13 @@ class SimulationContact(SimulationBase):
             param_generator = SamplerContact(sim_object=self, variable_params=variable_params)
             param_generator.run()
 
+    def get_scenario_params(self, variable_params: dict) -> dict:
+        """
+        Get the base reproduction number of the scenario, from which the model derives beta for
+        every sampled contact matrix.
+        """
+        return {"r0": torch.tensor(variable_params["r0"], dtype=torch.float32, device=self.device)}
+
     def plot_prcc_and_p_values(self, filename):
         """
 
@@ -79,8 +91,8 @@ class SimulationContact(SimulationBase):
 
         """
         os.makedirs(f"{self.folder_name}/prcc_p_val_plots", exist_ok=True)
-        prcc = np.loadtxt(fname=f"{self.folder_name}/prcc/prcc_{filename}.csv")
-        p_val = np.loadtxt(fname=f"{self.folder_name}/p_values/p_values_{filename}.csv")
+        prcc = self.results_store.load(output_name="prcc", filename=filename)
+        p_val = self.results_store.load(output_name="p_values", filename=filename)
 
         plot_prcc_p_values_as_heatmap(
             n_age=self.n_age,
@@ -8,7 +8,18 @@ from emsa.utils.dataloader import DataLoaderBase
 
 
 class DataLoader(DataLoaderBase):
-    def __init__(self, params_path=None, contact_data_path=None, age_data_path=None):
+    def __init__(
+        self, params_path=None, contact_data_path=None, age_data_path=None, cache_path=None
+    ):
+        """
+        Args:
+            params_path: Path of the model parameters, in json format.
+            contact_data_path: Path of the contact matrices of the layers, in xls format.
+            age_data_path: Path of the age distribution, in xls format.
+            cache_path: Optional path of the cache of the parsed data. If the file was saved from
+                the files above, unchanged since, the data is memory-mapped from it instead of
+                parsing them, otherwise it is saved there after parsing.
+        """
         super().__init__()
         self._model_parameters_data_file = (
             join(self.project_path, "emsa_examples/data/model_parameters.json")
@@ -26,9 +37,15 @@ class DataLoader(DataLoaderBase):
             else age_data_path
         )
 
-        self._get_age_data()
-        self._get_model_parameters_data()
-        self._get_contact_mtx()
+        sources = [self._model_parameters_data_file, self._contact_data_file, self._age_data_file]
+        if cache_path is not None and self.is_cache_valid(cache_path, sources=sources):
+            self.load_cache(cache_path)
+        else:
+            self._get_age_data()
+            self._get_model_parameters_data()
+            self._get_contact_mtx()
+            if cache_path is not None:
+                self.save_cache(cache_path, sources=sources)
 
         self.device = "cpu"
 
@@ -63,6 +80,9 @@ class DataLoader(DataLoaderBase):
             wb.unload_sheet(0)
             datalist = self.transform_matrix(datalist)
             contact_matrices.update({cm_type: datalist})
+        self.contact_layers = {
+            layer: contact_matrices[layer] for layer in ["home", "work", "school", "other"]
+        }
         self.cm = (
             contact_matrices["home"]
             + contact_matrices["work"]
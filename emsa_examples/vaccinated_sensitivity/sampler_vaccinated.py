@@ -17,58 +17,83 @@ class SamplerVaccinated(SamplerBase):
             )
         }
 
-    def run(self):
+    def transform_samples(self, lhs_table: np.ndarray) -> np.ndarray:
         """
-        Runs the sampling-based simulation to explore different parameter combinations and
-        collect simulation results for analysis.
-
-        This method performs Latin Hypercube Sampling (LHS) to generate vaccination distributions.
-        It then allocates vaccines to ensure that the total vaccines given to an age group does
-        not exceed the population of that age group. The simulation is executed for each parameter
-        combination, and the maximum value of a specified component (comp) is obtained using the
-        `get_max` method. The simulation results are sorted based on the target variables values
-        and saved in separate output files.
-
-        Returns:
-            None
-
+        Get the vaccine distributions from the sampled ratios, allocated so that the total vaccines
+        given to an age group doesn't exceed the population of that age group.
         """
-        lhs_table = self.get_lhs_table()
-        # Make sure that total vaccines given to an age group
-        # doesn't exceed the population of that age group
-        lhs_table = self.allocate_vaccines(lhs_table)
-        self.get_sim_output(lhs_table)
+        return self.allocate_vaccines(lhs_table)
 
     @staticmethod
     def norm_table_rows(table: np.ndarray):
         return table / np.sum(table, axis=1, keepdims=True)
 
-    def allocate_vaccines(self, lhs_table: np.ndarray):
+    def allocate_vaccines(self, lhs_table: np.ndarray, chunk_size: int = 2**16):
         """
 
         Allocates vaccines to ensure that the number of allocated vaccines does not exceed
         the population size of any given age group.
 
+        The rows of the table are normalized, then the age groups that would receive more
+        vaccines than their population are capped at it, and the excess is redistributed among
+        the other age groups in proportion to their sampled ratios, see
+        project_onto_capped_simplex. The rows are processed in chunks of chunk_size.
+
         Args:
-            lhs_table (torch.Tensor): The table of reallocated vaccines.
+            lhs_table (np.ndarray): The table of sampled vaccine ratios.
+            chunk_size (int): Number of rows allocated at once.
 
         Returns:
-            torch.Tensor: The adjusted table of vaccination allocations.
+            np.ndarray: The adjusted table of vaccination allocations.
 
         """
         lhs_table = self.norm_table_rows(lhs_table)
-        params = self.sim_object.params
-        total_vac = params["total_vaccines"] * lhs_table
-        population = np.array(self.sim_object.population.cpu())
-
-        while np.any(total_vac > population):
-            mask = total_vac > population
-            excess = population - total_vac
-            redistribution = excess * lhs_table
+        caps = np.array(self.sim_object.population.cpu()) / float(
+            self.sim_object.params["total_vaccines"]
+        )
+        for chunk_idx in range(0, lhs_table.shape[0], chunk_size):
+            chunk = slice(chunk_idx, chunk_idx + chunk_size)
+            lhs_table[chunk] = project_onto_capped_simplex(ratios=lhs_table[chunk], caps=caps)
+        return lhs_table
 
-            total_vac[mask] = np.tile(population, (lhs_table.shape[0], 1))[mask]
-            total_vac[~mask] += redistribution[~mask]
 
-            lhs_table = self.norm_table_rows(total_vac / params["total_vaccines"])
-            total_vac = params["total_vaccines"] * lhs_table
-        return lhs_table
+def project_onto_capped_simplex(ratios: np.ndarray, caps: np.ndarray) -> np.ndarray:
+    """
+    Find the allocations x = min(caps, t * ratios) summing to one, for every row of ratios.
+
+    The threshold t of a row is found exactly by water-filling: at the breakpoints caps / ratios
+    sorted in ascending order, the sum of the allocations is a cumulative sum of the caps below
+    the breakpoint plus the breakpoint times the sum of the remaining ratios. The first breakpoint
+    where the sum reaches one determines the capped age groups, and t is solved from them. Rows
+    within the caps are left unchanged, and the cost is O(n_exceeding * n_age * log(n_age)).
+
+    Args:
+        ratios (np.ndarray): Nonnegative ratios of shape (n_rows, n_age), with rows summing to one.
+        caps (np.ndarray): Upper bounds of the allocations of shape (n_age,).
+
+    Returns:
+        np.ndarray: The allocations of shape (n_rows, n_age).
+    """
+    allocations = ratios.copy()
+    # Only the rows exceeding the caps are redistributed
+    exceeding = np.any(ratios > caps, axis=1)
+    ratios = ratios[exceeding]
+    caps = np.broadcast_to(caps, ratios.shape)
+    if np.any(np.where(ratios > 0, caps, 0).sum(axis=1) < 1):
+        raise ValueError("The vaccines can't be allocated without exceeding the population sizes.")
+    breakpoints = np.where(ratios > 0, caps / np.where(ratios > 0, ratios, 1), np.inf)
+    order = np.argsort(breakpoints, axis=1)
+    breakpoints = np.take_along_axis(breakpoints, order, axis=1)
+    caps_sorted = np.take_along_axis(caps, order, axis=1)
+    ratios_sorted = np.take_along_axis(ratios, order, axis=1)
+    # Sum of the caps of the age groups before, and the ratios of the ones after each breakpoint
+    caps_below = np.cumsum(caps_sorted, axis=1) - caps_sorted
+    ratios_above = np.cumsum(ratios_sorted[:, ::-1], axis=1)[:, ::-1]
+    with np.errstate(invalid="ignore"):
+        sums = np.where(np.isinf(breakpoints), np.inf, caps_below + breakpoints * ratios_above)
+    n_capped = (sums < 1).sum(axis=1, keepdims=True)
+    threshold = (1 - np.take_along_axis(caps_below, n_capped, axis=1)) / np.take_along_axis(
+        ratios_above, n_capped, axis=1
+    )
+    allocations[exceeding] = np.minimum(caps, threshold * ratios)
+    return allocations
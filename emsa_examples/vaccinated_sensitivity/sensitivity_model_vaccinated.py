@@ -1,5 +1,6 @@
 import torch
 
+from emsa.model.schedule import Schedule, SegmentedODE
 from emsa.sensitivity.sensitivity_model_base import SensitivityModelBase
 
 
@@ -16,32 +17,67 @@ class VaccinatedModel(SensitivityModelBase):
 
         """
         super().__init__(sim_object=sim_object)
+        self.per_sample_attrs = self.per_sample_attrs + ["V_1"]
 
         self.V_1 = None
         self.V_2 = None
 
+    @property
+    def schedule_names(self) -> list:
+        return super().schedule_names + ["vaccination"]
+
     def get_solution(self, y0, t_eval, **kwargs):
         lhs_table = kwargs["lhs_table"]
-        self.initialize_matrices()
-        self.V_1 = self._get_V_1_from_lhs(lhs_table=lhs_table)
+        if not self.matrices_loaded:
+            # Per-sample matrices only if the samples carry the parameters of their scenarios
+            self.generate_3D_matrices(samples=lhs_table)
+            self.V_1 = self._get_V_1_from_lhs(lhs_table=self.split_samples(lhs_table)[0])
         self.V_2 = self.matrix_generator.get_V_2()
-        odefun = self.get_vaccinated_ode(curr_batch_size=lhs_table.shape[0])
+        schedules = {
+            "vaccination": self.get_vaccination_schedule(t_start=kwargs.get("t_start")),
+            **self.schedules,
+        }
+        odefun = SegmentedODE(schedules=schedules, make_odefun=self.get_vaccinated_ode)
         return self.get_sol_from_ode(y0, t_eval, odefun)
 
-    def get_vaccinated_ode(self, curr_batch_size):
-        V_1_mul = self.get_mul_method(self.V_1)
+    def get_vaccination_schedule(self, t_start=None) -> Schedule:
+        """
+        Get the schedule of the vaccination campaign, lasting for T days from t_start.
+
+        Args:
+            t_start: Start of the campaign, either shared or given for every sample of the batch.
+                Defaults to the t_start parameter.
+
+        Returns:
+            Schedule: The schedule, with the value 1 during the campaign and 0 otherwise.
+        """
+        t_start = self.ps["t_start"] if t_start is None else t_start
+        return Schedule.window(start=t_start, duration=self.ps["T"]).to(self.device)
 
-        v_div = torch.ones((curr_batch_size, self.n_eq)).to(self.device)
-        div_idx = self.idx("s_0") + self.idx("v_0")
-        basic_ode = self.get_basic_ode()
+    def get_vaccinated_ode(self, values: dict):
+        """
+        Get the right-hand side on a segment of the schedules, adding the vaccination term
+        (y @ V_1) / (y @ V_2) to the basic ODE while the campaign is running.
+
+        Args:
+            values (dict): Values of the schedules on the segment, see SegmentedODE.
+
+        Returns:
+            Callable: The right-hand side.
+        """
+        basic_ode = self.get_segment_ode(values=values)
+        vaccination = values["vaccination"]
+        if not vaccination.any():
+            return basic_ode
+        V_1_mul = self.get_mul_method(self.V_1)
+        # Only the susceptible and vaccinated compartments are affected by the vaccination
+        div_idx = torch.cat([self.layout.indices("s_0"), self.layout.indices("v_0")])
+        V_2 = self.V_2[:, div_idx]
+        vaccination = vaccination.reshape(-1, 1)
 
         def odefun(t, y):
-            base_result = basic_ode(t, y)
-            if self.ps["t_start"] <= t[0] < self.ps["t_start"] + self.ps["T"]:
-                v_div[:, div_idx] = (y @ self.V_2)[:, div_idx]
-                vacc = torch.div(V_1_mul(y, self.V_1), v_div)
-                return base_result + vacc
-            return base_result
+            vacc = V_1_mul(y, self.V_1)[:, div_idx] / (y @ V_2)
+            return torch.index_add(basic_ode(t, y), 1, div_idx, vaccination * vacc)
 
         return odefun
 
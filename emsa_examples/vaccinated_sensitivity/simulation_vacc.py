@@ -50,6 +50,9 @@ class SimulationVaccinated(SimulationBase):
         'sens_data_vacc/simulations' directories, respectively.
 
         """
+        if self.batch_scenarios:
+            self.run_batched_scenarios(sampler_cls=SamplerVaccinated)
+            return
         for variable_params in self.variable_param_combinations:
             base_r0 = variable_params["r0"]
             beta = self.get_beta_from_r0(base_r0)
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import torch
+
+from emsa_examples.contact_sensitivity.sensitivity_model_contact import (
+    get_rectangular_matrix_from_upper_triu,
+)
+from emsa_examples.contact_sensitivity.simulation_contact import SimulationContact
+from emsa_examples.utils.dataloader_16_ag import DataLoader
+
+N_SAMPLES = 4
+
+
+@pytest.fixture(scope="module")
+def sim():
+    sim = SimulationContact(data=DataLoader())
+    sim.model.base_r0 = 1.8
+    return sim
+
+
+@pytest.fixture
+def lhs_table(sim):
+    torch.manual_seed(0)
+    return torch.rand(N_SAMPLES, sim.upper_tri_size) * 0.5 + 0.5
+
+
+def test_upper_triu_to_symmetric(lhs_table, sim):
+    matrices = get_rectangular_matrix_from_upper_triu(lhs_table, matrix_size=sim.n_age)
+    assert matrices.shape == (N_SAMPLES, sim.n_age, sim.n_age)
+    for sample, matrix in zip(lhs_table.numpy(), matrices):
+        expected = np.zeros((sim.n_age, sim.n_age), dtype=sample.dtype)
+        expected[np.triu_indices(sim.n_age)] = sample
+        expected = np.triu(expected) + np.triu(expected, 1).T
+        assert np.array_equal(matrix.numpy(), expected)
+        assert np.array_equal(
+            get_rectangular_matrix_from_upper_triu(sample, matrix_size=sim.n_age).numpy(), expected
+        )
+
+
+def test_batched_contact_pipeline(lhs_table, sim):
+    model = sim.model
+    cm_samples = model.get_contacts_from_lhs(lhs_table=lhs_table)
+    betas = model._get_betas_from_contacts(cm_samples=cm_samples)
+    T = model._get_T_from_contacts(cm_samples=cm_samples, betas=betas)
+    population = sim.population
+    susceptibles = sim.susceptibles.flatten()
+    beta_original = model.matrix_generator.ps["beta"]
+    for cm, beta, T_sample in zip(cm_samples, betas, T):
+        eig_val = model.r0gen.get_eig_val(
+            contact_mtx=cm, susceptibles=susceptibles, population=population
+        )
+        assert beta.item() == pytest.approx(model.base_r0 / eig_val, rel=1e-5)
+        model.matrix_generator.ps["beta"] = beta
+        assert torch.allclose(T_sample, model.matrix_generator.get_T(cm=cm))
+    model.matrix_generator.ps["beta"] = beta_original
@@ -0,0 +1,83 @@
+import json
+import os
+
+import pytest
+import torch
+
+from emsa.model import EpidemicModel, LayeredMatrix
+from emsa.model.matrix_cache import cat_samples, select_samples
+from emsa.utils import PROJECT_PATH
+from emsa_examples.utils.dataloader_16_ag import DataLoader
+
+VACCINATED_CONFIG_PATH = "emsa_examples/vaccinated_sensitivity/configs/model_struct.json"
+N_SAMPLES = 5
+
+
+@pytest.fixture(scope="module")
+def model():
+    with open(os.path.join(PROJECT_PATH, VACCINATED_CONFIG_PATH)) as f:
+        model_struct = json.load(f)
+    return EpidemicModel(data=DataLoader(), model_struct=model_struct)
+
+
+@pytest.fixture
+def lhs_dict(model):
+    torch.manual_seed(0)
+    return {
+        "beta": torch.rand(N_SAMPLES),
+        "gamma": torch.rand(N_SAMPLES) + 0.1,
+        "h": torch.rand(N_SAMPLES, model.n_age) * 0.3,
+        "daily_vac": torch.rand(N_SAMPLES, model.n_age) * 1000,
+    }
+
+
+def get_matrices_per_sample(model, lhs_dict, matrix_name):
+    """Generate the matrices one by one, by overriding the parameters of the model."""
+    mtx_gen = model.matrix_generator
+    ps_original = mtx_gen.ps.copy()
+    matrices = []
+    for idx in range(N_SAMPLES):
+        mtx_gen.ps.update({param: value[idx] for param, value in lhs_dict.items()})
+        matrices.append(mtx_gen.generate_matrix(matrix_name))
+    mtx_gen.ps.update(ps_original)
+    return torch.stack(matrices)
+
+
+@pytest.mark.parametrize("matrix_name", ["A", "T", "B", "V_1"])
+def test_batched_matrices(model, lhs_dict, matrix_name):
+    batched = model.matrix_generator.generate_matrix(matrix_name, lhs_dict=lhs_dict)
+    per_sample = get_matrices_per_sample(model, lhs_dict, matrix_name)
+    assert batched.shape == (N_SAMPLES, model.n_eq, model.n_eq)
+    assert torch.allclose(batched, per_sample)
+
+
+def test_batched_contact_matrices(model):
+    cm_samples = torch.rand(N_SAMPLES, model.n_age, model.n_age)
+    T = model.matrix_generator.get_T(cm=cm_samples)
+    for idx in range(N_SAMPLES):
+        assert torch.allclose(T[idx], model.matrix_generator.get_T(cm=cm_samples[idx]))
+
+
+@pytest.mark.parametrize("sampled_beta", [False, True])
+def test_layered_T(model, lhs_dict, sampled_beta):
+    lhs_dict = {"beta": lhs_dict["beta"]} if sampled_beta else None
+    weights = torch.rand(N_SAMPLES, len(model.contact_layers))
+    T = model.get_layered_T(layer_weights=weights, lhs_dict=lhs_dict)
+    assert isinstance(T, LayeredMatrix) and T.shape == (N_SAMPLES, model.n_eq, model.n_eq)
+    dense_T = model.matrix_generator.get_T(cm=model.get_layered_cm(weights), lhs_dict=lhs_dict)
+    assert torch.allclose(T.to_dense(), dense_T, atol=1e-6)
+
+    y = torch.rand(N_SAMPLES, model.n_eq) * 1e4
+    assert torch.allclose(y @ T, torch.einsum("ij,ijk->ik", y, dense_T), rtol=1e-4)
+    # Unit weights give back the contact matrix of the model
+    unit_T = model.get_layered_T(layer_weights=torch.ones(1, len(model.contact_layers)))
+    assert torch.allclose(unit_T.to_dense()[0], model.matrix_generator.get_T(), atol=1e-6)
+
+    idx = torch.tensor([3, 1])
+    selected = select_samples(T, idx)
+    assert torch.allclose(selected.to_dense(), dense_T[idx], atol=1e-6)
+    assert torch.allclose(cat_samples([selected, T]).to_dense()[:2], dense_T[idx], atol=1e-6)
+
+
+if __name__ == "__main__":
+    pytest.main(["-v"])
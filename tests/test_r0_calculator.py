@@ -0,0 +1,120 @@
+import json
+import os
+
+import pytest
+import torch
+
+from emsa.model import R0Generator
+from emsa.model.matrix_generator import get_batched_params
+from emsa.utils import PROJECT_PATH
+from emsa_examples.utils.dataloader_16_ag import DataLoader
+
+CONTACT_CONFIG_PATH = "emsa_examples/contact_sensitivity/configs/model_struct.json"
+N_SAMPLES = 5
+
+
+@pytest.fixture(scope="module")
+def data():
+    return DataLoader()
+
+
+@pytest.fixture(scope="module")
+def model_struct():
+    with open(os.path.join(PROJECT_PATH, CONTACT_CONFIG_PATH)) as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope="module")
+def r0gen(data, model_struct):
+    return R0Generator(data=data, model_struct=model_struct)
+
+
+@pytest.fixture
+def lhs_dict(data):
+    torch.manual_seed(0)
+    return {
+        "alpha_l": torch.rand(N_SAMPLES) + 0.1,
+        "inf_a": torch.rand(N_SAMPLES),
+        "p": torch.rand(N_SAMPLES, data.n_age),
+        "susc": torch.rand(N_SAMPLES, data.n_age) + 0.5,
+    }
+
+
+def get_eig_vals_per_sample(r0gen, data, lhs_dict):
+    """Compute the eigenvalues one by one, by overriding the parameters of the generator."""
+    ps_original = r0gen.params.copy()
+    population = data.age_data.flatten()
+    eig_vals = []
+    for idx in range(N_SAMPLES):
+        r0gen.params.update({param: value[idx] for param, value in lhs_dict.items()})
+        eig_vals.append(
+            r0gen.get_eig_val(susceptibles=population, population=population, contact_mtx=data.cm)
+        )
+    r0gen.params.update(ps_original)
+    return torch.tensor(eig_vals)
+
+
+def test_batched_params(r0gen, data, lhs_dict):
+    population = data.age_data.flatten()
+    eig_vals = r0gen.get_eig_vals(
+        susceptibles=population, population=population, contact_mtx=data.cm, lhs_dict=lhs_dict
+    )
+    assert eig_vals.shape == (N_SAMPLES,)
+    assert torch.allclose(eig_vals, get_eig_vals_per_sample(r0gen, data, lhs_dict))
+
+
+def test_batched_contacts(r0gen, data):
+    torch.manual_seed(0)
+    population = data.age_data.flatten()
+    cms = torch.rand(N_SAMPLES, data.n_age, data.n_age) * data.cm
+    eig_vals = r0gen.get_eig_vals(susceptibles=population, population=population, contact_mtx=cms)
+    for cm, eig_val in zip(cms, eig_vals):
+        expected = r0gen.get_eig_val(susceptibles=population, population=population, contact_mtx=cm)
+        assert eig_val.item() == pytest.approx(expected, rel=1e-5)
+
+
+def test_block_inverse(r0gen, data, lhs_dict):
+    ps = get_batched_params(params=r0gen.params, lhs_dict=lhs_dict)
+    v_blocks = r0gen._get_v(ps=ps).expand(N_SAMPLES, data.n_age, -1, -1)
+    v_inv = torch.linalg.inv(torch.stack([torch.block_diag(*blocks) for blocks in v_blocks]))
+    v_inv_blocks = r0gen.get_v_inv_blocks(ps=ps, lhs_dict=lhs_dict)
+    for age in range(data.n_age):
+        age_slice = slice(age * r0gen.n_states, (age + 1) * r0gen.n_states)
+        assert torch.allclose(v_inv[:, age_slice, age_slice], v_inv_blocks[:, age], atol=1e-5)
+
+
+def test_v_inv_cache(r0gen, data):
+    ps = get_batched_params(params=r0gen.params)
+    v_inv_blocks = r0gen.get_v_inv_blocks(ps=ps, lhs_dict={"inf_a": torch.rand(N_SAMPLES)})
+    # None of the sampled parameters affect V, so the inverse is shared by the samples
+    assert v_inv_blocks.shape[0] == 1
+    assert r0gen.get_v_inv_blocks(ps=ps) is v_inv_blocks
+    ps["alpha_l"] = ps["alpha_l"] * 2
+    assert r0gen.get_v_inv_blocks(ps=ps) is not v_inv_blocks
+
+
+@pytest.mark.parametrize("tol", [1e-4, 1e-6])
+def test_power_iteration(r0gen, data, model_struct, tol):
+    power_r0gen = R0Generator(
+        data=data, model_struct=model_struct, eig_config={"method": "power", "tol": tol}
+    )
+    torch.manual_seed(0)
+    population = data.age_data.flatten()
+    cms = torch.rand(N_SAMPLES, data.n_age, data.n_age) * data.cm
+    kwargs = {"susceptibles": population, "population": population}
+    eig_vals = r0gen.get_eig_vals(contact_mtx=cms, **kwargs)
+    power_eig_vals = power_r0gen.get_eig_vals(contact_mtx=cms, **kwargs)
+    assert torch.allclose(eig_vals, power_eig_vals, rtol=tol)
+    # Single calls are warm started from the eigenvector of the previous one
+    for cm, eig_val in zip(cms, eig_vals):
+        power_eig_val = power_r0gen.get_eig_val(contact_mtx=cm, **kwargs)
+        assert power_eig_val == pytest.approx(eig_val.item(), rel=tol)
+
+
+def test_unknown_eig_method(data, model_struct):
+    with pytest.raises(ValueError):
+        R0Generator(data=data, model_struct=model_struct, eig_config={"method": "arnoldi"})
+
+
+if __name__ == "__main__":
+    pytest.main(["-v"])
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from emsa.utils.results_store import ResultsStore
+from emsa_examples.utils.dataloader_16_ag import DataLoader
+from emsa_examples.vaccinated_sensitivity.simulation_vacc import SimulationVaccinated
+
+
+@pytest.mark.parametrize("results_format", ["csv", "npy"])
+def test_round_trip(tmp_path, results_format):
+    store = ResultsStore(folder_name=str(tmp_path), results_format=results_format, config_hash="0")
+    output = np.random.default_rng(0).random((20, 3))
+    store.save(output=output, output_name="lhs", filename="r0-3", metadata={"columns": ["a"]})
+    assert np.allclose(store.load(output_name="lhs", filename="r0-3"), output)
+    if results_format == "npy":
+        assert isinstance(store.load(output_name="lhs", filename="r0-3"), np.memmap)
+        metadata = store.load_metadata(output_name="lhs", filename="r0-3")
+        assert metadata == {
+            "columns": ["a"],
+            "config_hash": "0",
+            "shape": [20, 3],
+            "dtype": "float64",
+        }
+    assert store.load_config_hash(output_name="lhs", filename="r0-3") == "0"
+    assert store.load_config_hash(output_name="lhs", filename="r0-2") is None
+
+
+@pytest.mark.parametrize("results_format", ["csv", "npy"])
+def test_append(tmp_path, results_format):
+    store = ResultsStore(folder_name=str(tmp_path), results_format=results_format)
+    output = np.random.default_rng(0).random(10)
+    for start in range(0, 8, 4):
+        store.append(
+            output=output[slice(start, start + 4)],
+            output_name="simulations",
+            filename="r0-3_d_sup",
+            start=start,
+            n_rows=10,
+        )
+    if results_format == "npy":
+        metadata = store.load_metadata(output_name="simulations", filename="r0-3_d_sup")
+        assert metadata["n_rows_written"] == 8 and metadata["shape"] == [10]
+    saved = store.load(output_name="simulations", filename="r0-3_d_sup")
+    assert np.allclose(saved[:8], output[:8])
+    assert store.count_rows(output_name="simulations", filename="r0-3_d_sup") == 8
+    assert store.count_rows(output_name="simulations", filename="r0-3_i_max") == 0
+
+
+def test_truncate(tmp_path):
+    store = ResultsStore(folder_name=str(tmp_path), results_format="csv")
+    output = np.random.default_rng(0).random(10)
+    store.save(output=output, output_name="lhs", filename="r0-3")
+    # A row written in part isn't counted
+    with open(store.get_path(output_name="lhs", filename="r0-3"), "a") as f:
+        f.write("0.5")
+    assert store.count_rows(output_name="lhs", filename="r0-3") == 10
+    store.truncate(output_name="lhs", filename="r0-3", n_rows=6)
+    assert store.count_rows(output_name="lhs", filename="r0-3") == 6
+    assert np.allclose(store.load(output_name="lhs", filename="r0-3"), output[:6])
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        ResultsStore(folder_name=str(tmp_path), results_format="xlsx")
+
+
+def test_prcc_formats(tmp_path):
+    sim = SimulationVaccinated(data=DataLoader())
+    sim.folder_name = str(tmp_path)
+    rng = np.random.default_rng(0)
+    lhs_table = rng.random((50, sim.n_age))
+    sim_output = lhs_table @ rng.random(sim.n_age) + rng.random(50)
+    prcc = {}
+    for results_format in ["csv", "npy"]:
+        sim.results_format = results_format
+        sim.results_store.save(output=lhs_table, output_name="lhs", filename="r0-3")
+        sim.results_store.save(output=sim_output, output_name="simulations", filename="r0-3_d_sup")
+        sim.calculate_prcc(filename="r0-3", target="d_sup")
+        prcc[results_format] = sim.results_store.load(output_name="prcc", filename="r0-3_d_sup")
+    assert np.allclose(prcc["csv"], prcc["npy"])
+
+
+if __name__ == "__main__":
+    pytest.main(["-v"])
@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from emsa_examples.vaccinated_sensitivity.sampler_vaccinated import (
+    SamplerVaccinated,
+    project_onto_capped_simplex,
+)
+
+N_SAMPLES = 1000
+
+
+@pytest.fixture
+def sampler():
+    np.random.seed(0)
+    sim_object = SimpleNamespace(
+        n_age=6,
+        population=torch.from_numpy(np.random.uniform(1e5, 1e6, 6)),
+        params={"total_vaccines": torch.tensor(1.5e6)},
+        sampled_params_boundaries=None,
+        n_samples=N_SAMPLES,
+        batch_size=N_SAMPLES,
+    )
+    return SamplerVaccinated(sim_object=sim_object, variable_params={})
+
+
+def get_allocations_by_bisection(ratios, caps, n_iter=100):
+    """Find the thresholds of the allocations min(caps, t * ratios) by bisection."""
+    lower, upper = np.zeros(ratios.shape[0]), np.full(ratios.shape[0], 1e6)
+    for _ in range(n_iter):
+        threshold = (lower + upper) / 2
+        too_few = np.minimum(caps, threshold[:, None] * ratios).sum(axis=1) < 1
+        lower = np.where(too_few, threshold, lower)
+        upper = np.where(too_few, upper, threshold)
+    return np.minimum(caps, upper[:, None] * ratios)
+
+
+def test_allocate_vaccines(sampler):
+    lhs_table = np.random.rand(N_SAMPLES, 6)
+    lhs_table[:10, 0] = 0
+    population = sampler.sim_object.population.numpy()
+    caps = population / 1.5e6
+    ratios = sampler.norm_table_rows(lhs_table)
+    exceeding = np.any(ratios > caps, axis=1)
+    assert 0 < exceeding.sum() < N_SAMPLES
+
+    allocations = sampler.allocate_vaccines(lhs_table, chunk_size=128)
+    assert np.allclose(allocations.sum(axis=1), 1)
+    assert np.all(allocations <= caps)
+    # Rows within the caps are only normalized
+    assert np.array_equal(allocations[~exceeding], ratios[~exceeding])
+    # The excess is redistributed proportionally to the sampled ratios
+    assert np.allclose(allocations, get_allocations_by_bisection(ratios, caps))
+
+
+def test_allocate_vaccines_infeasible():
+    ratios = np.full((2, 4), 0.25)
+    with pytest.raises(ValueError):
+        project_onto_capped_simplex(ratios=ratios, caps=np.full(4, 0.2))
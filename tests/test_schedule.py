@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import torch
+
+from emsa.model import Schedule
+from emsa.model.ode_solver import get_solver_config
+from emsa_examples.utils.dataloader_16_ag import DataLoader
+from emsa_examples.vaccinated_sensitivity.simulation_vacc import SimulationVaccinated
+
+N_SAMPLES = 3
+
+
+@pytest.fixture(scope="module")
+def vaccinated_sim():
+    return SimulationVaccinated(data=DataLoader())
+
+
+def test_schedule_values():
+    schedule = Schedule(breakpoints=[10, 20], values=[1, 0.5, 2])
+    values = schedule.value_at(torch.tensor([0, 10, 15, 20, 30]))
+    assert torch.equal(values, torch.tensor([1, 0.5, 0.5, 2, 2]))
+
+    window = Schedule.window(start=torch.tensor([0.0, 5.0]), duration=10)
+    assert torch.equal(window.value_at(torch.tensor([12.0, 12.0])), torch.tensor([0.0, 1.0]))
+    assert torch.equal(window.select(torch.tensor([1])).breakpoints, torch.tensor([[5.0, 15.0]]))
+
+
+@pytest.mark.parametrize(
+    "solver_config", [{}, {"method": "rk4"}, {"method": "rk4", "backend": "inference"}]
+)
+def test_vaccination_start_per_sample(vaccinated_sim, solver_config):
+    """Samples with different campaign starts solved in one batch match the separate solutions."""
+    model = vaccinated_sim.model
+    model.solver_config = get_solver_config(solver_config)
+    np.random.seed(0)
+    lhs_table = torch.from_numpy(np.random.dirichlet(np.ones(model.n_age), N_SAMPLES)).float()
+    t_start = torch.tensor([0.0, 20.0, 45.0])
+    y0 = model.get_initial_values().expand(N_SAMPLES, -1)
+    t_eval = torch.arange(0, 150).expand(N_SAMPLES, -1)
+
+    ys = model.get_solution(y0=y0, t_eval=t_eval, lhs_table=lhs_table, t_start=t_start).ys
+    for idx in range(N_SAMPLES):
+        sample = slice(idx, idx + 1)
+        sample_ys = model.get_solution(
+            y0=y0[sample], t_eval=t_eval[sample], lhs_table=lhs_table[sample], t_start=t_start[idx]
+        ).ys
+        assert torch.allclose(ys[sample], sample_ys, rtol=1e-3, atol=1e-2)
+
+
+def test_parameter_schedule(vaccinated_sim):
+    """Doubling beta is the same as doubling the contacts, as the transmission is linear in both."""
+    model = vaccinated_sim.model
+    model.solver_config = get_solver_config({"method": "rk4", "backend": "inference"})
+    lhs_table = torch.full((1, model.n_age), 1 / model.n_age)
+    y0 = model.get_initial_values().unsqueeze(0)
+    t_eval = torch.arange(0, 100).unsqueeze(0)
+    beta = float(model.ps["beta"])
+
+    model.schedules = {"beta": Schedule(breakpoints=[30.5], values=[beta, 2 * beta])}
+    beta_ys = model.get_solution(y0=y0, t_eval=t_eval, lhs_table=lhs_table).ys
+    model.schedules = {"contact_scale": Schedule(breakpoints=[30.5], values=[1, 2])}
+    contact_ys = model.get_solution(y0=y0, t_eval=t_eval, lhs_table=lhs_table).ys
+    model.schedules = {}
+    ys = model.get_solution(y0=y0, t_eval=t_eval, lhs_table=lhs_table).ys
+
+    assert torch.allclose(beta_ys, contact_ys, rtol=1e-4, atol=1e-2)
+    assert torch.allclose(beta_ys[:, :31], ys[:, :31])
+    assert not torch.allclose(beta_ys[:, 31:], ys[:, 31:])
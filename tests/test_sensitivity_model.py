@@ -0,0 +1,452 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from emsa.generics import GenericSampler, SimulationGeneric
+from emsa.model import LayeredMatrix, SparseMatrix
+from emsa.model.ode_compiler import get_struct_hash
+from emsa.sensitivity import SamplerBase
+from emsa.sensitivity.target_calc import (
+    Checkpoint,
+    OutputGenerator,
+    ParallelExecutor,
+    R0CalculatorLHS,
+    TargetCalc,
+)
+from emsa_examples.utils.dataloader_16_ag import DataLoader
+from emsa_examples.vaccinated_sensitivity.sampler_vaccinated import SamplerVaccinated
+from emsa_examples.vaccinated_sensitivity.simulation_vacc import SimulationVaccinated
+
+SEIHR_STRUCT_PATH = "emsa_examples/SEIHR_2_age_groups/configs/model_struct.json"
+SEIHR_CONFIG_PATH = "emsa_examples/SEIHR_2_age_groups/configs/sampling_config.json"
+N_SAMPLES = 10
+
+
+@pytest.fixture
+def sim():
+    params = {"gamma": 0.2, "beta": 0.2, "alpha": 0.3, "eta": [0.5, 0.5], "susc": [0.5, 1]}
+    data = SimpleNamespace(
+        params={key: torch.tensor(value) for key, value in params.items()},
+        cm=torch.tensor([[1, 1], [2, 1]]),
+        age_data=torch.tensor([1e5, 2e5]),
+        n_age=2,
+        device="cpu",
+    )
+    return SimulationGeneric(
+        data=data, model_struct_path=SEIHR_STRUCT_PATH, sampling_config_path=SEIHR_CONFIG_PATH
+    )
+
+
+@pytest.fixture
+def samples(sim):
+    np.random.seed(0)
+    # Bounds of alpha, gamma and the age specific eta
+    bounds = np.array([[0.2, 0.4], [0.2, 0.4], [0.01, 0.9], [0.01, 0.9]])
+    lhs = bounds[:, 0] + np.random.rand(N_SAMPLES, 4) * (bounds[:, 1] - bounds[:, 0])
+    return torch.from_numpy(lhs).float()
+
+
+def get_ode_output(model, samples):
+    model.generate_3D_matrices(samples=samples)
+    y = model.get_initial_values().repeat(N_SAMPLES, 1) * torch.rand(N_SAMPLES, model.n_eq)
+    return model.get_basic_ode()(torch.zeros(N_SAMPLES), y)
+
+
+def test_layered_contacts(sim, samples):
+    model = sim.model
+    cm = model.matrix_generator.cm.float()
+    model.contact_layers = {"home": cm * 0.25, "school": cm * 0.75}
+    sim.sampled_params_boundaries = {**sim.sampled_params_boundaries, "contact_school": [0, 1]}
+    school_weights = torch.linspace(0, 1, N_SAMPLES)
+    torch.manual_seed(0)
+    layered_output = get_ode_output(model, torch.cat([samples, school_weights[:, None]], dim=1))
+    assert isinstance(model.T, LayeredMatrix)
+    assert torch.allclose(model.batch_cm, cm * (0.25 + 0.75 * school_weights[:, None, None]))
+
+    model.T = model.T.to_dense()
+    torch.manual_seed(0)
+    y = model.get_initial_values().repeat(N_SAMPLES, 1) * torch.rand(N_SAMPLES, model.n_eq)
+    dense_output = model.get_basic_ode()(torch.zeros(N_SAMPLES), y)
+    assert torch.allclose(layered_output, dense_output, rtol=1e-4, atol=1e-4)
+
+    # The layers are also scaled by the model parameters, without sampling them
+    sim.sampled_params_boundaries.pop("contact_school")
+    model.ps["contact_school"] = torch.tensor(0.0)
+    model.generate_3D_matrices(samples=samples)
+    assert torch.allclose(model.batch_cm, cm * 0.25)
+    # States with infected in every compartment, so that the transmission term matters
+    y = 1e3 * torch.rand(N_SAMPLES, model.n_eq)
+    closed_output = model.get_basic_ode()(torch.zeros(N_SAMPLES), y)
+    model.T = model.matrix_generator.get_T(cm=cm * 0.25)
+    assert torch.allclose(closed_output, model.get_basic_ode()(torch.zeros(N_SAMPLES), y))
+    model.T = model.matrix_generator.get_T(cm=cm)
+    assert not torch.allclose(closed_output, model.get_basic_ode()(torch.zeros(N_SAMPLES), y))
+
+
+def test_layered_r0(sim, samples):
+    model = sim.model
+    cm = sim.cm.float()
+    model.contact_layers = {"home": cm * 0.25, "school": cm * 0.75}
+    r0 = R0CalculatorLHS(sim_object=sim).get_output(lhs_table=samples)
+    sim.sampled_params_boundaries = {**sim.sampled_params_boundaries, "contact_school": [0, 1]}
+    # R0 is linear in the contact matrix
+    for weight in [0, 1]:
+        weights = torch.full((N_SAMPLES, 1), float(weight))
+        layered_r0 = R0CalculatorLHS(sim_object=sim).get_output(
+            lhs_table=torch.cat([samples, weights], dim=1)
+        )
+        assert torch.allclose(layered_r0, r0 * (0.25 + 0.75 * weight), rtol=1e-4)
+
+    sim.sampled_params_boundaries.pop("contact_school")
+    model.ps["contact_school"] = torch.tensor(0.0)
+    closed_r0 = R0CalculatorLHS(sim_object=sim).get_output(lhs_table=samples)
+    assert torch.allclose(closed_r0, r0 * 0.25, rtol=1e-4)
+
+
+def test_sparse_ode(sim, samples):
+    model = sim.model
+    torch.manual_seed(0)
+    dense_output = get_ode_output(model, samples)
+
+    model.sparse = True
+    torch.manual_seed(0)
+    sparse_output = get_ode_output(model, samples)
+    assert isinstance(model.B, SparseMatrix)
+    assert torch.allclose(dense_output, sparse_output, atol=1e-4)
+
+
+def test_factored_ode(sim, samples):
+    model = sim.model
+    torch.manual_seed(0)
+    dense_output = get_ode_output(model, samples)
+
+    model.ode_engine = "factored"
+    torch.manual_seed(0)
+    factored_output = get_ode_output(model, samples)
+    assert torch.allclose(dense_output, factored_output, rtol=1e-4, atol=1e-4)
+
+
+def test_compiled_ode(sim, samples, monkeypatch, tmp_path):
+    monkeypatch.setenv("EMSA_CACHE_DIR", str(tmp_path))
+    model = sim.model
+    torch.manual_seed(0)
+    dense_output = get_ode_output(model, samples)
+
+    model.ode_engine = "compiled"
+    torch.manual_seed(0)
+    compiled_output = get_ode_output(model, samples)
+    assert torch.allclose(dense_output, compiled_output, rtol=1e-4, atol=1e-4)
+    # The generated source is cached on disk by the hash of the model structure
+    assert os.listdir(tmp_path) == [f"ode_{get_struct_hash(model.model_struct)}.py"]
+
+
+@pytest.mark.parametrize("backend", ["torchode", "inference"])
+def test_streaming_targets(sim, samples, backend):
+    model = sim.model
+    model.solver_config["backend"] = backend
+    targets = ["i_max", "h_max", "r_sup"]
+    config = {"tlim_ini": 50, "tlim_final": 500, "tdelta": 20}
+    output = TargetCalc(model=model, targets=targets, config=config).get_output(
+        lhs_table=samples, batch_size=4
+    )
+    streaming_output = TargetCalc(
+        model=model, targets=targets, config={**config, "streaming": True}
+    ).get_output(lhs_table=samples, batch_size=4)
+    for target in targets:
+        assert torch.allclose(output[target], streaming_output[target])
+
+
+def test_early_stopping(sim, samples):
+    model = sim.model
+    model.solver_config["backend"] = "inference"
+    targets = ["i_max", "h_max", "r_sup"]
+    config = {"tlim_ini": 50, "tlim_final": 500, "tdelta": 20, "streaming": True}
+    target_calc = TargetCalc(model=model, targets=targets, config=config)
+    output = target_calc.get_output(lhs_table=samples, batch_size=4)
+    early_target_calc = TargetCalc(
+        model=model, targets=targets, config={**config, "early_stopping": True}
+    )
+    early_output = early_target_calc.get_output(lhs_table=samples, batch_size=4)
+    # The maxima are reached before stopping, the suprema miss what is left of the infected
+    for target in ["i_max", "h_max"]:
+        assert torch.allclose(output[target], early_output[target])
+    assert torch.allclose(output["r_sup"], early_output["r_sup"], rtol=2e-2)
+    assert torch.all(
+        early_target_calc.solver_stats["n_steps"] <= target_calc.solver_stats["n_steps"]
+    )
+
+
+def test_early_stopping_max_targets():
+    # Several substates per compartment, the first ones decrease before the compartments peak
+    sim = SimulationVaccinated(data=DataLoader())
+    sim.n_samples = 4
+    sim.params["beta"] = sim.get_beta_from_r0(3)
+    np.random.seed(0)
+    sampler = SamplerVaccinated(sim_object=sim, variable_params={"r0": 3})
+    samples = torch.as_tensor(sampler.get_samples()).float()
+    model = sim.model
+    model.solver_config["backend"] = "inference"
+    config = {"tlim_ini": 300, "tlim_final": 1000, "tdelta": 50, "streaming": True}
+    target_calc = TargetCalc(model=model, targets=["i_max"], config=config)
+    output = target_calc.get_output(lhs_table=samples, batch_size=4)
+    early_target_calc = TargetCalc(
+        model=model, targets=["i_max"], config={**config, "early_stopping": True}
+    )
+    early_output = early_target_calc.get_output(lhs_table=samples, batch_size=4)
+    assert torch.all(output["i_max"] > 1e4)
+    assert torch.allclose(output["i_max"], early_output["i_max"])
+    assert torch.all(
+        early_target_calc.solver_stats["n_steps"] < target_calc.solver_stats["n_steps"]
+    )
+
+
+@pytest.mark.parametrize("early_stopping", [False, True])
+def test_matrix_cache(sim, samples, monkeypatch, early_stopping):
+    model = sim.model
+    model.solver_config["backend"] = "inference"
+    model.sparse = True
+    targets = ["i_max", "h_max", "r_sup"]
+    config = {"tlim_ini": 50, "tlim_final": 500, "tdelta": 20, "early_stopping": early_stopping}
+    output = TargetCalc(model=model, targets=targets, config=config).get_output(
+        lhs_table=samples, batch_size=4
+    )
+
+    n_generated = []
+    generate_3D_matrices = model.generate_3D_matrices
+
+    def count_generated(samples):
+        n_generated.append(samples.shape[0])
+        generate_3D_matrices(samples=samples)
+
+    monkeypatch.setattr(model, "generate_3D_matrices", count_generated)
+    cached_output = TargetCalc(
+        model=model, targets=targets, config={**config, "cache_matrices": True}
+    ).get_output(lhs_table=samples, batch_size=4)
+    # The matrices are only generated in the first time window
+    assert sum(n_generated) == N_SAMPLES
+    for target in targets:
+        assert torch.allclose(output[target], cached_output[target])
+
+
+def test_max_targets_only(sim, samples):
+    model = sim.model
+    config = {"tlim_ini": 20, "tlim_final": 500, "tdelta": 20}
+    output = TargetCalc(model=model, targets=["i_max", "r_sup"], config=config).get_output(
+        lhs_table=samples, batch_size=4
+    )
+    # Without sup targets, the simulations continue until the maxima of all samples are reached
+    max_output = TargetCalc(model=model, targets=["i_max"], config=config).get_output(
+        lhs_table=samples, batch_size=4
+    )
+    assert torch.all(max_output["i_max"] > 0)
+    assert torch.allclose(output["i_max"], max_output["i_max"])
+
+
+def test_batched_scenarios(sim, samples, monkeypatch):
+    """The scenarios solved in one batch give the same outputs as solved one by one."""
+    saved = {}
+
+    def save_output(sampler, output, output_name, filename, metadata=None, start=None):
+        saved[f"{output_name}_{filename}"] = torch.as_tensor(output)
+
+    monkeypatch.setattr(SamplerBase, "save_output", save_output)
+    monkeypatch.setattr(GenericSampler, "get_lhs_table", lambda sampler: samples.double().numpy())
+    sim.n_samples = N_SAMPLES
+    sim.batch_size = 2 * N_SAMPLES
+    sim.target_calc_config.update({"tlim_ini": 50, "tlim_final": 500, "tdelta": 20})
+    params = dict(sim.params)
+    for variable_params in sim.variable_param_combinations:
+        sim.get_scenario_params(variable_params)
+        GenericSampler(sim_object=sim, variable_params=variable_params).run()
+    scenario_outputs = dict(saved)
+    saved.clear()
+    sim.params.update(params)
+
+    sim.run_batched_scenarios(sampler_cls=GenericSampler)
+    assert saved.keys() == scenario_outputs.keys()
+    assert len(saved) == 3 * len(sim.variable_param_combinations)
+    for name, output in scenario_outputs.items():
+        assert torch.allclose(saved[name], output, rtol=1e-4)
+    assert sim.scenario_cols == {}
+
+
+@pytest.mark.parametrize("results_format", ["csv", "npy"])
+def test_streamed_sampling(sim, tmp_path, results_format):
+    sim.folder_name = str(tmp_path)
+    sim.results_format = results_format
+    sim.n_samples = N_SAMPLES
+    sim.chunk_size = 4
+    sim.target_calc_config.update({"tlim_ini": 50, "tlim_final": 500, "tdelta": 20})
+    np.random.seed(0)
+    GenericSampler(sim_object=sim, variable_params={"r0": 3}).run()
+
+    lhs_table = np.asarray(sim.results_store.load(output_name="lhs", filename="r0-3"))
+    assert lhs_table.shape == (N_SAMPLES, 4)
+    # Every column hits each of the strata of its bounds once
+    bounds = np.array([[0.2, 0.4], [0.2, 0.4], [0.01, 0.9], [0.01, 0.9]])
+    strata = (lhs_table - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0]) * N_SAMPLES - 0.5
+    assert np.allclose(np.sort(strata, axis=0), np.arange(N_SAMPLES)[:, None])
+    output = OutputGenerator(sim_object=sim).get_output(lhs_table=lhs_table)
+    for target, value in output.items():
+        saved = sim.results_store.load(output_name="simulations", filename=f"r0-3_{target}")
+        assert torch.allclose(torch.as_tensor(np.asarray(saved)).float(), value, rtol=1e-4)
+
+
+def run_interrupted_streamed_sampling(sim, folder_name, monkeypatch, results_format):
+    sim.folder_name = folder_name
+    sim.results_format = results_format
+    sim.n_samples = N_SAMPLES
+    sim.chunk_size = 4
+    sim.target_calc_config.update({"tlim_ini": 50, "tlim_final": 500, "tdelta": 20})
+    save_output = SamplerBase.save_output
+
+    def interrupted_save_output(sampler, output, output_name, filename, metadata=None, start=None):
+        # Interrupted after the samples of the third chunk are saved, but not its targets
+        if output_name == "simulations" and start == 8:
+            raise KeyboardInterrupt
+        save_output(sampler, output, output_name, filename, metadata=metadata, start=start)
+
+    monkeypatch.setattr(SamplerBase, "save_output", interrupted_save_output)
+    np.random.seed(0)
+    with pytest.raises(KeyboardInterrupt):
+        GenericSampler(sim_object=sim, variable_params={"r0": 3}).run()
+    monkeypatch.setattr(SamplerBase, "save_output", save_output)
+
+
+@pytest.mark.parametrize("results_format", ["csv", "npy"])
+def test_resume_streamed_sampling(sim, tmp_path, monkeypatch, capsys, results_format):
+    run_interrupted_streamed_sampling(sim, str(tmp_path), monkeypatch, results_format)
+    sampler = GenericSampler(sim_object=sim, variable_params={"r0": 3})
+    assert not sampler.is_complete()
+    lhs_table = np.load(sampler.get_lhs_table_path())
+
+    sim.resume = True
+    capsys.readouterr()
+    sampler.run()
+    out = capsys.readouterr().out
+    assert "Resuming from sample 8" in out and "Chunk of samples 4 - 8" not in out
+    assert sampler.is_complete()
+    assert not os.path.exists(sampler.get_lhs_table_path())
+
+    saved_lhs = np.asarray(sim.results_store.load(output_name="lhs", filename="r0-3"))
+    assert np.allclose(saved_lhs, lhs_table)
+    output = OutputGenerator(sim_object=sim).get_output(lhs_table=lhs_table)
+    for target, value in output.items():
+        saved = sim.results_store.load(output_name="simulations", filename=f"r0-3_{target}")
+        assert torch.allclose(torch.as_tensor(np.asarray(saved)).float(), value, rtol=1e-4)
+
+
+@pytest.mark.parametrize("results_format", ["csv", "npy"])
+def test_resume_changed_config(sim, tmp_path, monkeypatch, capsys, results_format):
+    run_interrupted_streamed_sampling(sim, str(tmp_path), monkeypatch, results_format)
+    config_hash = sim.config_hash
+    sim.config_hash = "changed"
+    sim.n_samples = 12
+    sim.resume = True
+    sampler = GenericSampler(sim_object=sim, variable_params={"r0": 3})
+    capsys.readouterr()
+    sampler.run()
+    out = capsys.readouterr().out
+    assert "Starting over" in out and "Chunk of samples 0 - 4" in out
+    assert sampler.is_complete()
+    assert sim.results_store.count_rows(output_name="lhs", filename="r0-3") == 12
+
+    # The results of the other configuration aren't complete
+    sim.config_hash = config_hash
+    assert not sampler.is_complete()
+
+
+def test_parallel_output(sim, samples):
+    executor = ParallelExecutor(config={"n_workers": 3})
+    assert executor.get_shards(10) == [slice(0, 3), slice(3, 6), slice(6, 10)]
+    assert executor.get_shards(2) == [slice(0, 1), slice(1, 2)]
+
+    sim.target_calc_config.update({"tlim_ini": 50, "tlim_final": 500, "tdelta": 20})
+    lhs_table = samples.double().numpy()
+    output = OutputGenerator(sim_object=sim).get_output(lhs_table=lhs_table)
+    # Forked workers start faster than spawned ones, which have to import torch again
+    sim.parallel_config = {"n_workers": 2, "threads_per_worker": 1, "start_method": "fork"}
+    parallel_output = OutputGenerator(sim_object=sim).get_output(lhs_table=lhs_table)
+    assert parallel_output.keys() == output.keys()
+    for target, value in output.items():
+        assert torch.allclose(parallel_output[target], value, rtol=1e-4)
+
+
+def _get_worker_info(sim_object, samples):
+    tensors = [sim_object.cm, sim_object.population, sim_object.params["susc"], samples]
+    return {
+        "pid": torch.full((samples.shape[0],), os.getpid()),
+        "shared": torch.tensor([all(tensor.is_shared() for tensor in tensors)] * samples.shape[0]),
+    }
+
+
+def test_parallel_executor_spawn(sim, samples):
+    config = {"n_workers": 2, "threads_per_worker": 1, "start_method": "spawn"}
+    with ParallelExecutor(config=config) as executor:
+        first = executor.map_shards(func=_get_worker_info, sim_object=sim, samples=samples)
+        pool = executor._pool
+        worker_pids = set(pool._processes)
+        second = executor.map_shards(func=_get_worker_info, sim_object=sim, samples=samples)
+        assert executor._pool is pool
+    assert executor._pool is None
+    # The spawned workers attach to the shared tensors, and are kept for both calls
+    assert first["shared"].all() and second["shared"].all()
+    assert set(torch.cat([first["pid"], second["pid"]]).tolist()) <= worker_pids
+    assert os.getpid() not in worker_pids
+
+
+def test_checkpoint_resume(sim, tmp_path, monkeypatch, capsys):
+    sim.folder_name = str(tmp_path)
+    sim.n_samples = N_SAMPLES
+    sim.checkpoint_every = 2
+    sim.target_calc_config.update({"tlim_ini": 20, "tlim_final": 500, "tdelta": 10})
+    save = Checkpoint.save
+    saved_states = []
+
+    def interrupted_save(checkpoint, state):
+        save(checkpoint, state)
+        saved_states.append(state)
+        if len(saved_states) == 2:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(Checkpoint, "save", interrupted_save)
+    np.random.seed(0)
+    with pytest.raises(KeyboardInterrupt):
+        GenericSampler(sim_object=sim, variable_params={"r0": 3}).run()
+    monkeypatch.setattr(Checkpoint, "save", save)
+    sampler = GenericSampler(sim_object=sim, variable_params={"r0": 3})
+    assert sampler.get_checkpoint().exists()
+    assert not sampler.is_complete()
+    assert saved_states[-1]["n_windows"] == 4 and len(saved_states[-1]["indices"]) > 0
+
+    # Resume with the samples saved before the interruption, not new ones
+    np.random.seed(1)
+    sim.resume = True
+    capsys.readouterr()
+    sampler.run()
+    assert "Resuming from the checkpoint" in capsys.readouterr().out
+    assert not sampler.get_checkpoint().exists()
+    assert sampler.is_complete()
+
+    lhs_table = sim.results_store.load(output_name="lhs", filename="r0-3")
+    assert torch.equal(torch.as_tensor(lhs_table).float(), saved_states[-1]["lhs_table"])
+    sim.checkpoint_every = None
+    output = OutputGenerator(sim_object=sim).get_output(lhs_table=lhs_table)
+    for target, value in output.items():
+        saved = sim.results_store.load(output_name="simulations", filename=f"r0-3_{target}")
+        assert torch.allclose(torch.as_tensor(saved).float(), value)
+
+    # Changing the configuration invalidates the checkpoint
+    checkpoint = Checkpoint(path=str(tmp_path / "checkpoint.pt"), config_hash="a")
+    checkpoint.save(saved_states[-1])
+    with pytest.raises(ValueError):
+        Checkpoint(path=checkpoint.path, config_hash="b").load(
+            lhs_table=saved_states[-1]["lhs_table"]
+        )
+
+
+if __name__ == "__main__":
+    pytest.main(["-v"])
@@ -0,0 +1,58 @@
+import json
+import os
+
+import pytest
+import torch
+
+from emsa.utils import share_tensors
+from emsa.utils.dataloader import PROJECT_PATH
+from emsa_examples.utils.dataloader_16_ag import DataLoader
+from emsa_examples.vaccinated_sensitivity.simulation_vacc import SimulationVaccinated
+
+
+def test_data_cache(tmp_path):
+    cache_path = str(tmp_path / "data.pt")
+    data = DataLoader(cache_path=cache_path)
+    cached_data = DataLoader(cache_path=cache_path)
+    assert torch.equal(cached_data.age_data, data.age_data)
+    assert torch.equal(cached_data.cm, data.cm)
+    for layer, cm in data.contact_layers.items():
+        assert torch.equal(cached_data.contact_layers[layer], cm)
+    for param, value in data.params.items():
+        assert torch.equal(torch.as_tensor(cached_data.params[param]), torch.as_tensor(value))
+
+
+def test_stale_data_cache(tmp_path):
+    cache_path = str(tmp_path / "data.pt")
+    params_path = tmp_path / "model_parameters.json"
+    params_path.write_text(
+        open(os.path.join(PROJECT_PATH, "emsa_examples/data/model_parameters.json")).read()
+    )
+    DataLoader(params_path=str(params_path), cache_path=cache_path)
+    params = json.loads(params_path.read_text())
+    param = next(iter(params))
+    params[param]["value"] = 123.0
+    params_path.write_text(json.dumps(params))
+    # The cache was saved from the previous version of the parameters
+    data = DataLoader(params_path=str(params_path), cache_path=cache_path)
+    assert data.params[param] == 123.0
+    assert DataLoader(params_path=str(params_path), cache_path=cache_path).params[param] == 123.0
+    # Nor is it used for other source files
+    other_data = DataLoader(cache_path=cache_path)
+    assert other_data.params[param] != 123.0
+
+
+def test_share_tensors():
+    sim = SimulationVaccinated(data=DataLoader())
+    sim.model.initialize_matrices()
+    cm = sim.cm.clone()
+    # The model refers back to the simulation object, which is traversed only once
+    assert share_tensors(sim) is sim
+    assert sim.cm.is_shared() and torch.equal(sim.cm, cm)
+    assert sim.data.age_data.is_shared()
+    assert all(layer.is_shared() for layer in sim.data.contact_layers.values())
+    assert sim.model.T.is_shared() and sim.model.matrix_generator.cm.is_shared()
+
+
+if __name__ == "__main__":
+    pytest.main(["-v"])
@@ -126,5 +126,89 @@ def _test_model(mock_model: MockModelBase, model_struct):
     ), "Model solutions do not match"
 
 
+@pytest.mark.parametrize(
+    "data_fixture, model_key",
+    [("seihr_data", "seihr"), ("contact_data", "contact"), ("vaccinated_data", "vacc")],
+)
+@pytest.mark.parametrize("ode_engine", ["factored", "compiled"])
+def test_ode_engines(
+    data_fixture, model_key, ode_engine, request, model_structs, monkeypatch, tmp_path
+):
+    """Test that the factored and compiled right-hand sides match the dense matrix formulation."""
+    monkeypatch.setenv("EMSA_CACHE_DIR", str(tmp_path))
+    data = request.getfixturevalue(data_fixture)
+    dense_model = EpidemicModel(data=data, model_struct=model_structs[model_key])
+    engine_model = EpidemicModel(
+        data=data, model_struct=model_structs[model_key], ode_engine=ode_engine
+    )
+
+    exposed_iv = torch.zeros(dense_model.n_age)
+    exposed_iv[0] = 10
+    iv = {"e": exposed_iv} if "l" not in dense_model.state_data else {"l": exposed_iv}
+    y0 = torch.atleast_2d(dense_model.get_initial_values_from_dict(iv))
+    t_eval = torch.atleast_2d(torch.arange(0, 200, 1))
+    dense_sol = dense_model.get_solution(y0, t_eval).ys
+    engine_sol = engine_model.get_solution(y0, t_eval).ys
+    assert torch.allclose(dense_sol, engine_sol, rtol=1e-4, atol=1e-2)
+
+
+@pytest.mark.parametrize("method", ["rk4", "dopri5", "tsit5"])
+def test_solver_methods(method, seihr_data, model_structs):
+    """Test that the solver methods agree with the Euler method with a small step size."""
+    ref_model = EpidemicModel(
+        data=seihr_data,
+        model_struct=model_structs["seihr"],
+        solver_config={"method": "euler", "dt": 0.05},
+    )
+    model = EpidemicModel(
+        data=seihr_data, model_struct=model_structs["seihr"], solver_config={"method": method}
+    )
+
+    exposed_iv = torch.zeros(model.n_age)
+    exposed_iv[0] = 10
+    y0 = torch.atleast_2d(model.get_initial_values_from_dict({"e": exposed_iv})).repeat(2, 1)
+    t_eval = torch.arange(0, 200, 1).repeat(2, 1)
+    ref_sol = ref_model.get_solution(y0, t_eval).ys
+    sol = model.get_solution(y0, t_eval).ys
+    assert torch.allclose(ref_sol, sol, rtol=1e-2, atol=ref_sol.max() * 1e-2)
+    # Statistics of the solver are given for every sample
+    assert model.solver_stats["n_steps"].shape == (2,)
+
+
+@pytest.mark.parametrize(
+    "solver_config",
+    [{"method": "euler"}, {"method": "rk4"}, {"method": "euler", "dt": 0.4}],
+)
+def test_inference_backend(solver_config, vaccinated_data, model_structs):
+    """Test that the inference backend matches the torchode solution."""
+    model = EpidemicModel(
+        data=vaccinated_data, model_struct=model_structs["vacc"], solver_config=solver_config
+    )
+    inference_model = EpidemicModel(
+        data=vaccinated_data,
+        model_struct=model_structs["vacc"],
+        solver_config={**solver_config, "backend": "inference"},
+    )
+
+    exposed_iv = torch.zeros(model.n_age)
+    exposed_iv[0] = 10
+    y0 = torch.atleast_2d(model.get_initial_values_from_dict({"e": exposed_iv})).repeat(2, 1)
+    t_eval = torch.arange(0, 200, 1).repeat(2, 1) + torch.tensor([[0], [50]])
+    sol = model.get_solution(y0, t_eval).ys
+    inference_sol = inference_model.get_solution(y0, t_eval).ys
+    # Times are accumulated differently, which matters for step sizes not exactly representable
+    assert torch.allclose(sol, inference_sol, rtol=1e-3, atol=1e-2)
+    assert torch.equal(
+        inference_model.solver_stats["n_steps"], torch.full((2,), model.solver_stats["n_steps"][0])
+    )
+
+
+def test_unknown_solver_method(seihr_data, model_structs):
+    with pytest.raises(ValueError):
+        EpidemicModel(
+            data=seihr_data, model_struct=model_structs["seihr"], solver_config={"method": "rk45"}
+        )
+
+
 if __name__ == "__main__":
     pytest.main(["-v"])
@@ -0,0 +1,68 @@
+import json
+import os
+
+import pytest
+import torch
+
+from emsa.model import EpidemicModel
+from emsa.utils import PROJECT_PATH
+from emsa_examples.utils.dataloader_16_ag import DataLoader
+
+VACCINATED_CONFIG_PATH = "emsa_examples/vaccinated_sensitivity/configs/model_struct.json"
+
+
+@pytest.fixture(scope="module")
+def model():
+    with open(os.path.join(PROJECT_PATH, VACCINATED_CONFIG_PATH)) as f:
+        model_struct = json.load(f)
+    return EpidemicModel(data=DataLoader(), model_struct=model_struct)
+
+
+def get_mask(model, comp):
+    return torch.arange(model.n_eq) % model.n_comp == model.c_idx[comp]
+
+
+def test_indices(model):
+    for comp in model.compartments:
+        assert torch.equal(model.idx(comp), get_mask(model, comp))
+        assert torch.equal(model.layout.indices(comp), get_mask(model, comp).nonzero().flatten())
+
+
+def test_view(model):
+    solution = torch.rand(3, 4, model.n_eq)
+    for comp in model.compartments:
+        assert torch.equal(
+            model.layout.get_comp(solution, comp=comp), solution[..., get_mask(model, comp)]
+        )
+
+
+def test_aggregation(model):
+    solution = torch.rand(3, 4, model.n_eq)
+    inf_sum = torch.zeros(3, 4)
+    for state, data in model.state_data.items():
+        substates = [comp for comp in model.compartments if comp.rsplit("_", 1)[0] == state]
+        state_sum = sum(solution[..., get_mask(model, comp)].sum(dim=-1) for comp in substates)
+        assert torch.allclose(model.aggregate_by_age(solution, comp=state), state_sum)
+        if data.get("type") == "infected":
+            inf_sum += state_sum
+    assert torch.allclose(model.layout.sum_type(solution, state_type="infected"), inf_sum)
+
+
+def test_batched_aggregation(model):
+    solution = torch.rand(3, 4, model.n_eq)
+    groups = list(model.state_data) + model.compartments + ["infected"]
+    sums = model.aggregate(solution, groups=groups)
+    by_age = model.aggregate(solution, groups=groups, by_age=True)
+    assert sums.shape == (3, 4, len(groups))
+    assert by_age.shape == (3, 4, model.n_age, len(groups))
+    for col, group in enumerate(groups[: len(model.state_data)]):
+        assert torch.allclose(sums[..., col], model.aggregate_by_age(solution, comp=group))
+    for col, comp in enumerate(model.compartments, start=len(model.state_data)):
+        assert torch.allclose(by_age[..., col], model.layout.get_comp(solution, comp=comp))
+    assert torch.allclose(sums[..., -1], model.layout.sum_type(solution, state_type="infected"))
+    with pytest.raises(ValueError):
+        model.aggregate(solution, groups=["unknown"])
+
+
+if __name__ == "__main__":
+    pytest.main(["-v"])